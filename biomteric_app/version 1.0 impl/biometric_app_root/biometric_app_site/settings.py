@@ -82,6 +82,9 @@ DATABASES = {
     }
 }
 
+# Type of the primary key added to models which do not define one
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -134,3 +137,5 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 JSON_URL = '/json/'
 JSON_ROOT = os.path.join(BASE_DIR, 'identification_library/json')
 
+# Number of worker processes used to search the gallery for a matching fish (1 searches in the request process)
+SEARCH_WORKERS = 1
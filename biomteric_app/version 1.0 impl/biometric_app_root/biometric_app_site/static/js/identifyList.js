@@ -170,7 +170,8 @@ function UpdateMatchData(slidePosition) {
     '<tr><td> Tag </td><td>'+ dataToUpdate['tag']+'</td></tr>'+
     '<tr><td> Population </td><td>'+ dataToUpdate['population']+'</td></tr>'+
     '<tr><td> Tank </td><td>'+ dataToUpdate['tank']+'</td></tr>'+
-    '<tr><td> Date </td><td>'+ dataToUpdate['date']+'</td></tr></tbody>');
+    '<tr><td> Date </td><td>'+ dataToUpdate['date']+'</td></tr>'+
+    '<tr><td> Matching spots </td><td>'+ dataToUpdate['score']+'</td></tr></tbody>');
 };
 
 /**
@@ -4,5 +4,8 @@ from django.apps import AppConfig
 
 class IdentificationLibraryConfig(AppConfig):
     name = 'identification_library'
-    
 
+    def ready(self):
+        # connect the FishData signals which keep the gallery up to date
+        from . import signals
+    
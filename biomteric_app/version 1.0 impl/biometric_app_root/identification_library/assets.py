@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Cached loader for the JSON files in identification_library/json.
+
+Each file is read once per process, the first time it is used, and is read
+again only when its modification time changes. Nothing is read when the
+module is imported. The shape templates of memory_shapes.json are converted
+to numpy contours once when the file is read, so the contour matching does
+not convert the nested lists on every call. The cached value is shared by
+every caller and must not be changed, a file is changed through update_json
+which applies the change to a fresh copy while holding the lock. Files are 
+saved by writing a temporary file and replacing the old one, so a reader 
+never sees a file which is half written.
+"""
+
+#import python libraries
+import json
+import os
+import threading
+import numpy
+
+# import json file path
+from biometric_app_site.settings import JSON_ROOT
+
+
+# parsed files, name -> (modification time, value)
+_cache = {}
+_lock = threading.Lock()
+
+
+def load_json(name, convert=None):
+
+    """
+    DESCRIPTION
+    This function returns the parsed contents of a JSON file, reading it only
+    if it has not been read before or has changed since.
+
+    INPUT
+    name = the file name in JSON_ROOT
+    convert = an optional function applied to the parsed contents
+
+    OUTPUT
+    value = the parsed (and converted) contents, shared by every caller
+    """
+
+    path = os.path.join(JSON_ROOT, name)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _cache.get(name)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with _lock:
+        #another thread may have read the file while waiting for the lock
+        cached = _cache.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r') as json_file:
+            value = json.load(json_file)
+        if convert is not None:
+            value = convert(value)
+        _cache[name] = (mtime, value)
+    #return
+    return value
+
+
+def update_json(name, update):
+
+    """
+    DESCRIPTION
+    This function changes a JSON file. The file is read again while holding
+    the lock, so the change is made to a fresh copy of the latest contents 
+    and not to the cached value returned by load_json, and two threads
+    changing the file at the same time do not lose each other's change.
+
+    INPUT
+    name = the file name in JSON_ROOT
+    update = a function which changes the parsed contents in place
+    """
+
+    path = os.path.join(JSON_ROOT, name)
+    with _lock:
+        with open(path, 'r') as json_file:
+            value = json.load(json_file)
+        update(value)
+        with open(path + '.tmp', 'w') as json_file:
+            json.dump(value, json_file)
+        os.replace(path + '.tmp', path)
+        #the next load_json reads (and converts) the new contents
+        _cache.pop(name, None)
+
+
+def shape_contours(shapes):
+
+    """
+    DESCRIPTION
+    This function converts the shape templates to numpy contours.
+
+    INPUT
+    shapes = a dictionary of shape type -> shape name -> contour lists
+
+    OUTPUT
+    shapes = the same dictionary with (n, 1, 2) int32 numpy contours
+    """
+
+    return {shapeType: {shape: numpy.array(contour, numpy.int32).reshape(-1, 1, 2)
+                        for shape, contour in templates.items()}
+            for shapeType, templates in shapes.items()}
+
+
+def memory_contours():
+
+    """
+    DESCRIPTION
+    This function returns the successful thresholding parameter sets of each
+    shape type (see untidy_fun.edge_optimized).
+
+    OUTPUT
+    contourMemory = a dictionary of shape type -> list of parameter sets
+    """
+
+    return load_json('memory_contours.json')
+
+
+def memory_shapes():
+
+    """
+    DESCRIPTION
+    This function returns the shape templates of each shape type.
+
+    OUTPUT
+    shapeMemory = a dictionary of shape type -> shape name -> numpy contour
+    """
+
+    return load_json('memory_shapes.json', shape_contours)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Batch identification of many new individuals against the gallery.
+
+The gallery arrays are loaded once for the whole batch. The embedding scores
+of every query against every gallery row are calculated as blocked matrix
+products, with the gallery blocks sized to stay in the CPU cache and the
+query blocks sized to keep the score block under a memory limit. Only the
+representative rows of the identities are scored, as in a single search.
+The nearest rows of each query are then passed to getBioMatchData, so each
+query goes through the same candidate selection, prefilter cascade, exact
+ranking and expansion into sightings as a single search.
+"""
+
+#import python libraries
+import numpy
+
+# import shared modules
+from . import features
+from . import functions
+from .gallery import get_gallery, EMBEDDING_CANDIDATES
+from .identifyImage import getBioMatchData
+
+
+# size of a block of gallery embeddings, roughly the size of the L2 cache
+BLOCK_BYTES = 1024 * 1024
+
+# default limit on the memory used by a block of scores
+MEMORY_LIMIT_MB = 256
+
+
+def blocked_nearest(matrix, queries, number, memory_mb):
+
+    """
+    DESCRIPTION
+    This function finds the rows of matrix with the highest dot product with
+    each query. The products are calculated one block at a time and only the
+    best rows so far are kept for each query, so the full query x gallery
+    score matrix is never built.
+
+    INPUT
+    matrix = an (N, D) float32 array of gallery embeddings
+    queries = a (Q, D) float32 array of query embeddings
+    number = the number of rows to return for each query
+    memory_mb = the limit on the memory used by a block of scores
+
+    OUTPUT
+    nearest = a list with a list of row numbers for each query, best first
+              and lowest row first for equal scores
+    """
+
+    number = min(number, len(matrix))
+    if number == 0:
+        return [[] for x in queries]
+    #the number of gallery rows in a cache sized block
+    size = matrix.shape[1] * matrix.itemsize
+    block_rows = max(number, BLOCK_BYTES // max(size, 1))
+    #the number of queries so a block of scores fits in the memory limit
+    block_queries = max(1, (memory_mb * 1024 * 1024) //
+                        ((block_rows + number) * 4 * 2))
+    nearest = []
+    for start_query in range(0, len(queries), block_queries):
+        query = queries[start_query:start_query + block_queries]
+        #the best scores and rows so far for each query in the block
+        best_scores = numpy.full((len(query), 0), -numpy.inf, numpy.float32)
+        best_rows = numpy.zeros((len(query), 0), numpy.int64)
+        for start_row in range(0, len(matrix), block_rows):
+            block = matrix[start_row:start_row + block_rows]
+            scores = numpy.dot(query, block.T)
+            rows = numpy.arange(start_row, start_row + len(block))
+            #merge with the best so far and keep the top number, the best
+            #rows so far come before the rows of the block and are sorted,
+            #so a stable sort keeps the lowest row first for equal scores
+            scores = numpy.concatenate([best_scores, scores], axis=1)
+            rows = numpy.concatenate([best_rows,
+                numpy.broadcast_to(rows, (len(query), len(rows)))], axis=1)
+            top = numpy.argsort(-scores, axis=1, kind='stable')[:, :number]
+            best_scores = numpy.take_along_axis(scores, top, axis=1)
+            best_rows = numpy.take_along_axis(rows, top, axis=1)
+        nearest += best_rows.tolist()
+    #return
+    return nearest
+
+
+def identify_batch(new_individuals, method, matchquality, matchTop,
+                   memory_mb=MEMORY_LIMIT_MB):
+
+    """
+    DESCRIPTION
+    This function finds the ranked matches of a list of new individuals with
+    one pass over the gallery. The nearest representative rows of every 
+    query are found together, and each query is then searched by 
+    getBioMatchData with them, so it finds the same matches as a single
+    search. analyzeData is still used for a single image.
+
+    INPUT
+    new_individuals = a list of individuals to match (spots + ref points,
+                      spots_standard and name as built by analyzeData)
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    matchTop = the number of ranked matches to return for each individual
+    memory_mb = the limit on the memory used by a block of scores
+
+    OUTPUT
+    results = a list with the getBioMatchData result of each new individual
+              and its name
+    """
+
+    #load the gallery arrays once for the whole batch
+    gallery = get_gallery()
+    #the queries with standard space spots whose search uses the usual
+    #representative rows (see GalleryArrays.representatives)
+    standard = [method in functions.STANDARD_METHODS and
+                x.get('spots_standard') is not None and
+                gallery.representatives(x['name']) is gallery.representative
+                for x in new_individuals]
+    #find the nearest embeddings for all of these queries at once
+    queries = [x for x, ok in zip(new_individuals, standard) if ok]
+    embeddings = numpy.array([features.pattern_embedding(x['spots_standard'])
+                              for x in queries], numpy.float32)
+    embeddings = embeddings.reshape(len(queries), gallery.embedding.shape[1])
+    rows = numpy.flatnonzero(gallery.representative)
+    nearest = iter(blocked_nearest(gallery.embedding[rows], embeddings,
+                                   EMBEDDING_CANDIDATES, memory_mb))
+    results = []
+    for new_individual, ok in zip(new_individuals, standard):
+        #the other queries find their nearest rows in the search
+        matchData = getBioMatchData(gallery, new_individual, [method],
+                                    matchquality, 1, matchTop, None,
+                                    nearest=rows[next(nearest)].tolist() if ok
+                                    else None)
+        results += [dict(matchData, name=new_individual['name'])]
+    #return
+    return results
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Derived FishData fields which are calculated once when a row is saved, so
+the matching functions do not need to recalculate them for every search.
+"""
+
+#import python libraries
+import json
+import numpy
+
+# import shared modules
+from .modules import fish_fun
+from .modules import misc_fun
+from .modules import opencv_fun
+
+
+# occupancy grid in standard space, nose at x=100 and tail at x=600
+GRID_BOUNDS = [100, 300, 600, 500]
+GRID_SIZE = [16, 8]
+
+# gaussian splatted grid used as a fixed length embedding of a pattern
+EMBEDDING_SIZE = [24, 8]
+EMBEDDING_SIGMA = 16
+
+# settings for the geometric hash of the standard space spot triangles, 
+# change HASH_VERSION whenever they change so the stored keys are replaced
+HASH_VERSION = 1
+HASH_NEIGHBOURS = 4
+HASH_RATIO_BINS = 40
+HASH_ANGLE_BINS = 48
+HASH_CELL_SIZE = 40
+
+
+def standard_spots(spots, ref_nose, ref_tail):
+
+    """
+    DESCRIPTION
+    This function converts a spot pattern into the standardized nose/tail 
+    space used for matching (see fish_fun.standardize_pattern). 
+
+    INPUT
+    spots = a list of xy coordinates
+    ref_nose = the xy coordinate of the nose
+    ref_tail = the xy coordinate of the tail
+
+    OUTPUT
+    spots_standard = a list of xy coordinates in standard space or None if
+                     either reference point is missing
+    """
+
+    #the reference points are needed to place the pattern in standard space
+    if ref_nose is None or ref_tail is None:
+        return None
+    #return
+    return fish_fun.standardize_pattern({'spots': spots,
+                                         'ref_nose': ref_nose,
+                                         'ref_tail': ref_tail})
+
+
+def grid_signature(spots_standard):
+
+    """
+    DESCRIPTION
+    This function generates a coarse occupancy grid of a standard space spot
+    pattern. The area between the nose and tail is divided into GRID_SIZE 
+    cells and a cell is set when it contains at least one spot. The cells 
+    are packed into bits and returned as a hex string.
+
+    INPUT
+    spots_standard = a list of xy coordinates in standard space
+
+    OUTPUT
+    signature = a hex string with one bit per grid cell
+    """
+
+    grid = numpy.zeros(GRID_SIZE[::-1], bool)
+    points = numpy.asarray(spots_standard, numpy.float64).reshape(-1, 2)
+    #find the cell of each spot, skipping spots outside the grid
+    x = numpy.floor((points[:, 0] - GRID_BOUNDS[0]) * GRID_SIZE[0] / 
+                    float(GRID_BOUNDS[2] - GRID_BOUNDS[0])).astype(int)
+    y = numpy.floor((points[:, 1] - GRID_BOUNDS[1]) * GRID_SIZE[1] / 
+                    float(GRID_BOUNDS[3] - GRID_BOUNDS[1])).astype(int)
+    inside = (x >= 0) & (x < GRID_SIZE[0]) & (y >= 0) & (y < GRID_SIZE[1])
+    grid[y[inside], x[inside]] = True
+    #return
+    return numpy.packbits(grid).tobytes().hex()
+
+
+def hash_keys(spots_standard, expand=False):
+
+    """
+    DESCRIPTION
+    This function generates the geometric hash keys of a standard space spot
+    pattern (see opencv_fun.pattern_triangle_keys). The keys of each gallery
+    row are stored in the hashKeys field, the keys of a query are generated
+    with expand set.
+
+    INPUT
+    spots_standard = a list or (n, 2) array of xy coordinates in standard space
+    expand = include the neighbouring bins of each key
+
+    OUTPUT
+    keys = a sorted int64 numpy array of keys
+    """
+
+    return opencv_fun.pattern_triangle_keys(spots_standard, HASH_NEIGHBOURS,
+                                            HASH_RATIO_BINS, HASH_ANGLE_BINS,
+                                            HASH_CELL_SIZE, expand)
+
+
+def stored_hash_keys(spots_standard):
+
+    """
+    DESCRIPTION
+    This function generates the text stored in the hashKeys field of a row, 
+    the HASH_VERSION followed by the hash keys in hex. The keys are generated
+    from the whole number spots, as the gallery reads them (see 
+    gallery.decode_points).
+
+    INPUT
+    spots_standard = a list of xy coordinates in standard space or None
+
+    OUTPUT
+    value = a string of the form 'version:hex'
+    """
+
+    points = numpy.array(spots_standard or [], numpy.int32).reshape(-1, 2)
+    keys = numpy.asarray(hash_keys(points), '<i8')
+    #return
+    return '%d:%s' % (HASH_VERSION, keys.tobytes().hex())
+
+
+def decode_hash_keys(value):
+
+    """
+    DESCRIPTION
+    This function reads the hash keys stored in the hashKeys field.
+
+    INPUT
+    value = the text of the hashKeys field
+
+    OUTPUT
+    keys = an int64 numpy array of keys, or None when the field is empty or
+           was written with another HASH_VERSION
+    """
+
+    version, _, keys = (value or '').partition(':')
+    if version != str(HASH_VERSION):
+        return None
+    #return
+    return numpy.frombuffer(bytes.fromhex(keys), '<i8').astype(numpy.int64)
+
+
+def pattern_embedding(spots_standard):
+
+    """
+    DESCRIPTION
+    This function converts a standard space spot pattern into a fixed length
+    vector. Each spot is spread over a grid covering GRID_BOUNDS with a 
+    gaussian of EMBEDDING_SIGMA pixels, so small shifts in the spot positions
+    only change the vector slightly. The grid is centered on its mean and 
+    scaled to unit length, so the dot product of two vectors is their 
+    correlation.
+
+    INPUT
+    spots_standard = a list of xy coordinates in standard space
+
+    OUTPUT
+    embedding = a float32 numpy array of EMBEDDING_SIZE[0] * EMBEDDING_SIZE[1]
+                values (all zero for an empty pattern)
+    """
+
+    points = numpy.asarray(spots_standard, numpy.float64).reshape(-1, 2)
+    #the centre of each grid cell
+    x = GRID_BOUNDS[0] + (numpy.arange(EMBEDDING_SIZE[0]) + 0.5) * \
+        (GRID_BOUNDS[2] - GRID_BOUNDS[0]) / float(EMBEDDING_SIZE[0])
+    y = GRID_BOUNDS[1] + (numpy.arange(EMBEDDING_SIZE[1]) + 0.5) * \
+        (GRID_BOUNDS[3] - GRID_BOUNDS[1]) / float(EMBEDDING_SIZE[1])
+    #the gaussian is separable so the grid is a product of x and y weights
+    weight_x = numpy.exp(-(x[None, :] - points[:, 0:1])**2 / (2.0 * EMBEDDING_SIGMA**2))
+    weight_y = numpy.exp(-(y[None, :] - points[:, 1:2])**2 / (2.0 * EMBEDDING_SIGMA**2))
+    embedding = numpy.dot(weight_y.T, weight_x).ravel()
+    #center and scale to unit length
+    embedding = embedding - embedding.mean()
+    length = numpy.linalg.norm(embedding)
+    if length > 0:
+        embedding = embedding / length
+    #return
+    return embedding.astype(numpy.float32)
+
+
+def pattern_stats(spots, spots_standard, ref_nose, ref_head, ref_tail):
+
+    """
+    DESCRIPTION
+    This function calculates the cheap statistics of a spot pattern used by
+    the prefilter cascade (see GalleryArrays.cascade). The spacing values 
+    are measured in standard space so they do not depend on the image size.
+
+    INPUT
+    spots = a list of xy coordinates
+    spots_standard = the spots in standard space or None
+    ref_nose, ref_head, ref_tail = the xy coordinates of the ref points or None
+
+    OUTPUT
+    stats = a dictionary with spotCount, spacingAverage, spacingClosest, 
+            noseTailRatio and gridSignature (None when it can not be 
+            calculated)
+    """
+
+    stats = {'spotCount': len(spots), 'spacingAverage': None, 
+             'spacingClosest': None, 'noseTailRatio': None, 
+             'gridSignature': ''}
+    if spots_standard is not None:
+        stats['spacingAverage'] = opencv_fun.pattern_spacing_average(spots_standard)[0]
+        stats['spacingClosest'] = opencv_fun.pattern_spacing_closest(spots_standard)[0]
+        stats['gridSignature'] = grid_signature(spots_standard)
+    #ratio of the nose to head distance to the nose to tail distance
+    if ref_nose is not None and ref_head is not None and ref_tail is not None:
+        length = misc_fun.distance(ref_nose, ref_tail)
+        if length > 0:
+            stats['noseTailRatio'] = misc_fun.distance(ref_nose, ref_head) / float(length)
+    #return
+    return stats
+
+
+def update_features(data_individual):
+
+    """
+    DESCRIPTION
+    This function fills in the derived fields of a FishData object from its
+    spots and reference points. It is called before every save.
+
+    INPUT
+    data_individual = a FishData object (also works on migration models)
+    """
+
+    #decode the stored spots and ref points
+    spots = json.loads(data_individual.spots) if data_individual.spots else []
+    ref_nose = json.loads(data_individual.refNose) if data_individual.refNose else None
+    ref_tail = json.loads(data_individual.refTail) if data_individual.refTail else None
+    ref_head = json.loads(data_individual.refHead) if data_individual.refHead else None
+    #store the spots in standard space
+    spots_standard = standard_spots(spots, ref_nose, ref_tail)
+    if spots_standard is None:
+        data_individual.spotsStandard = ''
+    else:
+        data_individual.spotsStandard = json.dumps(spots_standard)
+    #store the statistics used by the prefilter cascade
+    stats = pattern_stats(spots, spots_standard, ref_nose, ref_head, ref_tail)
+    for key in stats:
+        setattr(data_individual, key, stats[key])
+    #store the geometric hash keys
+    data_individual.hashKeys = stored_hash_keys(spots_standard)
@@ -4,8 +4,10 @@ Created on Mon Apr 29 10:02:06 2019
 """
 
 #import libraries
-import copy
 import datetime
+import heapq
+import time
+import numpy
 
 
 #import shared modules
@@ -105,6 +107,10 @@ def search_for_pattern(dataset, new_individual, limit, perm, method):
     while loop < len(range(perm)):
         #initialize None for return values
         match_value = None
+        #collect the alignment for each candidate in this permutation
+        candidates = []
+        matrices = []
+        patterns = []
         #loop through each population
         for population in dataset:
             #skip if not the same population as the input image
@@ -126,29 +132,44 @@ def search_for_pattern(dataset, new_individual, limit, perm, method):
                     image_2 = str(new_individual["population"]) + str(new_individual["date"]) + str(new_individual["number"])
                     if image_1 == image_2:
                         continue                    
-                    #align the data_individual to the new individual
-                    aligned_pattern = fish_fun.align_patterns(copy.deepcopy(new_individual), 
-                                                                copy.deepcopy(data_individual), 
-                                                                method)
-                    #compare to new_individual
-                    match_list = fish_fun.compare_patterns(new_individual['spots'], 
-                                                             aligned_pattern)
-                    #count the number of matching spots
-                    match_value = len([x for x in match_list if x[1] < 0.15])
-                    #break if sufficient number of matching spots is found
-                    if match_value > limit:
-                        #add info to a dictionary
-                        matching_image = {"population": population,
-                                          "date": date,
-                                          "number": number}
-                        #calculate the search time
-                        end_time = datetime.datetime.now()
-                        time_out = end_time - start_time
-                        match_data["value"] = match_value
-                        match_data["time"] = time_out.total_seconds()  
-                        match_data["permutations"] = loop
-                        #return
-                        return matching_image, match_data 
+                    #get the matrix to align the data_individual to the new individual
+                    matrix, pattern = fish_fun.align_matrix(new_individual, 
+                                                            data_individual, 
+                                                            method)
+                    candidates += [(population, date, number)]
+                    matrices += [matrix]
+                    patterns += [numpy.array(pattern).reshape(-1, 2)]
+        #skip the permutation if there is nothing to compare
+        if len(candidates) == 0:
+            loop += 1
+            continue
+        #align all candidate patterns in one vectorized call
+        offsets = numpy.cumsum([0] + [len(x) for x in patterns])
+        aligned = fish_fun.align_patterns_batch(numpy.array(matrices), 
+                                                numpy.concatenate(patterns), 
+                                                offsets)
+        #compare each aligned pattern in the original order
+        for key, (population, date, number) in enumerate(candidates):
+            aligned_pattern = aligned[offsets[key]:offsets[key + 1]]
+            #compare to new_individual
+            match_list = fish_fun.compare_patterns(new_individual['spots'], 
+                                                     aligned_pattern)
+            #count the number of matching spots
+            match_value = len([x for x in match_list if x[1] < 0.15])
+            #break if sufficient number of matching spots is found
+            if match_value > limit:
+                #add info to a dictionary
+                matching_image = {"population": population,
+                                  "date": date,
+                                  "number": number}
+                #calculate the search time
+                end_time = datetime.datetime.now()
+                time_out = end_time - start_time
+                match_data["value"] = match_value
+                match_data["time"] = time_out.total_seconds()  
+                match_data["permutations"] = loop
+                #return
+                return matching_image, match_data 
         loop += 1                       
     #calculate time it took to match
     end_time = datetime.datetime.now()
@@ -188,4 +209,226 @@ def add_match_data(match_data, population, date, number, new_data):
     match_data[population][date][number] = new_data
     #return
     return match_data
-  
\ No newline at end of file
+  
+
+# methods which align the patterns stored in standard space
+STANDARD_METHODS = ['fish_standard', 'fish_ransac']
+
+# standard space methods which give the same score every time a pair is 
+# aligned (fish_ransac seeds its random generator), the other methods draw 
+# new random samples each time so their scores are never cached
+FIXED_METHODS = ['fish_ransac']
+
+# number of gallery rows aligned together before checking for a match
+CHUNK_SIZE = 8
+
+
+def score_gallery_rows(gallery, new_individual, rows, method, cache=None,
+                       cache_counts=None):
+    
+    """
+    DESCRIPTION
+    This function aligns a set of gallery rows to the new individual and 
+    counts the matching spots for each row. For the standard space methods
+    the rows with standard space spots are aligned in one vectorized call 
+    (see fish_fun.align_patterns_batch), any other row falls back to the 
+    fish_ref method using the original spots. The rows found in the cache 
+    are not aligned again, and only the scores of the FIXED_METHODS aligned
+    in standard space are added to it, so a random score is drawn again by
+    every pass of a search.
+    
+    INPUT
+    gallery = a GalleryArrays object (see gallery.py)
+    new_individual = the individual to match (spots + ref points, and 
+                     spots_standard for the standard space methods)
+    rows = a list of gallery row numbers
+    method = a string defining which alignment method to use
+    cache = a dictionary of row to (match_value, inliers, matrix) of the 
+            rows already scored (see scorecache.py) which the new fixed 
+            scores are added to, or None. inliers is the number of spot pairs found by
+            compare_patterns, of which match_value passed the ratio test
+    cache_counts = a dictionary whose 'hits' value is increased by the 
+                   number of rows found in the cache, or None
+    
+    OUTPUT
+    match_values = a list with the number of matching spots for each row
+    """
+    
+    if cache is None:
+        cache = {}
+    #only the rows not in the cache are aligned
+    rows_new = [row for row in rows if row not in cache]
+    scores = {row: cache[row] for row in rows if row in cache}
+    if cache_counts is not None:
+        cache_counts['hits'] += len(rows) - len(rows_new)
+    #the query pattern in standard space (see features.standard_spots)
+    query_standard = {'spots': new_individual.get('spots_standard')}
+    standard = method in STANDARD_METHODS and query_standard['spots'] is not None
+    #align the standard space rows in one call
+    aligned_gallery = {}
+    if standard:
+        hashed = []
+        matrices = []
+        #find the alignment matrix for every standard space candidate
+        for row in rows_new:
+            if not gallery.standard[row]:
+                continue
+            matrix, pattern = fish_fun.align_matrix(query_standard,
+                {'spots': gallery.pattern_standard(row)}, method)
+            #rows which can not be aligned have no matching spots
+            if matrix is None:
+                scores[row] = (0, 0, None)
+                continue
+            hashed += [row]
+            matrices += [matrix]
+        matrices = numpy.array(matrices, numpy.float64).reshape(-1, 2, 3)
+        #align all candidate patterns in one vectorized call
+        patterns = [gallery.pattern_standard(row) for row in hashed]
+        offsets = numpy.cumsum([0] + [len(x) for x in patterns])
+        if len(patterns) > 0:
+            aligned = fish_fun.align_patterns_batch(matrices, 
+                                                    numpy.concatenate(patterns), 
+                                                    offsets)
+            aligned_gallery = {row: aligned[offsets[key]:offsets[key + 1]] 
+                               for key, row in enumerate(hashed)}
+            matrix_rows = dict(zip(hashed, matrices.tolist()))
+    #compare each row to the new individual
+    for row in rows_new:
+        if row in scores:
+            continue
+        matrix = None
+        if row in aligned_gallery:
+            #both patterns are already in standard space
+            match_list = fish_fun.compare_patterns(query_standard['spots'], 
+                                                   aligned_gallery[row])
+            matrix = matrix_rows[row]
+        else:
+            #rows without standard space spots fall back to fish_ref
+            method_row = 'fish_ref' if method in STANDARD_METHODS else method
+            #align the data_individual to the new individual
+            aligned_pattern = fish_fun.align_patterns(new_individual, 
+                                                      gallery.individual(row), 
+                                                      method_row)
+            #compare to new_individual
+            match_list = fish_fun.compare_patterns(new_individual['spots'], 
+                                                   aligned_pattern)
+        #count the number of matching spots
+        scores[row] = (len([x for x in match_list if x[1] < 0.15]), 
+                       len(match_list), matrix)
+    #keep the scores which are the same when aligned again
+    if standard and method in FIXED_METHODS:
+        for row in rows_new:
+            if gallery.standard[row]:
+                cache[row] = scores[row]
+    #return
+    return [scores[row][0] for row in rows]
+
+
+def rank_gallery_rows(gallery, new_individual, rows, method, matchquality, top, 
+                      deadline, cache=None, cache_counts=None):
+    
+    """
+    DESCRIPTION
+    This function finds the top scoring gallery rows for the new individual.
+    A heap of the best rows found so far is kept, and a row is skipped 
+    without being aligned when the most spots it could match (the smaller of
+    the two spot counts) can not beat the lowest score in a full heap. Only
+    rows with more than matchquality matching spots are ranked. When the 
+    deadline passes the rows ranked so far are returned.
+    
+    INPUT
+    gallery = a GalleryArrays object (see gallery.py)
+    new_individual = the individual to match
+    rows = a list of gallery row numbers, most promising first
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    top = the number of rows to return
+    deadline = the time.time() at which to stop, or None for no limit
+    cache = the score cache passed to score_gallery_rows, or None
+    cache_counts = the cache hit counts passed to score_gallery_rows, or None
+    
+    OUTPUT
+    ranked = a list of (row, match_value) tuples, best first. Rows with equal
+             values keep the order of the rows list
+    checked = the number of rows checked before the deadline
+    """
+    
+    #the upper bound on the number of matching spots for each row
+    query_count = len(new_individual['spots'])
+    counts = numpy.diff(gallery.offsets)
+    #heap of (match_value, -position, row) with the worst row first
+    heap = []
+    checked = 0
+    for start in range(0, len(rows), CHUNK_SIZE):
+        #stop when the time is up
+        if deadline is not None and time.time() > deadline:
+            break
+        checked = min(start + CHUNK_SIZE, len(rows))
+        #the value a row has to beat to enter the heap
+        if len(heap) == top:
+            limit = heap[0][0]
+        else:
+            limit = matchquality
+        #skip the rows which can not beat the limit
+        chunk = [(position, row) for position, row in 
+                 enumerate(rows[start:start + CHUNK_SIZE], start)
+                 if min(query_count, counts[row]) > limit]
+        if len(chunk) == 0:
+            continue
+        #align and compare the remaining rows
+        match_values = score_gallery_rows(gallery, new_individual, 
+                                          [row for position, row in chunk], 
+                                          method, cache, cache_counts)
+        for (position, row), match_value in zip(chunk, match_values):
+            if match_value <= matchquality:
+                continue
+            item = (match_value, -position, row)
+            if len(heap) < top:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+    #sort best first
+    ranked = sorted(heap, reverse=True)
+    #return
+    return [(row, match_value) for match_value, position, row in ranked], checked
+
+
+def search_gallery_rows(gallery, new_individual, rows, method, matchquality, 
+                        deadline, cache=None, cache_counts=None):
+    
+    """
+    DESCRIPTION
+    This function finds the first gallery row with more than matchquality 
+    matching spots, aligning the rows a chunk at a time so the search stops 
+    soon after a match is found or the deadline passes.
+    
+    INPUT
+    gallery = a GalleryArrays object (see gallery.py)
+    new_individual = the individual to match
+    rows = a list of gallery row numbers, most promising first
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    deadline = the time.time() at which to stop, or None for no limit
+    cache = the score cache passed to score_gallery_rows, or None
+    cache_counts = the cache hit counts passed to score_gallery_rows, or None
+    
+    OUTPUT
+    match = a tuple of (row, match_value) or None if no match was found
+    checked = the number of rows checked
+    """
+    
+    checked = 0
+    for start in range(0, len(rows), CHUNK_SIZE):
+        #stop when the time is up
+        if deadline is not None and time.time() > deadline:
+            break
+        chunk = rows[start:start + CHUNK_SIZE]
+        checked += len(chunk)
+        #align and compare a chunk of rows
+        match_values = score_gallery_rows(gallery, new_individual, chunk, 
+                                          method, cache, cache_counts)
+        for row, match_value in zip(chunk, match_values):
+            if match_value > matchquality:
+                return (row, match_value), checked
+    #return
+    return None, checked
@@ -0,0 +1,1272 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory copy of the FishData gallery used by the matching functions.
+
+The gallery is loaded from the database once per process and is then kept
+up to date by the FishData post_save/post_delete signals (see signals.py), so
+the search loop never has to query the ORM or decode JSON again. A geometric
+hash of the spot triangles of each row is built at the same time from the 
+keys stored with the row (see features.hash_keys), so a search only needs to
+align the rows voted for by the query (see GalleryArrays.vote), and the other
+rows only when none of those is a match.
+The medoid of each identity in the Identity table is kept as well, so a bio
+search only needs to align one image of each individual (see identities.py).
+Every change to FishData also adds one to the change counter in the 
+GalleryStamp table, so a process whose gallery was not changed by the 
+signals (another web server process, or a management command which saves 
+with update()) sees the counter has moved and loads the gallery again.
+"""
+
+#import python libraries
+import bisect
+import copy
+import json
+import threading
+import numpy
+
+# import shared modules
+from . import features
+from . import galleryfile
+
+
+# fields copied from each FishData row into the gallery info list
+INFO_FIELDS = ['imageId', 'name', 'population', 'tank', 'date',
+               'pitTag', 'report', 'baseTag']
+
+# number of top voted rows passed on to align_patterns/compare_patterns
+HASH_CANDIDATES = 50
+
+# number of nearest rows by embedding passed on to align_patterns
+EMBEDDING_CANDIDATES = 50
+
+# number of further rows by embedding aligned when the shortlist has no
+# match (see GalleryArrays.candidates), so a new fish is aligned with a 
+# bounded number of rows instead of the whole gallery
+FALLBACK_CANDIDATES = 200
+
+# limits of the prefilter cascade (see GalleryArrays.cascade), measured with
+# the benchmark_cascade command on json/snapper-spot-data.json: each limit is
+# a margin past the loosest of the 705 tagged pairs which fish_ransac aligns
+# with more than MATCH_QUALITY spots (count ratio 2.21, average spacing 0.38,
+# closest spacing 0.49, nose/tail ratio 0.04, grid overlap 0.06), so no true
+# match is removed and 5.8% of random pairs of different fish are. The
+# earlier limits (1.75, 0.2, 0.8, 0.1, 0.45) removed 52 of the true matches
+CASCADE_COUNT_RATIO = 2.5
+CASCADE_SPACING_AVERAGE = 0.45
+CASCADE_SPACING_CLOSEST = 0.6
+CASCADE_NOSE_TAIL_RATIO = 0.06
+CASCADE_GRID_OVERLAP = 0.05
+
+# number of changes kept before the worker processes are sent the whole
+# gallery again (see Gallery.change)
+GALLERY_CHANGES = 50
+
+# FishData statistics used by the first stage of the cascade
+STAT_FIELDS = ['spotCount', 'spacingAverage', 'spacingClosest', 'noseTailRatio']
+
+# arrays of a snapshot stored in a snapshot file (see GalleryArrays.write)
+SNAPSHOT_ARRAYS = ['spots', 'spots_standard', 'offsets', 'standard', 
+                   'ref_nose', 'ref_tail', 'ref_head', 'hash_keys', 
+                   'hash_rows', 'hash_counts', 'stats', 'grid', 'embedding',
+                   'representative']
+
+
+def decode_points(value):
+
+    """
+    DESCRIPTION
+    This function decodes a JSON encoded list of xy coordinates (as stored in
+    the FishData spots field) into an int32 numpy array.
+
+    INPUT
+    value = JSON text of a list of xy coordinates
+
+    OUTPUT
+    points = a numpy array of shape (n, 2)
+    """
+
+    #empty fields are treated as an empty pattern
+    if not value:
+        return numpy.zeros((0, 2), numpy.int32)
+    points = numpy.array(json.loads(value), numpy.int32)
+    #reshape so an empty list still has two columns
+    return points.reshape(-1, 2)
+
+
+def decode_point(value):
+
+    """
+    DESCRIPTION
+    This function decodes a JSON encoded xy coordinate (as stored in the
+    FishData ref fields). Missing reference points are returned as nan.
+
+    INPUT
+    value = JSON text of an xy coordinate
+
+    OUTPUT
+    point = a list of two floats
+    """
+
+    if not value:
+        return [numpy.nan, numpy.nan]
+    point = json.loads(value)
+    if point is None:
+        return [numpy.nan, numpy.nan]
+    return [float(point[0]), float(point[1])]
+
+
+def decode_stats(data_individual):
+
+    """
+    DESCRIPTION
+    This function reads the prefilter statistics of a FishData row (see
+    features.pattern_stats). Missing values are returned as nan and a 
+    missing grid signature as an empty grid.
+
+    INPUT
+    data_individual = a FishData object or a dictionary of the same fields
+
+    OUTPUT
+    stats = a list of the STAT_FIELDS values
+    grid = the grid signature as a uint8 numpy array
+    """
+
+    if not isinstance(data_individual, dict):
+        data_individual = {x: getattr(data_individual, x) for x in 
+                           STAT_FIELDS + ['gridSignature']}
+    stats = [numpy.nan if data_individual[x] is None else float(data_individual[x])
+             for x in STAT_FIELDS]
+    size = features.GRID_SIZE[0] * features.GRID_SIZE[1] // 8
+    if data_individual['gridSignature']:
+        grid = numpy.frombuffer(bytes.fromhex(data_individual['gridSignature']), 
+                                numpy.uint8)
+    else:
+        grid = numpy.zeros(size, numpy.uint8)
+    return stats, grid
+
+
+def query_stats(new_individual):
+
+    """
+    DESCRIPTION
+    This function calculates the prefilter statistics of a new individual 
+    (see features.pattern_stats), once for a search so they can be passed to 
+    each GalleryArrays.candidates call.
+
+    INPUT
+    new_individual = the individual to match (spots + ref points, and 
+                     spots_standard when known)
+
+    OUTPUT
+    stats = a list of the STAT_FIELDS values
+    grid = the grid signature as a uint8 numpy array
+    """
+
+    return decode_stats(features.pattern_stats(
+        new_individual['spots'], new_individual.get('spots_standard'), 
+        new_individual.get('ref_nose'), new_individual.get('ref_head'), 
+        new_individual.get('ref_tail')))
+
+
+def pack_points(patterns):
+
+    """
+    DESCRIPTION
+    This function concatenates a list of spot patterns into one array.
+
+    INPUT
+    patterns = a list of (n, 2) numpy arrays
+
+    OUTPUT
+    points = an (S, 2) int32 numpy array
+    """
+
+    if len(patterns) == 0:
+        return numpy.zeros((0, 2), numpy.int32)
+    return numpy.concatenate(patterns).astype(numpy.int32)
+
+
+# FishData fields kept for each row of the gallery
+ROW_FIELDS = INFO_FIELDS + ['spots', 'spotsStandard', 'refNose', 'refTail', 
+                            'refHead', 'gridSignature', 'hashKeys'] + STAT_FIELDS
+
+
+def row_fields(data_individual):
+
+    """
+    DESCRIPTION
+    This function copies the ROW_FIELDS of a FishData object into a plain
+    dictionary, which can be sent to another process.
+
+    INPUT
+    data_individual = a FishData object
+
+    OUTPUT
+    fields = a dictionary of the ROW_FIELDS values
+    """
+
+    return {x: getattr(data_individual, x) for x in ROW_FIELDS}
+
+
+def decode_row(fields):
+
+    """
+    DESCRIPTION
+    This function decodes the fields of a FishData row into the values 
+    kept by the gallery, so the JSON is only decoded once for each row. The
+    hash keys stored with the row are used, they are only generated again 
+    for a row saved before the hashKeys field or with another HASH_VERSION.
+
+    INPUT
+    fields = a dictionary of the ROW_FIELDS values (see row_fields)
+
+    OUTPUT
+    item = a dictionary with the pattern, pattern_standard, refs, info, 
+           keys, stats, grid and embedding of the row
+    """
+
+    pattern_standard = decode_points(fields['spotsStandard'])
+    stats, grid = decode_stats(fields)
+    keys = features.decode_hash_keys(fields['hashKeys'])
+    if keys is None:
+        keys = features.hash_keys(pattern_standard)
+    return {'pattern': decode_points(fields['spots']),
+            'pattern_standard': pattern_standard,
+            'refs': [decode_point(fields['refNose']),
+                     decode_point(fields['refTail']),
+                     decode_point(fields['refHead'])],
+            'info': {x: fields[x] for x in INFO_FIELDS},
+            'keys': keys,
+            'stats': stats,
+            'grid': grid,
+            'embedding': features.pattern_embedding(pattern_standard)}
+
+
+def set_row(array, row, value):
+
+    """
+    DESCRIPTION
+    This function returns a copy of an array with one row replaced, or with
+    the row added at the end when row is the length of the array. The 
+    array passed in is not changed, as older snapshots still use it.
+
+    INPUT
+    array = a numpy array
+    row = the row number
+    value = the new value of the row
+
+    OUTPUT
+    array = the new numpy array
+    """
+
+    if row == len(array):
+        return numpy.concatenate([array, numpy.asarray(value, array.dtype)[None]])
+    array = array.copy()
+    array[row] = value
+    return array
+
+
+class GalleryArrays(object):
+
+    """
+    DESCRIPTION
+    An immutable snapshot of the gallery packed into numpy arrays. Each 
+    change to the gallery makes a new snapshot from the old one with only
+    the changed row decoded (see replaced), so a search can keep using the
+    snapshot it started with while rows are being saved.
+
+    spots = all spot patterns concatenated into one (S, 2) int32 array
+    offsets = start position of each row in spots (length N + 1)
+    spots_standard = the spot patterns in standard space (same offsets)
+    standard = boolean array, True if the row has standard space spots
+    ref_nose, ref_tail, ref_head = (N, 2) float arrays (nan when missing)
+    info = a list of dictionaries with the INFO_FIELDS for each row
+    order = row numbers sorted by date (newest first)
+    index = a dictionary of imageId to row number
+    hash_keys, hash_rows = the geometric hash keys of every standard row and
+                           the row each belongs to, sorted by key
+    hash_counts = the number of hash keys of each row
+    unhashed = rows without standard space spots, sorted by date
+    stats = an (N, 4) float array of the STAT_FIELDS (nan when missing)
+    grid = an (N, 128) boolean array of the occupancy grid signatures
+    embedding = an (N, D) contiguous float32 array of the pattern embeddings
+                (all zero for rows without standard space spots)
+    identities = a dictionary of baseTag to the medoid imageId
+    representative = boolean array, True if the row is the medoid of its 
+                     identity or has no identity
+    sightings = a dictionary of baseTag to the rows with that baseTag
+    names = a dictionary of name to the rows with that name
+    version = (load number, number of changes) of the Gallery the snapshot
+              came from, or None (see Gallery.changes_between)
+    """
+
+    def __init__(self, patterns, patterns_standard, refs, info, keys, stats, 
+                 grids, embeddings, identities):
+        #pack the spot patterns into one array with offsets
+        counts = [len(x) for x in patterns]
+        self.offsets = numpy.zeros(len(patterns) + 1, numpy.int64)
+        self.offsets[1:] = numpy.cumsum(counts)
+        self.spots = pack_points(patterns)
+        #rows without standard space spots are padded to keep the offsets
+        self.standard = numpy.array([len(x) == len(y) for x, y in 
+                                     zip(patterns_standard, patterns)], bool)
+        self.spots_standard = pack_points([
+            x if ok else numpy.zeros(y.shape, numpy.int32)
+            for x, y, ok in zip(patterns_standard, patterns, self.standard)])
+        #pack the reference points
+        refs = numpy.array(refs, numpy.float64).reshape(-1, 3, 2)
+        self.ref_nose = refs[:, 0]
+        self.ref_tail = refs[:, 1]
+        self.ref_head = refs[:, 2]
+        self.info = info
+        #sort newest first, keeping insertion order for equal dates
+        self.order = sorted(range(len(info)), key=lambda x: info[x]['date'],
+                            reverse=True)
+        self.index = {x['imageId']: row for row, x in enumerate(info)}
+        #pack the hash keys into one array sorted by key
+        keys = [x if ok else x[:0] for x, ok in zip(keys, self.standard)]
+        self.hash_counts = numpy.array([len(x) for x in keys], numpy.int64)
+        rows = numpy.repeat(numpy.arange(len(keys), dtype=numpy.int32),
+                            self.hash_counts)
+        if len(keys) > 0:
+            keys = numpy.concatenate(keys)
+        else:
+            keys = numpy.zeros(0, numpy.int64)
+        sort = numpy.argsort(keys, kind='stable')
+        self.hash_keys = keys[sort]
+        self.hash_rows = rows[sort]
+        self.unhashed = [x for x in self.order if not self.standard[x]]
+        #pack the prefilter statistics
+        self.stats = numpy.array(stats, numpy.float64).reshape(-1, len(STAT_FIELDS))
+        size = features.GRID_SIZE[0] * features.GRID_SIZE[1]
+        if len(grids) > 0:
+            self.grid = numpy.unpackbits(numpy.array(grids), axis=1).astype(bool)
+        else:
+            self.grid = numpy.zeros((0, size), bool)
+        #pack the embeddings into one matrix
+        size = features.EMBEDDING_SIZE[0] * features.EMBEDDING_SIZE[1]
+        self.embedding = numpy.zeros((len(embeddings), size), numpy.float32)
+        for row, (embedding, ok) in enumerate(zip(embeddings, self.standard)):
+            if ok:
+                self.embedding[row] = embedding
+        self.group_rows()
+        self.identities = dict(identities)
+        self.representative = numpy.zeros(len(info), bool)
+        self.represent(range(len(info)))
+        #the place of the snapshot in the changes of the gallery
+        self.version = None
+
+    def __len__(self):
+        return len(self.info)
+
+    def group_rows(self):
+        #group the rows by identity and by name
+        self.sightings = {}
+        self.names = {}
+        for row, x in enumerate(self.info):
+            if x['baseTag']:
+                self.sightings.setdefault(str(x['baseTag']), []).append(row)
+            self.names.setdefault(x['name'], []).append(row)
+
+    def represent(self, rows):
+        #rows without an identity or with a missing medoid are kept
+        for row in rows:
+            x = self.info[row]
+            medoid = self.identities.get(str(x['baseTag']))
+            self.representative[row] = (medoid is None or medoid == x['imageId']
+                                        or medoid not in self.index)
+
+    def position(self, order, row):
+        #where a row goes in a list sorted by date (newest first), keeping
+        #the lower row first for equal dates
+        date = self.info[row]['date']
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            other = self.info[order[middle]]['date']
+            if other > date or (other == date and order[middle] < row):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def replaced(self, row, item):
+
+        """
+        DESCRIPTION
+        This function returns a new snapshot with one row replaced, or with
+        a row added when row is None. Only the values of that row are 
+        decoded, the arrays of the other rows are copied as they are. This
+        snapshot is not changed, so a search using it is not affected.
+
+        INPUT
+        row = the row number to replace, or None to add a row
+        item = the decoded row (see decode_row)
+
+        OUTPUT
+        packed = the new GalleryArrays object
+        """
+
+        new = copy.copy(self)
+        if row is None:
+            row = len(self.info)
+            old = None
+        else:
+            old = self.info[row]
+        info = item['info']
+        pattern = numpy.asarray(item['pattern'], numpy.int32).reshape(-1, 2)
+        standard = len(item['pattern_standard']) == len(pattern)
+        if standard:
+            pattern_standard = numpy.asarray(item['pattern_standard'], numpy.int32)
+        else:
+            pattern_standard = numpy.zeros(pattern.shape, numpy.int32)
+        #splice the spots of the row into the packed spots
+        start = self.offsets[row]
+        end = self.offsets[row + 1] if old is not None else start
+        new.spots = numpy.concatenate([self.spots[:start], pattern, 
+                                       self.spots[end:]])
+        new.spots_standard = numpy.concatenate([self.spots_standard[:start], 
+                                                pattern_standard, 
+                                                self.spots_standard[end:]])
+        new.offsets = numpy.concatenate([self.offsets[:row + 1], 
+                                         self.offsets[row + 1 if old is not None 
+                                                      else row:] + 
+                                         len(pattern) - (end - start)])
+        #the values of the row
+        new.standard = set_row(self.standard, row, standard)
+        new.ref_nose = set_row(self.ref_nose, row, item['refs'][0])
+        new.ref_tail = set_row(self.ref_tail, row, item['refs'][1])
+        new.ref_head = set_row(self.ref_head, row, item['refs'][2])
+        new.stats = set_row(self.stats, row, item['stats'])
+        new.grid = set_row(self.grid, row, numpy.unpackbits(
+            numpy.asarray(item['grid'], numpy.uint8)).astype(bool))
+        new.embedding = set_row(self.embedding, row, item['embedding'] if standard
+                                else numpy.zeros(self.embedding.shape[1]))
+        new.info = list(self.info)
+        if old is None:
+            new.info.append(info)
+            new.index = dict(self.index)
+            new.index[info['imageId']] = row
+        else:
+            new.info[row] = info
+        #move the row to its place in the date order
+        new.order = [x for x in self.order if x != row]
+        new.order.insert(new.position(new.order, row), row)
+        new.unhashed = [x for x in self.unhashed if x != row]
+        if not standard:
+            new.unhashed.insert(new.position(new.unhashed, row), row)
+        #swap the hash keys of the row, keeping the keys sorted
+        keys = item['keys'] if standard else item['keys'][:0]
+        keep = self.hash_rows != row
+        hash_keys = self.hash_keys[keep]
+        hash_rows = self.hash_rows[keep]
+        insert = numpy.searchsorted(hash_keys, keys, 'right')
+        new.hash_keys = numpy.insert(hash_keys, insert, keys)
+        new.hash_rows = numpy.insert(hash_rows, insert, 
+                                     numpy.full(len(keys), row, numpy.int32))
+        new.hash_counts = set_row(self.hash_counts, row, len(keys))
+        #move the row between the identity and name groups
+        new.sightings = dict(self.sightings)
+        new.names = dict(self.names)
+        groups = [(new.sightings, lambda x: str(x['baseTag']) if x['baseTag'] else None),
+                  (new.names, lambda x: x['name'])]
+        for group_rows, group_key in groups:
+            if old is not None and group_key(old) is not None:
+                group = [x for x in group_rows[group_key(old)] if x != row]
+                if group:
+                    group_rows[group_key(old)] = group
+                else:
+                    del group_rows[group_key(old)]
+            if group_key(info) is not None:
+                group = list(group_rows.get(group_key(info), []))
+                bisect.insort(group, row)
+                group_rows[group_key(info)] = group
+        #the rows of the identities the row left and joined
+        new.representative = set_row(self.representative, row, True)
+        rows = [row]
+        for x in [old, info]:
+            if x is not None and x['baseTag']:
+                rows += new.sightings.get(str(x['baseTag']), [])
+        new.represent(rows)
+        return new
+
+    def removed(self, row):
+
+        """
+        DESCRIPTION
+        This function returns a new snapshot without one row. The rows 
+        after it move up by one. This snapshot is not changed.
+
+        INPUT
+        row = the row number to remove
+
+        OUTPUT
+        packed = the new GalleryArrays object
+        """
+
+        new = copy.copy(self)
+        old = self.info[row]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        new.spots = numpy.concatenate([self.spots[:start], self.spots[end:]])
+        new.spots_standard = numpy.concatenate([self.spots_standard[:start],
+                                                self.spots_standard[end:]])
+        new.offsets = numpy.concatenate([self.offsets[:row + 1],
+                                         self.offsets[row + 2:] - (end - start)])
+        for name in ['standard', 'ref_nose', 'ref_tail', 'ref_head', 'stats',
+                     'grid', 'embedding', 'hash_counts', 'representative']:
+            setattr(new, name, numpy.delete(getattr(self, name), row, axis=0))
+        new.info = self.info[:row] + self.info[row + 1:]
+        new.index = {x['imageId']: key for key, x in enumerate(new.info)}
+        new.order = [x - (x > row) for x in self.order if x != row]
+        new.unhashed = [x - (x > row) for x in self.unhashed if x != row]
+        keep = self.hash_rows != row
+        new.hash_keys = self.hash_keys[keep]
+        new.hash_rows = self.hash_rows[keep]
+        new.hash_rows = new.hash_rows - (new.hash_rows > row).astype(numpy.int32)
+        new.group_rows()
+        if old['baseTag']:
+            new.represent(new.sightings.get(str(old['baseTag']), []))
+        return new
+
+    def with_identities(self, identities, baseTags=None):
+
+        """
+        DESCRIPTION
+        This function returns a new snapshot with the representative rows
+        of some identities worked out again after their medoid changed. 
+        This snapshot is not changed.
+
+        INPUT
+        identities = a dictionary of baseTag to the medoid imageId
+        baseTags = the baseTags of the identities changed, or None for all
+
+        OUTPUT
+        packed = the new GalleryArrays object
+        """
+
+        new = copy.copy(self)
+        new.identities = identities
+        new.representative = self.representative.copy()
+        if baseTags is None:
+            rows = range(len(self.info))
+        else:
+            rows = [x for baseTag in baseTags 
+                    for x in self.sightings.get(str(baseTag), [])]
+        new.represent(rows)
+        return new
+
+    def pattern(self, row):
+
+        """
+        DESCRIPTION
+        This function returns the spot pattern for a row of the gallery.
+
+        INPUT
+        row = the row number
+
+        OUTPUT
+        pattern = an (n, 2) int32 numpy array (view into spots)
+        """
+
+        return self.spots[self.offsets[row]:self.offsets[row + 1]]
+
+    def pattern_standard(self, row):
+
+        """
+        DESCRIPTION
+        This function returns the standard space spot pattern for a row of
+        the gallery (see fish_fun.standardize_pattern).
+
+        INPUT
+        row = the row number
+
+        OUTPUT
+        pattern = an (n, 2) int32 numpy array (view into spots_standard)
+        """
+
+        return self.spots_standard[self.offsets[row]:self.offsets[row + 1]]
+
+    def vote(self, pattern, number, subset=None):
+
+        """
+        DESCRIPTION
+        This function looks up the geometric hash keys of a standard space 
+        pattern and returns the rows with the largest share of their keys 
+        matched, so rows with many spots (and so many keys) are not favoured.
+        Only the keys found in the gallery are visited, so the time taken 
+        grows with the number of hash collisions and not with the size of 
+        the gallery.
+
+        INPUT
+        pattern = a list of xy coordinates in standard space
+        number = the maximum number of rows to return
+        subset = a boolean array of the rows which may be returned, or None
+                 for every row
+
+        OUTPUT
+        rows = a list of row numbers, most votes first
+        votes = a list of the share of the keys of each row matched
+        """
+
+        keys = features.hash_keys(pattern, expand=True)
+        #find the range of the gallery keys matching each query key
+        start = numpy.searchsorted(self.hash_keys, keys, 'left')
+        end = numpy.searchsorted(self.hash_keys, keys, 'right')
+        counts = end - start
+        if counts.sum() == 0:
+            return [], []
+        #list the position of every collision
+        first = numpy.cumsum(counts) - counts
+        position = (numpy.repeat(start - first, counts) + 
+                    numpy.arange(counts.sum()))
+        #count the votes for each row
+        rows, votes = numpy.unique(self.hash_rows[position], return_counts=True)
+        votes = votes / self.hash_counts[rows].astype(numpy.float64)
+        if subset is not None:
+            keep = subset[rows]
+            rows, votes = rows[keep], votes[keep]
+        #most votes first, the lowest row number first for equal votes
+        best = numpy.argsort(-votes, kind='stable')[:number]
+        return rows[best].tolist(), votes[best].tolist()
+
+    def nearest(self, embedding, number, subset=None):
+
+        """
+        DESCRIPTION
+        This function finds the rows with the embedding closest to a query
+        embedding (see features.pattern_embedding) using a single matrix 
+        vector product.
+
+        INPUT
+        embedding = the embedding of the query pattern
+        number = the maximum number of rows to return
+        subset = a boolean array of the rows which may be returned, or None
+                 for every row
+
+        OUTPUT
+        rows = a list of row numbers, closest first and lowest row first for
+               equal scores (as batch.blocked_nearest)
+        scores = a list of the correlation of each row with the query
+        """
+
+        if subset is None:
+            rows = numpy.arange(len(self.embedding))
+        else:
+            rows = numpy.flatnonzero(subset)
+        if len(rows) == 0:
+            return [], []
+        if subset is None:
+            scores = numpy.dot(self.embedding, 
+                               numpy.asarray(embedding, numpy.float32))
+        else:
+            scores = numpy.dot(self.embedding[rows], 
+                               numpy.asarray(embedding, numpy.float32))
+        #select the top rows without sorting the whole gallery, the rows
+        #above the last score kept and the lowest rows equal to it
+        number = min(number, len(scores))
+        limit = -numpy.partition(-scores, number - 1)[number - 1]
+        top = numpy.flatnonzero(scores > limit)
+        top = numpy.concatenate([top, numpy.flatnonzero(scores == limit)[:number - len(top)]])
+        top = top[numpy.argsort(-scores[top], kind='stable')]
+        return rows[top].tolist(), scores[top].tolist()
+
+    def representatives(self, name):
+
+        """
+        DESCRIPTION
+        This function returns the rows to search for a new individual, one 
+        for each identity. When the medoid of an identity has the same name
+        as the new individual (and so is skipped by candidates) the other
+        sightings of that identity are searched instead.
+
+        INPUT
+        name = the name of the new individual
+
+        OUTPUT
+        subset = a boolean array of the rows to search
+        """
+
+        subset = self.representative
+        for row in self.names.get(name, []):
+            if subset[row] and self.info[row]['baseTag']:
+                if subset is self.representative:
+                    subset = subset.copy()
+                subset[self.sightings[str(self.info[row]['baseTag'])]] = True
+        return subset
+
+    def stat_differences(self, stats, rows):
+
+        """
+        DESCRIPTION
+        This function measures how far the STAT_FIELDS values of some rows 
+        are from those of a new individual, as compared with the limits of
+        the first stage of the cascade. A value which is missing for either 
+        pattern gives nan.
+
+        INPUT
+        stats = the STAT_FIELDS values of the new individual
+        rows = an int array of row numbers
+
+        OUTPUT
+        differences = an (n, 4) float array of the spot count ratio, the 
+                      relative difference of the average and closest 
+                      spacing, and the difference of the nose/tail ratio
+        """
+
+        query = numpy.array(stats, numpy.float64)
+        values = self.stats[rows]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            #relative difference to the new individual
+            count = (numpy.maximum(values[:, 0], query[0]) / 
+                     numpy.minimum(values[:, 0], query[0]))
+            average = numpy.abs(values[:, 1] - query[1]) / query[1]
+            closest = numpy.abs(values[:, 2] - query[2]) / query[2]
+            ratio = numpy.abs(values[:, 3] - query[3])
+        return numpy.stack([count, average, closest, ratio], axis=1)
+
+    def grid_overlap(self, grid, rows):
+
+        """
+        DESCRIPTION
+        This function measures the overlap of the grid signatures of some 
+        rows with that of a new individual, as the shared cells over the 
+        cells of the smaller grid (nan when either grid is empty).
+
+        INPUT
+        grid = the grid signature of the new individual (uint8 array)
+        rows = an int array of row numbers
+
+        OUTPUT
+        overlap = a float array with the overlap of each row
+        """
+
+        query_grid = numpy.unpackbits(numpy.asarray(grid, numpy.uint8)).astype(bool)
+        cells = self.grid[rows]
+        shared = (cells & query_grid).sum(axis=1)
+        smaller = numpy.minimum(cells.sum(axis=1), query_grid.sum())
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return shared / smaller.astype(numpy.float64)
+
+    def cascade(self, stats, grid, rows):
+
+        """
+        DESCRIPTION
+        This function removes the rows which can not be a match before they
+        are aligned, using two cheap stages. The first stage compares the 
+        spot count, spacing and nose/tail statistics stored for each row. The
+        second stage compares the occupancy grid signatures in standard 
+        space, measured as the shared cells over the cells of the smaller 
+        grid. A value which is missing for either pattern passes the test.
+
+        INPUT
+        stats = the STAT_FIELDS values of the new individual
+        grid = the grid signature of the new individual (uint8 array)
+        rows = a list of row numbers
+
+        OUTPUT
+        rows = the rows passing both stages, in the same order
+        removed = a dictionary with the number of rows removed by each stage
+        """
+
+        rows = numpy.array(rows, numpy.int64)
+        differences = self.stat_differences(stats, rows)
+        limits = [CASCADE_COUNT_RATIO, CASCADE_SPACING_AVERAGE, 
+                  CASCADE_SPACING_CLOSEST, CASCADE_NOSE_TAIL_RATIO]
+        #nan comparisons are False so missing values pass
+        with numpy.errstate(invalid='ignore'):
+            fail = (differences > limits).any(axis=1)
+        keep_stats = rows[~fail]
+        #compare the grid signatures of the remaining rows
+        with numpy.errstate(invalid='ignore'):
+            fail = self.grid_overlap(grid, keep_stats) < CASCADE_GRID_OVERLAP
+        keep_grid = keep_stats[~fail]
+        removed = {'stats': len(rows) - len(keep_stats), 
+                   'grid': len(keep_stats) - len(keep_grid)}
+        return keep_grid.tolist(), removed
+
+    def candidates(self, new_individual, standard, excluded, nearest=None,
+                   subset=None, fallback=False, stats=None):
+
+        """
+        DESCRIPTION
+        This function selects the rows to align for a new individual. For 
+        the standard space methods these are the rows voted for by the 
+        geometric hash and the rows with the nearest embedding, followed by 
+        any rows without standard space spots. When none of these rows is a
+        match the search is run again with fallback set, which returns the
+        next FALLBACK_CANDIDATES rows by embedding, nearest first. Otherwise
+        every row is used,
+        with rows with a similar number of spots first. The rows are then 
+        passed through the prefilter cascade.
+
+        INPUT
+        new_individual = the individual to match (spots + ref points, and 
+                         spots_standard for the standard space methods)
+        standard = True when a standard space method is used
+        excluded = a set of imageIds to skip, rows with the same name as the 
+                   new individual are always skipped
+        nearest = the rows nearest by embedding if they are already known
+        subset = a boolean array of the rows to search, or None for every row
+        fallback = True to return the nearest rows by embedding which were 
+                   not in the shortlist, at most FALLBACK_CANDIDATES of them
+                   (always empty when standard is False)
+        stats = the prefilter statistics of the new individual from 
+                query_stats, or None to calculate them here
+
+        OUTPUT
+        rows = a list of row numbers, most promising first
+        removed = a dictionary with the number of candidates and the number
+                  removed by each stage of the cascade
+        """
+
+        spots_standard = new_individual.get('spots_standard')
+        if standard:
+            voted, votes = self.vote(spots_standard, HASH_CANDIDATES, subset)
+            unhashed = self.unhashed
+            if subset is not None:
+                unhashed = [x for x in unhashed if subset[x]]
+            if nearest is None or fallback:
+                #enough rows for the shortlist and the fallback after it
+                number = EMBEDDING_CANDIDATES
+                if fallback:
+                    number += len(voted) + len(unhashed) + FALLBACK_CANDIDATES
+                nearest, scores = self.nearest(
+                    features.pattern_embedding(spots_standard), number, subset)
+            shortlist = set(voted)
+            rows = (voted + [x for x in nearest[:EMBEDDING_CANDIDATES] 
+                             if x not in shortlist] + unhashed)
+            if fallback:
+                shortlist = set(rows)
+                rows = [x for x in nearest if x not in shortlist][:FALLBACK_CANDIDATES]
+        elif fallback:
+            rows = []
+        else:
+            counts = numpy.diff(self.offsets)
+            order = self.order
+            if subset is not None:
+                order = [x for x in order if subset[x]]
+            rows = sorted(order, key=lambda x: abs(counts[x] - 
+                          len(new_individual['spots'])))
+        #skip the new individual and the excluded images
+        rows = [x for x in rows if self.info[x]['name'] != new_individual['name']
+                and self.info[x]['imageId'] not in excluded]
+        #the prefilter statistics of the new individual
+        if stats is None:
+            stats = query_stats(new_individual)
+        candidates = len(rows)
+        rows, removed = self.cascade(stats[0], stats[1], rows)
+        removed['candidates'] = candidates
+        return rows, removed
+
+    def individual(self, row):
+
+        """
+        DESCRIPTION
+        This function returns a row of the gallery in the individual format
+        used by fish_fun.align_patterns (spots + ref points).
+
+        INPUT
+        row = the row number
+
+        OUTPUT
+        individual = a dictionary with spots, ref_nose, ref_tail and ref_head
+        """
+
+        individual = {'spots': self.pattern(row)}
+        for key, refs in [('ref_nose', self.ref_nose),
+                          ('ref_tail', self.ref_tail),
+                          ('ref_head', self.ref_head)]:
+            if numpy.isnan(refs[row]).any():
+                individual[key] = None
+            else:
+                individual[key] = refs[row].tolist()
+        return individual
+
+    def write(self, path):
+
+        """
+        DESCRIPTION
+        This function writes the snapshot to a file in the layout of the 
+        gallery export file (see galleryfile.write_arrays), with the info,
+        order and identities stored as JSON in one more array. The file is
+        opened again with read_snapshot.
+
+        INPUT
+        path = the snapshot file
+        """
+
+        arrays = {x: getattr(self, x) for x in SNAPSHOT_ARRAYS}
+        meta = {'info': self.info, 'order': self.order, 
+                'unhashed': self.unhashed, 'identities': self.identities,
+                'version': self.version}
+        arrays['meta'] = numpy.frombuffer(json.dumps(meta).encode('utf-8'), 
+                                          numpy.uint8)
+        galleryfile.write_arrays(path, arrays, galleryfile.SNAPSHOT_MAGIC)
+
+
+def read_snapshot(path):
+
+    """
+    DESCRIPTION
+    This function opens a snapshot file written by GalleryArrays.write with
+    a read-only mmap. The arrays of the snapshot are views into the mapped
+    file, so processes opening the same file share one copy of it. Changes
+    applied to the snapshot make new arrays (see apply_change).
+
+    INPUT
+    path = the snapshot file
+
+    OUTPUT
+    packed = a GalleryArrays object
+    """
+
+    arrays = galleryfile.read_arrays(path, galleryfile.SNAPSHOT_MAGIC)
+    meta = json.loads(bytes(arrays.pop('meta')).decode('utf-8'))
+    packed = GalleryArrays.__new__(GalleryArrays)
+    for name in SNAPSHOT_ARRAYS:
+        setattr(packed, name, arrays[name])
+    packed.info = meta['info']
+    packed.order = meta['order']
+    packed.unhashed = meta['unhashed']
+    packed.identities = meta['identities']
+    packed.version = None if meta['version'] is None else tuple(meta['version'])
+    packed.index = {x['imageId']: row for row, x in enumerate(packed.info)}
+    packed.group_rows()
+    return packed
+
+
+def pack_items(items, identities):
+
+    """
+    DESCRIPTION
+    This function packs a list of decoded rows into a snapshot.
+
+    INPUT
+    items = a list of decoded rows, newest first (see decode_row)
+    identities = a dictionary of baseTag to the medoid imageId
+
+    OUTPUT
+    packed = a GalleryArrays object
+    """
+
+    return GalleryArrays([x['pattern'] for x in items],
+                         [x['pattern_standard'] for x in items],
+                         [x['refs'] for x in items],
+                         [x['info'] for x in items],
+                         [x['keys'] for x in items],
+                         [x['stats'] for x in items],
+                         [x['grid'] for x in items],
+                         [x['embedding'] for x in items],
+                         identities)
+
+
+def apply_change(packed, change):
+
+    """
+    DESCRIPTION
+    This function applies one change of the gallery to a snapshot. The 
+    same changes are applied by the Gallery and by the worker processes 
+    (see parallel.py), so both number the rows in the same way.
+
+    INPUT
+    packed = a GalleryArrays object
+    change = a tuple of ('row', fields) for a saved row (see row_fields),
+             ('remove', imageId) for a deleted row, ('identity', baseTag, 
+             medoidImageId) for a changed identity or ('identities', 
+             dictionary of baseTag to medoidImageId) for all identities
+
+    OUTPUT
+    packed = the new GalleryArrays object
+    """
+
+    if change[0] == 'row':
+        row = packed.index.get(change[1]['imageId'])
+        return packed.replaced(row, decode_row(change[1]))
+    if change[0] == 'remove':
+        return packed.removed(packed.index[change[1]])
+    if change[0] == 'identity':
+        identities = dict(packed.identities)
+        if change[2] is None:
+            identities.pop(change[1], None)
+        else:
+            identities[change[1]] = change[2]
+        return packed.with_identities(identities, [change[1]])
+    return packed.with_identities(dict(change[1]))
+
+
+class Gallery(object):
+
+    """
+    DESCRIPTION
+    A process-wide copy of the FishData table. Rows are loaded once from the
+    database and then updated one row at a time through update() and 
+    remove(), which are called from the FishData signals. Each change 
+    builds a new packed snapshot from the old one (see apply_change), which
+    the matching functions read through arrays(). The changes since the 
+    last load are kept, so the worker processes of parallel.py can apply 
+    them to their own copy instead of being sent the whole gallery again.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.packed = None
+        #number of loads, and the changes since the last load
+        self.epoch = 0
+        self.changes = []
+        #the change counter when the snapshot was last up to date
+        self.stamp = None
+
+    def load(self):
+
+        """
+        DESCRIPTION
+        This function (re)loads every FishData row from the database.
+        """
+
+        # import model here so the worker processes can unpickle a snapshot
+        # before django is set up
+        from identify.models import FishData, Identity
+
+        with self.lock:
+            #changes saved while loading move the stamp, so they load again
+            self.stamp = stamp_changes()
+            items = [decode_row(row_fields(x)) 
+                     for x in FishData.objects.filter(inGallery=True)
+                                                  .order_by('-date')]
+            identities = dict(Identity.objects.values_list('baseTag', 
+                                                           'medoidImageId'))
+            self.packed = pack_items(items, identities)
+            self.epoch += 1
+            self.changes = []
+            self.packed.version = (self.epoch, 0)
+            self.loaded = True
+
+    def change(self, change):
+        #apply a change to the snapshot and keep it for the workers
+        with self.lock:
+            self.packed = apply_change(self.packed, change)
+            self.changes.append(change)
+            #start again from the current snapshot when the list gets long
+            if len(self.changes) > GALLERY_CHANGES:
+                self.epoch += 1
+                self.changes = []
+            self.packed.version = (self.epoch, len(self.changes))
+
+    def changes_between(self, start, end):
+
+        """
+        DESCRIPTION
+        This function returns the changes which turn one snapshot of the 
+        gallery into a later one.
+
+        INPUT
+        start = the version of the earlier snapshot
+        end = the version of the later snapshot
+
+        OUTPUT
+        changes = a list of changes (see apply_change), or None if the 
+                  snapshots are not from the same load of this gallery
+        """
+
+        with self.lock:
+            if start is None or end is None or start[0] != end[0] or \
+               end[0] != self.epoch or start[1] > end[1] or \
+               end[1] > len(self.changes):
+                return None
+            return self.changes[start[1]:end[1]]
+
+    def update(self, data_individual):
+
+        """
+        DESCRIPTION
+        This function adds a new FishData row to the gallery or replaces the
+        existing row with the same imageId. A row which is not in the gallery
+        (the spots of an upload which found no match) is removed instead. 
+        Nothing is done if the gallery has not been loaded yet, as it will be
+        read from the database on first use.
+
+        INPUT
+        data_individual = a FishData object
+        """
+
+        with self.lock:
+            if not self.loaded:
+                return
+            if not data_individual.inGallery:
+                self.remove(data_individual.imageId)
+                return
+            self.change(('row', row_fields(data_individual)))
+
+    def remove(self, imageId):
+
+        """
+        DESCRIPTION
+        This function removes a row from the gallery.
+
+        INPUT
+        imageId = the imageId of the deleted FishData row
+        """
+
+        with self.lock:
+            if not self.loaded or imageId not in self.packed.index:
+                return
+            self.change(('remove', imageId))
+
+    def touch(self, applied=False):
+
+        """
+        DESCRIPTION
+        This function adds one to the change counter to tell every other
+        process that FishData has changed. When the change has been applied
+        to this gallery as well and no other process has moved the counter
+        since, the gallery stays loaded, otherwise it is loaded again on 
+        next use.
+
+        INPUT
+        applied = True when the change was applied by update(), remove() or
+                  update_identity(), False for changes saved without the
+                  signals
+        """
+
+        with self.lock:
+            changes = stamp_move()
+            if applied and self.stamp is not None and changes == self.stamp + 1:
+                self.stamp = changes
+            else:
+                self.stamp = None
+
+    def current(self):
+        #True when the gallery is loaded and no other process has changed FishData
+        with self.lock:
+            return self.loaded and self.stamp is not None and \
+                self.stamp == stamp_changes()
+
+    def saved_row(self, data_individual):
+
+        """
+        DESCRIPTION
+        This function compares a FishData object which is about to be saved
+        with its row in the gallery, so the row does not have to be read 
+        from the database again.
+
+        INPUT
+        data_individual = a FishData object
+
+        OUTPUT
+        previous = None if the row is not in the gallery, otherwise a 
+                   dictionary with the old baseTag and scoresChanged, True
+                   if the spots or ref points have changed
+        """
+
+        with self.lock:
+            row = self.packed.index.get(data_individual.imageId)
+            if row is None:
+                return None
+            packed = self.packed
+        refs = numpy.array([decode_point(data_individual.refNose),
+                            decode_point(data_individual.refTail),
+                            decode_point(data_individual.refHead)])
+        old_refs = numpy.array([packed.ref_nose[row], packed.ref_tail[row],
+                                packed.ref_head[row]])
+        #missing ref points are nan in both
+        same_refs = ((refs == old_refs) | (numpy.isnan(refs) & 
+                                           numpy.isnan(old_refs))).all()
+        changed = not same_refs or not numpy.array_equal(
+            decode_points(data_individual.spots), packed.pattern(row))
+        return {'baseTag': packed.info[row]['baseTag'], 'scoresChanged': changed}
+
+    def load_identities(self):
+
+        """
+        DESCRIPTION
+        This function (re)loads the medoid of every identity from the 
+        database.
+        """
+
+        # import model
+        from identify.models import Identity
+
+        with self.lock:
+            if not self.loaded:
+                return
+            self.change(('identities', dict(Identity.objects.values_list(
+                'baseTag', 'medoidImageId'))))
+
+    def update_identity(self, baseTag, medoidImageId):
+
+        """
+        DESCRIPTION
+        This function sets the medoid of an identity, or removes the identity
+        when medoidImageId is None.
+
+        INPUT
+        baseTag = the baseTag of the identity
+        medoidImageId = the imageId of the medoid, or None
+        """
+
+        with self.lock:
+            if not self.loaded:
+                return
+            self.change(('identity', baseTag, medoidImageId))
+
+    def arrays(self):
+
+        """
+        DESCRIPTION
+        This function returns the packed snapshot of the gallery, loading the
+        gallery from the database on first use and whenever FishData has 
+        been changed without updating this gallery (see touch).
+
+        OUTPUT
+        packed = a GalleryArrays object
+        """
+
+        with self.lock:
+            if not self.current():
+                self.load()
+            return self.packed
+
+
+def stamp_changes():
+    #the change counter, 0 before the first change
+
+    # import model
+    from identify.models import GalleryStamp
+
+    return GalleryStamp.objects.filter(pk=1).values_list('changes', 
+                                                         flat=True).first() or 0
+
+
+def stamp_move():
+    #add one to the change counter and return the new value, the update 
+    #locks the row until the end of the transaction so the value read back
+    #is the one written by this process
+
+    # import django and model
+    from django.db import transaction
+    from django.db.models import F
+    from identify.models import GalleryStamp
+
+    with transaction.atomic():
+        if GalleryStamp.objects.filter(pk=1).update(changes=F('changes') + 1) == 0:
+            GalleryStamp.objects.get_or_create(pk=1)
+            GalleryStamp.objects.filter(pk=1).update(changes=F('changes') + 1)
+        return GalleryStamp.objects.get(pk=1).changes
+
+
+# the gallery shared by every request handled by this process
+gallery = Gallery()
+
+
+def get_gallery():
+
+    """
+    DESCRIPTION
+    This function returns the packed snapshot of the process-wide gallery.
+
+    OUTPUT
+    packed = a GalleryArrays object
+    """
+
+    return gallery.arrays()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary export format of the spot data.
+
+The file replaces the nested snapper-spot-data.json dataset for moving spot
+data between databases: the gallery_file command exports the JSON dataset or
+FishData to it and imports it into FishData. The in-memory gallery is built
+from FishData (see gallery.py), and the worker processes of a search open a
+snapshot of it written with the same layout (see GalleryArrays.write), so 
+every worker shares one mapped copy instead of unpickling its own.
+
+The images are stored as columns: the spots of every image in one int16
+array with offsets, the ref points in a float32 array (nan when missing),
+the imageIds, and the population, date, number, name, tags and tank of each
+image as codes into one string table. The file is opened with a single
+read-only mmap, so opening it does not parse anything.
+
+The file starts with MAGIC, the length of a JSON header as a uint64 and the
+header, which lists the dtype, shape and position of each array. The arrays
+follow, each starting on an ALIGNMENT byte boundary.
+"""
+
+#import python libraries
+import json
+import os
+import numpy
+
+
+# start of every gallery file
+MAGIC = b'FISHGAL3'
+
+# imageId stored for an image without one. Uploads use the upload time and
+# imported images get negative imageIds (see the gallery_file command), so 
+# no row has imageId 0
+UNKNOWN_ID = 0
+
+# start of every gallery snapshot file (see GalleryArrays.write)
+SNAPSHOT_MAGIC = b'FISHSNP1'
+
+# byte alignment of each array in the file
+ALIGNMENT = 64
+
+# string columns stored as codes into the string table
+STRING_FIELDS = ['population', 'date', 'number', 'name', 'baseTag', 'pitTag',
+                 'report', 'tank']
+
+
+def write_gallery_file(path, records):
+
+    """
+    DESCRIPTION
+    This function writes a list of images to a gallery file. The old file is
+    replaced in one step, so processes which have it open keep their copy.
+
+    INPUT
+    path = the gallery file
+    records = a list of dictionaries with the imageId (None if unknown),
+              population, date, number, name, baseTag, pitTag, report, 
+              tank, spots, ref_nose, ref_tail and ref_head of each image
+
+    OUTPUT
+    count = the number of images written
+    """
+
+    #pack the spots into one array with offsets
+    patterns = [numpy.asarray(x['spots'], numpy.int64).reshape(-1, 2)
+                for x in records]
+    spots = numpy.concatenate(patterns + [numpy.zeros((0, 2), numpy.int64)])
+    if len(spots) > 0 and (spots.min() < -32768 or spots.max() > 32767):
+        raise ValueError('spot coordinates do not fit in int16')
+    offsets = numpy.zeros(len(records) + 1, numpy.int64)
+    offsets[1:] = numpy.cumsum([len(x) for x in patterns])
+    #pack the ref points, nan when missing
+    refs = numpy.full((len(records), 3, 2), numpy.nan, numpy.float32)
+    for row, record in enumerate(records):
+        for key, name in enumerate(['ref_nose', 'ref_tail', 'ref_head']):
+            if record.get(name) is not None:
+                refs[row, key] = record[name]
+    imageIds = numpy.array([UNKNOWN_ID if x.get('imageId') is None else x['imageId']
+                            for x in records], numpy.int64)
+    #replace the strings by codes into one string table
+    table = {}
+    codes = {}
+    for field in STRING_FIELDS:
+        codes[field] = numpy.array([table.setdefault(str(x.get(field) or ''),
+                                                     len(table))
+                                    for x in records], numpy.int32)
+    strings = [x.encode('utf-8') for x in sorted(table, key=table.get)]
+    string_offsets = numpy.zeros(len(strings) + 1, numpy.int64)
+    string_offsets[1:] = numpy.cumsum([len(x) for x in strings])
+    arrays = {'spots': spots.astype(numpy.int16), 'offsets': offsets,
+              'refs': refs, 'imageId': imageIds,
+              'strings': numpy.frombuffer(b''.join(strings), numpy.uint8),
+              'string_offsets': string_offsets}
+    arrays.update(codes)
+    write_arrays(path, arrays, MAGIC)
+    #return
+    return len(records)
+
+
+def write_arrays(path, arrays, magic):
+
+    """
+    DESCRIPTION
+    This function writes named numpy arrays to a file which can be opened
+    with a single read-only mmap (see read_arrays). The old file is replaced
+    in one step, so processes which have it open keep their copy.
+
+    INPUT
+    path = the file to write
+    arrays = a dictionary of name to numpy array
+    magic = the bytes the file starts with
+    """
+
+    #place each array on an aligned position after the header
+    header = {}
+    position = 0
+    for name, array in sorted(arrays.items()):
+        header[name] = [array.dtype.str, list(array.shape), position]
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(header).encode('utf-8')
+    start = -(-(len(magic) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(path + '.tmp', 'wb') as gallery_file:
+        gallery_file.write(magic)
+        gallery_file.write(numpy.uint64(len(header)).tobytes())
+        gallery_file.write(header)
+        for name, array in sorted(arrays.items()):
+            gallery_file.seek(start + json.loads(header)[name][2])
+            gallery_file.write(numpy.ascontiguousarray(array).tobytes())
+        #pad the end of the file to the last aligned position
+        gallery_file.truncate(start + position)
+    os.replace(path + '.tmp', path)
+
+
+def read_arrays(path, magic):
+
+    """
+    DESCRIPTION
+    This function opens a file written by write_arrays with a read-only 
+    mmap. The arrays are views into the mapped file.
+
+    INPUT
+    path = the file to open
+    magic = the bytes the file must start with
+
+    OUTPUT
+    arrays = a dictionary of name to read-only numpy array
+    """
+
+    buffer = numpy.memmap(path, numpy.uint8, 'r')
+    if bytes(buffer[:len(magic)]) != magic:
+        raise ValueError(path + ' is not a gallery file')
+    size = int(buffer[len(magic):len(magic) + 8].view(numpy.uint64)[0])
+    header_start = len(magic) + 8
+    header = json.loads(bytes(buffer[header_start:header_start + size]))
+    start = -(-(header_start + size) // ALIGNMENT) * ALIGNMENT
+    return {name: numpy.ndarray(shape, numpy.dtype(dtype), buffer, 
+                                start + position)
+            for name, (dtype, shape, position) in header.items()}
+
+
+class GalleryFile(object):
+
+    """
+    DESCRIPTION
+    A gallery file opened with a read-only mmap. The arrays are views into
+    the mapped file, so nothing is read until it is used.
+
+    spots = an (S, 2) int16 array of all spot patterns
+    offsets = start position of each image in spots (length N + 1)
+    refs = an (N, 3, 2) float32 array of the nose, tail and head ref points
+    imageId = an int64 array of imageIds (UNKNOWN_ID when unknown)
+    population, date, number, name, baseTag, pitTag, report, tank = int32 
+        arrays of string table codes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for name, array in read_arrays(path, MAGIC).items():
+            setattr(self, name, array)
+        #the code of each string, built on first use (see code)
+        self.codes = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def string(self, code):
+
+        """
+        DESCRIPTION
+        This function returns a string of the string table.
+
+        INPUT
+        code = the code of the string
+
+        OUTPUT
+        string = the decoded string
+        """
+
+        return bytes(self.strings[self.string_offsets[code]:
+                                  self.string_offsets[code + 1]]).decode('utf-8')
+
+    def code(self, string):
+
+        """
+        DESCRIPTION
+        This function finds the code of a string in the string table.
+
+        INPUT
+        string = the string to look up
+
+        OUTPUT
+        code = the code of the string, or -1 if it is not in the table
+        """
+
+        if self.codes is None:
+            self.codes = {self.string(x): x 
+                          for x in range(len(self.string_offsets) - 1)}
+        return self.codes.get(string, -1)
+
+    def pattern(self, row):
+
+        """
+        DESCRIPTION
+        This function returns the spot pattern of an image.
+
+        INPUT
+        row = the row number
+
+        OUTPUT
+        pattern = an (n, 2) int16 numpy array (view into the file)
+        """
+
+        return self.spots[self.offsets[row]:self.offsets[row + 1]]
+
+    def record(self, row):
+
+        """
+        DESCRIPTION
+        This function returns an image in the format passed to
+        write_gallery_file.
+
+        INPUT
+        row = the row number
+
+        OUTPUT
+        record = a dictionary of the imageId, string fields, spots and ref
+                 points of the image
+        """
+
+        record = {field: self.string(getattr(self, field)[row])
+                  for field in STRING_FIELDS}
+        record['imageId'] = (None if self.imageId[row] == UNKNOWN_ID 
+                             else int(self.imageId[row]))
+        record['spots'] = self.pattern(row).tolist()
+        for key, name in enumerate(['ref_nose', 'ref_tail', 'ref_head']):
+            if numpy.isnan(self.refs[row, key]).any():
+                record[name] = None
+            else:
+                record[name] = self.refs[row, key].tolist()
+        return record
+
+    def population_rows(self, population):
+
+        """
+        DESCRIPTION
+        This function finds the images of a population.
+
+        INPUT
+        population = the population name
+
+        OUTPUT
+        rows = a numpy array of row numbers
+        """
+
+        return numpy.flatnonzero(self.population == self.code(population))
+
+
+def json_records(path):
+
+    """
+    DESCRIPTION
+    This function reads the nested population/date/number JSON spot dataset
+    (see json/snapper-spot-data.json) as a list of images.
+
+    INPUT
+    path = the JSON dataset
+
+    OUTPUT
+    records = a list of dictionaries as passed to write_gallery_file
+    """
+
+    with open(path, 'r') as json_file:
+        dataset = json.load(json_file)
+    records = []
+    for population in dataset:
+        for date in dataset[population]:
+            for number in dataset[population][date]:
+                data_individual = dataset[population][date][number]
+                name = data_individual['image'].split('.')[0]
+                #the images are named date_tag, the tag is the baseTag
+                record = {'imageId': None, 'population': population,
+                          'date': date, 'number': number, 'name': name,
+                          'baseTag': name.split('_')[1] if '_' in name else '',
+                          'pitTag': '-', 'report': '-', 'tank': '-'}
+                #the spots and ref points are stored as JSON text
+                for name in ['spots', 'ref_nose', 'ref_tail', 'ref_head']:
+                    value = data_individual.get(name)
+                    record[name] = json.loads(value) if isinstance(value, str) else value
+                records += [record]
+    #return
+    return records
+
+
+def fishdata_records():
+
+    """
+    DESCRIPTION
+    This function reads the FishData table as a list of images.
+
+    OUTPUT
+    records = a list of dictionaries as passed to write_gallery_file
+    """
+
+    # import model
+    from identify.models import FishData
+
+    records = []
+    for data_individual in (FishData.objects.filter(inGallery=True)
+                            .order_by('-date', 'imageId')
+                            .values('imageId', 'population', 'date', 'name',
+                                    'baseTag', 'pitTag', 'report', 'tank',
+                                    'spots', 'refNose', 'refTail', 'refHead')
+                            .iterator()):
+        records += [{'imageId': data_individual['imageId'],
+                     'population': data_individual['population'],
+                     'date': data_individual['date'], 'number': '',
+                     'name': data_individual['name'],
+                     'baseTag': data_individual['baseTag'],
+                     'pitTag': data_individual['pitTag'],
+                     'report': data_individual['report'],
+                     'tank': data_individual['tank'],
+                     'spots': json.loads(data_individual['spots'] or '[]'),
+                     'ref_nose': json.loads(data_individual['refNose'] or 'null'),
+                     'ref_tail': json.loads(data_individual['refTail'] or 'null'),
+                     'ref_head': json.loads(data_individual['refHead'] or 'null')}]
+    #return
+    return records
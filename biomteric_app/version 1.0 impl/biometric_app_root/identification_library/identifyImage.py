@@ -3,22 +3,48 @@ import json
 import cv2
 import copy
 import datetime
+import time
 
 
 
 # import json file path
-from biometric_app_site.settings import JSON_ROOT
+from biometric_app_site.settings import SEARCH_WORKERS
 
 # import shared modules
 from . import functions
+from . import features
+from . import parallel
+from . import scorecache
+from .identities import identity_sightings
+from .gallery import get_gallery, query_stats
 from .modules import misc_fun
 from .modules import untidy_fun
 from .modules import fish_fun
 from .modules import opencv_fun
+from .modules import ref_fun
 
 # import model
+from django.db.models import Q
 from identify.models import FishData
 
+# FishData fields returned for each tag match
+TAG_MATCH_FIELDS = ['population', 'name', 'imageId', 'tank', 'date']
+
+# search settings used by analyzeData and searchStoredData
+METHODS = ['fish_ransac']
+# fish_ransac converges within each candidate, so one pass is enough
+MATCH_PERM = 1
+MATCH_QUALITY = 12
+# number of ranked matches to return (0 returns the first match only)
+MATCH_TOP = 5
+# time budget for the search, the best matches so far are returned after it
+DEADLINE_MS = 60000
+
+# version of the image pipeline (fish, spot and ref point extraction) stored
+# with the features in FishData, increase it when the extracted features 
+# change so searchStoredData runs the pipeline again
+PIPELINE_VERSION = 1
+
 """
 Accepts request from web page and return the result
 
@@ -26,18 +52,14 @@ INPUT
 image = path of uploaded image
 imageName = name of uploaded image
 pitTag = physical tag of uploaded image
+imageId = imageId of uploaded image, used to reuse the cached match scores
 
 OUTPUT
 Identfication results
 """
-def analyzeData(image, imageName, pitTag):
+def analyzeData(image, imageName, pitTag, imageId=None):
     print('starting identification')
     
-    # load the merged raw spot data
-    spot_data_file = JSON_ROOT + '/snapper-spot-data.json'
-    with open(spot_data_file, 'r') as file:
-        spot_data = json.load(file)
-    
     # to analyze how much time taken for the identification process
     startTime = datetime.datetime.now()
     
@@ -52,9 +74,6 @@ def analyzeData(image, imageName, pitTag):
     standard_height = 1000
     population = '2013B10'
     date = '2019-03-22'
-    methods = ['fish_ref']
-    matchPerm = 100
-    matchQuality = 12
 
     # Resize input image and create three copies for different parts of the analysis
     ratio = standard_height / float(len(img))
@@ -83,33 +102,107 @@ def analyzeData(image, imageName, pitTag):
     spot_centers = [opencv_fun.contour_center(x) for x in spots]
       
     # find three ref points
-    nose_upper, nose_lower = fish_fun.ref_fish_lips(fish)
+    nose_upper, nose_lower = ref_fun.ref_fish_lips(fish)
     tail_upper, tail_lower = fish_fun.ref_tail_across(fish)
-    head_upper = fish_fun.ref_fish_head(fish, nose_upper, tail_upper)
+    head_upper = ref_fun.ref_fish_head(fish, nose_upper, tail_upper)
         
     # init a new individual dictionary
     new_ind = {"population": population, "date": date, "number": 0,
                     "image": image, 'spots': spot_centers, 'ref_nose': nose_upper, 
                    'ref_head': head_upper, 'ref_tail': tail_upper,
-                   'name': imageName}
+                   'name': imageName, 'imageId': imageId,
+                   'pipelineVersion': PIPELINE_VERSION}
+
+    # place the spots in standard space once so the gallery patterns, which 
+    # are stored in standard space, can be compared without a nose/tail affine
+    new_ind['spots_standard'] = features.standard_spots(spot_centers, nose_upper, tail_upper)
+
+    # initiating search for match
+    return search_for_match(new_ind, METHODS, MATCH_QUALITY, MATCH_PERM, MATCH_TOP, startTime, pitTag, DEADLINE_MS)
+
+
+"""
+Search again for an image which has already been processed, using the spots
+and ref points stored in FishData instead of running the image pipeline
+
+INPUT
+imageId = imageId of the stored image
+pitTag = physical tag of the image
+
+OUTPUT
+Identfication results, or None if the stored features are missing or were 
+extracted by an older pipeline version (see PIPELINE_VERSION)
+"""
+def searchStoredData(imageId, pitTag):
+    print('starting search of stored data')
+    # to analyze how much time taken for the identification process
+    startTime = datetime.datetime.now()
+
+    new_ind = storedIndividual(FishData.objects.filter(pk=imageId).first())
+    if new_ind is None:
+        return None
 
     # initiating search for match
-    return search_for_match(new_ind, methods, matchQuality, matchPerm, startTime, pitTag)
+    return search_for_match(new_ind, METHODS, MATCH_QUALITY, MATCH_PERM, MATCH_TOP, startTime, pitTag, DEADLINE_MS)
+
+
 
+"""
+Read the spots and ref points stored for an image, which are kept for every
+analysed upload, including the ones which found no match and are not in the
+gallery (see FishData.inGallery)
 
+INPUT
+data_individual = a FishData object, or None
 
-def search_for_match(new_individual, methods, matchquality, matchPerm, startTime, pitTag):
-    #loop through dataset for a total number of permutations
-    dataList = FishData.objects.order_by('-date')
+OUTPUT
+new_ind = the individual in the format built by analyzeData, or None if the
+          stored features are missing or were extracted by an older pipeline
+          version (see PIPELINE_VERSION)
+"""
+def storedIndividual(data_individual):
+    if data_individual is None or data_individual.pipelineVersion != PIPELINE_VERSION:
+        return None
+    if not data_individual.spots or not data_individual.refNose or not data_individual.refTail:
+        return None
+
+    # the stored individual in the format built by analyzeData
+    new_ind = {'spots': json.loads(data_individual.spots),
+               'ref_nose': json.loads(data_individual.refNose),
+               'ref_head': json.loads(data_individual.refHead) if data_individual.refHead else None,
+               'ref_tail': json.loads(data_individual.refTail),
+               'name': data_individual.name, 'imageId': data_individual.imageId,
+               'pipelineVersion': data_individual.pipelineVersion}
+    if new_ind['ref_nose'] is None or new_ind['ref_tail'] is None:
+        return None
+    new_ind['spots_standard'] = features.standard_spots(new_ind['spots'], new_ind['ref_nose'], 
+                                                        new_ind['ref_tail'])
+    return new_ind
+
+
+def search_for_match(new_individual, methods, matchquality, matchPerm, matchTop, startTime, pitTag, deadline_ms=None):
+    # the search stops deadline_ms after the identification started
+    deadline = None
+    if deadline_ms is not None:
+        deadline = startTime.timestamp() + deadline_ms / 1000.0
     matchData = {}
     print('Start checking for match')
     if pitTag is '-':
         print('Bio match starts')
-        matchData = getBioMatchData(dataList, new_individual, methods, matchquality, matchPerm)
+        matchData = getBioMatchData(get_gallery(), new_individual, methods, matchquality, matchPerm, matchTop, deadline)
     else:
         print('Tag match starts')
-        matchData = getTagMatchData(new_individual, dataList, pitTag)
+        matchData = getTagMatchData(new_individual, pitTag)
     print('got results')
+    if 'cascade' in matchData:
+        print('prefilter removed ' + str(matchData['cascade']['stats']) + ' (stats) and ' + 
+              str(matchData['cascade']['grid']) + ' (grid) of ' + 
+              str(matchData['cascade']['candidates']) + ' candidates')
+    if 'scoreCache' in matchData:
+        print('score cache: ' + str(matchData['scoreCache']['hits']) + ' hits, ' + 
+              str(matchData['scoreCache']['misses']) + ' misses')
+    if not matchData['searchComplete']:
+        print('search stopped at the deadline after ' + matchData['searchProgress'] + ' candidates')
     if pitTag is not '-' and len(matchData['matching_image_list']) == 0:
         return {'type': 'success',
                 'message': 'Match Not Found',
@@ -117,9 +210,16 @@ def search_for_match(new_individual, methods, matchquality, matchPerm, startTime
                 'matchPitTag': pitTag,
                 'matching_image_list': matchData['matching_image_list'],
                 'matching_image_id_list': matchData['matching_image_id_list'],
+                'matching_score_list': matchData['matching_score_list'],
+                'searchComplete': matchData['searchComplete'],
+                'searchProgress': matchData['searchProgress'],
                 'timeTook': str(datetime.datetime.now() - startTime)}
     elif len(matchData['matching_image_list']) == 0:
-        return {'type': 'info', 'message': 'Sorry, unable to identify the fish.'}
+        return {'type': 'info', 'message': 'Sorry, unable to identify the fish.',
+                'new_individual': new_individual,
+                'searchComplete': matchData['searchComplete'],
+                'searchProgress': matchData['searchProgress'],
+                'timeTook': str(datetime.datetime.now() - startTime)}
     else:
         return {'type': 'success',
             'message': 'Match Found',
@@ -127,87 +227,152 @@ def search_for_match(new_individual, methods, matchquality, matchPerm, startTime
             'matchPitTag': matchData['matchPitTag'],
             'matching_image_list': matchData['matching_image_list'],
             'matching_image_id_list': matchData['matching_image_id_list'],
+            'matching_score_list': matchData['matching_score_list'],
+            'searchComplete': matchData['searchComplete'],
+            'searchProgress': matchData['searchProgress'],
             'timeTook': str(datetime.datetime.now() - startTime)}
 
 
-def getTagMatchData(new_individual, dataList, pitTag):
-    imageName = new_individual['name']
-    matching_image_list = []
-    mathcing_image_id_list = []
-    jsonDec = json.decoder.JSONDecoder()
-    for data_individual in dataList:
-        if imageName == data_individual.name:
-            continue
-        if data_individual.pitTag is not '-':
-            checkPitTag = data_individual.pitTag
-        elif data_individual.report is not '-':
-            checkPitTag = data_individual.report
-        else:
-            continue
-        imageId = data_individual.imageId
-        if checkPitTag == pitTag and (len(mathcing_image_id_list) == 0 or imageId not in mathcing_image_id_list):
-            mathcing_image_id_list.append(imageId)
-            matching_image_list.append({'population' : data_individual.population,
-                                            'name' : data_individual.name, 
-                                            'imageId' : imageId,
-                                            'tank': data_individual.tank, 
-                                            'date': data_individual.date})
+def getTagMatchData(new_individual, pitTag):
+    # a row is tagged by its pitTag, or by its report when it has no pitTag
+    tagged = ((Q(pitTag=pitTag) & ~Q(pitTag='-')) | 
+              (Q(pitTag='-', report=pitTag) & ~Q(report='-')))
+    # one indexed query instead of a scan of the whole table
+    matching_image_list = list(FishData.objects.filter(tagged, inGallery=True)
+                               .exclude(name=new_individual['name'])
+                               .order_by('-date', 'imageId')
+                               .values(*TAG_MATCH_FIELDS).distinct())
+    mathcing_image_id_list = [x['imageId'] for x in matching_image_list]
     return {'matching_image_list': matching_image_list,
             'matching_image_id_list': mathcing_image_id_list,
-            'matchPitTag' : pitTag}   
+            'matching_score_list': [],
+            'matchPitTag' : pitTag,
+            'searchComplete': True,
+            'searchProgress': ''}   
 
 
-def getBioMatchData(dataList, new_individual, methods, matchquality, matchPerm):
+def getBioMatchData(gallery, new_individual, methods, matchquality, matchPerm, matchTop, deadline, 
+                    subset=None, nearest=None):
     loop = 0
     matching_image_list = []
     mathcing_image_id_list = []
     matchPitTag = '-'
-    jsonDec = json.decoder.JSONDecoder()
-    imageName = new_individual['name']
+    # number of candidate rows checked out of the total before the deadline
+    checked = 0
+    total = 0
+    complete = True
+    # the query pattern in standard space (see features.standard_spots)
+    query_standard = {'spots': new_individual.get('spots_standard')}
+    standard = methods[0] in functions.STANDARD_METHODS
+    if query_standard['spots'] is None and standard:
+        methods = ['fish_ref']
+        standard = False
+    # a ranked search keeps the matchTop best rows in a single pass
+    if matchTop > 0:
+        matchPerm = 1
+    # number of rows removed by each stage of the prefilter cascade
+    cascade = {'candidates': 0, 'stats': 0, 'grid': 0}
+    # align one representative image of each identity (see identities.py),
+    # unless the rows to search are given (see sweep.py)
+    if subset is None:
+        subset = gallery.representatives(new_individual['name'])
+    # the prefilter statistics of the new individual, used by every pass
+    stats = query_stats(new_individual)
+    # the scores cached by earlier searches of this image (see scorecache.py),
+    # only the fixed scores are added so every pass draws the random ones again
+    cache = None
+    # the number of rows read from the cache
+    cache_counts = {'hits': 0}
+    if new_individual.get('imageId') is not None:
+        paramsHash = scorecache.params_hash(new_individual, methods[0])
+        cache = scorecache.load_scores(gallery, [new_individual['imageId']], 
+                                       [paramsHash], methods[0])[0]
+        known = set(cache)
     while loop < len(range(matchPerm)):
-        for data_individual in dataList:
-            if imageName == data_individual.name:
-                continue
-
-            # select the spots to allign
-            dataSpots = data_individual.spots
-
-            # setting check_data
-            check_data = {'spots': jsonDec.decode(data_individual.spots),
-                        'ref_nose': jsonDec.decode(data_individual.refNose),
-                        'ref_tail': jsonDec.decode(data_individual.refTail),
-                        'ref_head': jsonDec.decode(data_individual.refHead)}
-
-            # align the data_individual to the new individual        
-            aligned_pattern = fish_fun.align_patterns(copy.deepcopy(new_individual),
-                copy.deepcopy(check_data), methods[0])
-
-            #compare to new_individual
-            match_list = fish_fun.compare_patterns(new_individual['spots'], aligned_pattern)
-
-            # count the number of matching spots
-            match_value = len([x for x in match_list if x[1] < 0.15])
-
-            population = data_individual.population
-            name = data_individual.name
-            imageId = data_individual.imageId
-            tank = data_individual.tank
-            date = data_individual.date
-            temp = {}
-            if match_value > matchquality and (len(mathcing_image_id_list) == 0 or imageId not in mathcing_image_id_list):
-                    mathcing_image_id_list.append(imageId)
-                    if data_individual.pitTag is not '-':
-                        matchPitTag = data_individual.pitTag
-                    elif data_individual.report is not '-':
-                        matchPitTag = data_individual.report
-                    matching_image_list.append({'population' : population,
-                                            'name' : name, 'imageId' : imageId,
-                                            'tank': tank, 'date': date})
-                    break
+        # the shortlist first, then the next rows by embedding when the
+        # shortlist has no match (see gallery.candidates)
+        for fallback in [False, True]:
+            # the rows to align, after the prefilter cascade (see gallery.py),
+            # the first shortlist uses the nearest rows when they are given
+            # (see batch.py)
+            rows, removed = gallery.candidates(new_individual, standard, set(mathcing_image_id_list), 
+                                               nearest if loop == 0 and not fallback else None,
+                                               subset=subset, fallback=fallback, stats=stats)
+            for key in cascade:
+                cascade[key] += removed[key]
+            total += len(rows)
+
+            if matchTop > 0:
+                # rank the rows, best match first
+                if SEARCH_WORKERS > 1:
+                    matches, checked_pass = parallel.search_pool.rank(gallery, new_individual, rows, 
+                        methods[0], matchquality, matchTop, SEARCH_WORKERS, deadline, cache, 
+                        cache_counts)
+                else:
+                    matches, checked_pass = functions.rank_gallery_rows(gallery, new_individual, 
+                        rows, methods[0], matchquality, matchTop, deadline, cache, cache_counts)
+            else:
+                # find the first row above matchquality
+                if SEARCH_WORKERS > 1:
+                    match, checked_pass = parallel.search_pool.search(gallery, new_individual, rows, 
+                        methods[0], matchquality, SEARCH_WORKERS, deadline, cache, cache_counts)
+                else:
+                    match, checked_pass = functions.search_gallery_rows(gallery, new_individual, 
+                        rows, methods[0], matchquality, deadline, cache, cache_counts)
+                matches = [match] if match is not None else []
+            checked += checked_pass
+            # rows left unchecked without a match means the time ran out
+            if checked_pass < len(rows) and (matchTop > 0 or len(matches) == 0):
+                complete = False
+            if len(matches) > 0 or not standard:
+                break
+
+        # expand the matched identities into all of their sightings
+        sightings = identity_sightings([str(gallery.info[row]['baseTag']) 
+                                        for row, match_value in matches], 
+                                       new_individual['name'])
+        for row, match_value in matches:
+            # the matched image first, then the other sightings
+            data_individual = gallery.info[row]
+            identity = [data_individual] + sightings.get(str(data_individual['baseTag']), [])
+            # the tag of the first tagged sighting of the identity
+            identityPitTag = '-'
+            for sighting in identity:
+                if identityPitTag == '-':
+                    if sighting['pitTag'] != '-':
+                        identityPitTag = sighting['pitTag']
+                    elif sighting['report'] != '-':
+                        identityPitTag = sighting['report']
+            # a ranked search keeps the tag of the best tagged match
+            if identityPitTag != '-' and (matchTop == 0 or matchPitTag == '-'):
+                matchPitTag = identityPitTag
+            for sighting in identity:
+                imageId = sighting['imageId']
+                if imageId in mathcing_image_id_list:
+                    continue
+                mathcing_image_id_list.append(imageId)
+                matching_image_list.append({'population' : sighting['population'],
+                                        'name' : sighting['name'], 'imageId' : imageId,
+                                        'tank': sighting['tank'], 'date': sighting['date'],
+                                        'score': match_value})
         loop += 1
-    return {'matching_image_list': matching_image_list,
-            'matching_image_id_list': mathcing_image_id_list,
-            'matchPitTag': matchPitTag}
+        # stop the remaining passes when the time is up
+        if loop < matchPerm and deadline is not None and time.time() > deadline:
+            complete = False
+            break
+    matchData = {'matching_image_list': matching_image_list,
+                 'matching_image_id_list': mathcing_image_id_list,
+                 'matching_score_list': [x['score'] for x in matching_image_list],
+                 'matchPitTag': matchPitTag,
+                 'searchComplete': complete,
+                 'searchProgress': '%d/%d' % (checked, total),
+                 'cascade': cascade}
+    if cache is not None:
+        # save the new scores for the next search of this image
+        misses = scorecache.save_scores(gallery, new_individual['imageId'], paramsHash, 
+                                        methods[0], cache, known)
+        matchData['scoreCache'] = {'hits': cache_counts['hits'], 'misses': misses}
+    return matchData
 
 
 
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Identity table built on FishData.baseTag.
+
+All the images with the same baseTag are sightings of one individual. Each
+identity keeps a representative (medoid) image, and the bio search aligns
+the new individual to the representatives only. The matched identity is
+then expanded into all of its sightings with a single query (see
+getBioMatchData). The identities are kept up to date by the FishData
+signals (see signals.py).
+"""
+
+#import python libraries
+import itertools
+import numpy
+
+# import shared modules
+from . import features
+from .gallery import decode_points, gallery
+
+# import model
+from identify.models import FishData, Identity
+
+
+# FishData fields needed to choose the medoid of an identity
+MEDOID_FIELDS = ['imageId', 'spots', 'spotsStandard']
+
+# FishData fields returned for each sighting of a matched identity
+SIGHTING_FIELDS = ['population', 'name', 'imageId', 'tank', 'date', 'pitTag',
+                   'report']
+
+
+def identity_medoid(members):
+
+    """
+    DESCRIPTION
+    This function chooses the representative image of an identity. This is
+    the sighting whose pattern embedding (see features.pattern_embedding)
+    is the most similar to the others in total. Sightings without standard
+    space spots are only used when no sighting has them, in which case the
+    sighting with the most spots is used.
+
+    INPUT
+    members = a list of dictionaries with the MEDOID_FIELDS of each sighting
+
+    OUTPUT
+    imageId = the imageId of the representative image
+    """
+
+    standard = [x for x in members if x['spotsStandard']]
+    if len(standard) == 0:
+        return max(members, key=lambda x: len(decode_points(x['spots'])))['imageId']
+    embeddings = numpy.array([features.pattern_embedding(
+        decode_points(x['spotsStandard'])) for x in standard])
+    #the total similarity of each sighting to every sighting
+    totals = numpy.dot(embeddings, embeddings.T).sum(axis=1)
+    #return
+    return standard[int(numpy.argmax(totals))]['imageId']
+
+
+def update_identity(baseTag):
+
+    """
+    DESCRIPTION
+    This function recalculates the identity of a baseTag after one of its
+    sightings has been saved or deleted. The identity is removed when it has
+    no sightings left.
+
+    INPUT
+    baseTag = the baseTag of the identity
+    """
+
+    if not baseTag:
+        return
+    members = list(FishData.objects.filter(baseTag=baseTag)
+                   .values(*MEDOID_FIELDS))
+    if len(members) == 0:
+        Identity.objects.filter(baseTag=baseTag).delete()
+        return
+    Identity(baseTag=baseTag, medoidImageId=identity_medoid(members),
+             sightings=len(members)).save()
+
+
+def rebuild_identities():
+
+    """
+    DESCRIPTION
+    This function rebuilds the whole identity table from FishData, reading
+    one baseTag at a time.
+
+    OUTPUT
+    count = the number of identities
+    """
+
+    Identity.objects.all().delete()
+    rows = (FishData.objects.exclude(baseTag='').order_by('baseTag')
+            .values('baseTag', *MEDOID_FIELDS).iterator())
+    identities = []
+    for baseTag, members in itertools.groupby(rows, lambda x: x['baseTag']):
+        members = list(members)
+        identities += [Identity(baseTag=baseTag,
+                                medoidImageId=identity_medoid(members),
+                                sightings=len(members))]
+    Identity.objects.bulk_create(identities)
+    #bulk_create does not send the Identity signals
+    gallery.load_identities()
+    gallery.touch(True)
+    #return
+    return len(identities)
+
+
+def identity_sightings(baseTags, name):
+
+    """
+    DESCRIPTION
+    This function finds every sighting of a list of identities with a single
+    query, skipping the images with the name of the new individual.
+
+    INPUT
+    baseTags = a list of baseTags
+    name = the name of the new individual
+
+    OUTPUT
+    sightings = a dictionary of baseTag to a list of dictionaries with the
+                SIGHTING_FIELDS of each sighting, newest first
+    """
+
+    sightings = {}
+    baseTags = [x for x in baseTags if x]
+    if len(baseTags) == 0:
+        return sightings
+    for sighting in (FishData.objects.filter(baseTag__in=baseTags)
+                     .exclude(name=name).order_by('-date', 'imageId')
+                     .values('baseTag', *SIGHTING_FIELDS)):
+        sightings.setdefault(sighting['baseTag'], []).append(sighting)
+    #return
+    return sightings
+
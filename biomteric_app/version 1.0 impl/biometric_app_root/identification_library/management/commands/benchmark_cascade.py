@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Management command which measures the limits of the prefilter cascade (see
+GalleryArrays.cascade) on the tagged images of the spot dataset.
+
+    python manage.py benchmark_cascade --negatives 20000
+
+The images named date_tag_side with the same tag and side are sightings of
+one individual. Each pair of sightings is aligned both ways and the pairs
+with more than matchquality matching spots are the true matches. For each
+cascade value the command prints the current limit, the loosest value
+among the true matches (the tightest limit which keeps all of them) and the
+share of random pairs of different individuals removed by the current
+limit. The database is not used.
+"""
+
+#import python libraries
+import collections
+import json
+import os
+import numpy
+
+#import django
+from django.core.management.base import BaseCommand
+
+# import shared modules
+from biometric_app_site.settings import JSON_ROOT
+from identification_library import features
+from identification_library import functions
+from identification_library import gallery as gallery_module
+from identification_library.galleryfile import json_records
+from identification_library.gallery import decode_row, row_fields, pack_items, query_stats
+from identification_library.identifyImage import MATCH_QUALITY
+
+# import model
+from identify.models import FishData
+
+
+# the cascade values, the name of the limit in gallery.py and True when a
+# larger value removes a row
+MEASURES = [('count ratio', 'CASCADE_COUNT_RATIO', True),
+            ('spacing average', 'CASCADE_SPACING_AVERAGE', True),
+            ('spacing closest', 'CASCADE_SPACING_CLOSEST', True),
+            ('nose/tail ratio', 'CASCADE_NOSE_TAIL_RATIO', True),
+            ('grid overlap', 'CASCADE_GRID_OVERLAP', False)]
+
+
+class Command(BaseCommand):
+
+    help = 'Measure the prefilter cascade limits on the tagged images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', default=os.path.join(JSON_ROOT, 'snapper-spot-data.json'),
+                            help='the spot dataset')
+        parser.add_argument('--method', default='fish_ransac',
+                            help='alignment method (see fish_fun.align_matrix)')
+        parser.add_argument('--matchquality', type=int, default=MATCH_QUALITY,
+                            help='number of matching spots needed for a match')
+        parser.add_argument('--negatives', type=int, default=20000,
+                            help='number of random pairs of different individuals')
+
+    def handle(self, *args, **options):
+        packed = self.pack_records(json_records(options['json']))
+        queries = [query_individual(packed, x) for x in range(len(packed))]
+        stats = [query_stats(x) for x in queries]
+        #the true matches, in both directions
+        pairs = tagged_pairs(packed)
+        matches = []
+        for row_1, row_2 in pairs:
+            for query, row in [(row_1, row_2), (row_2, row_1)]:
+                if functions.score_gallery_rows(packed, queries[query], [row],
+                                                options['method'])[0] > options['matchquality']:
+                    matches += [(query, row)]
+        #random pairs of different individuals
+        state = numpy.random.RandomState(0)
+        tags = [x['baseTag'] for x in packed.info]
+        negatives = [(x, y) for x, y in state.randint(0, len(packed), (options['negatives'], 2))
+                     if x != y and (not tags[x] or tags[x] != tags[y])]
+        self.stdout.write('%d images, %d tagged pairs, %d true matches, %d random pairs' %
+                          (len(packed), len(pairs), len(matches), len(negatives)))
+        true_values = cascade_values(packed, stats, matches)
+        negative_values = cascade_values(packed, stats, negatives)
+        for column, (name, limit_name, larger) in enumerate(MEASURES):
+            limit = getattr(gallery_module, limit_name)
+            #missing values pass the cascade
+            true_column = true_values[:, column][~numpy.isnan(true_values[:, column])]
+            negative_column = negative_values[:, column]
+            with numpy.errstate(invalid='ignore'):
+                if larger:
+                    loosest = true_column.max()
+                    removed_true = (true_column > limit).sum()
+                    removed = (negative_column > limit).mean()
+                else:
+                    loosest = true_column.min()
+                    removed_true = (true_column < limit).sum()
+                    removed = (negative_column < limit).mean()
+            self.stdout.write('%-16s limit %5.2f  loosest true match %5.2f  '
+                              'true matches removed %d  random pairs removed %5.1f%%' %
+                              (name, limit, loosest, removed_true, removed * 100))
+        #the whole cascade
+        removed_true = sum(not packed.cascade(stats[x][0], stats[x][1], [y])[0]
+                           for x, y in matches)
+        removed = sum(not packed.cascade(stats[x][0], stats[x][1], [y])[0]
+                      for x, y in negatives)
+        self.stdout.write('cascade          true matches removed %d  random pairs removed %5.1f%%' %
+                          (removed_true, 100.0 * removed / max(len(negatives), 1)))
+
+    def pack_records(self, records):
+
+        """
+        DESCRIPTION
+        This function packs the images of the dataset into a snapshot, with
+        the features calculated as when a FishData row is saved.
+
+        INPUT
+        records = a list of images (see galleryfile.json_records)
+
+        OUTPUT
+        packed = a GalleryArrays object, with the tag and side of each
+                 image as its baseTag
+        """
+
+        items = []
+        for key, record in enumerate(records):
+            parts = record['name'].split('_')
+            data_individual = FishData(
+                imageId=key + 1, name=record['name'], population=record['population'],
+                date=record['date'], tank='-', pitTag='-', report='-',
+                baseTag='_'.join(parts[1:]) if len(parts) == 3 else '',
+                spots=json.dumps(record['spots']), refNose=json.dumps(record['ref_nose']),
+                refTail=json.dumps(record['ref_tail']), refHead=json.dumps(record['ref_head']))
+            features.update_features(data_individual)
+            items += [decode_row(row_fields(data_individual))]
+        #return
+        return pack_items(items, {})
+
+
+def tagged_pairs(packed):
+
+    """
+    DESCRIPTION
+    This function finds every pair of sightings of the same individual.
+
+    INPUT
+    packed = a GalleryArrays object with the tag and side as baseTag
+
+    OUTPUT
+    pairs = a list of (row, row) tuples
+    """
+
+    groups = collections.defaultdict(list)
+    for row, info in enumerate(packed.info):
+        if info['baseTag']:
+            groups[info['baseTag']].append(row)
+    #return
+    return [(x, y) for group in groups.values() for key, x in enumerate(group)
+            for y in group[key + 1:]]
+
+
+def query_individual(packed, row):
+
+    """
+    DESCRIPTION
+    This function returns a row of the snapshot as a new individual.
+
+    INPUT
+    packed = a GalleryArrays object
+    row = the row number
+
+    OUTPUT
+    new_individual = a dictionary with the spots, ref points, spots_standard
+                     and name of the row
+    """
+
+    new_individual = packed.individual(row)
+    new_individual['spots_standard'] = packed.pattern_standard(row).tolist()
+    new_individual['name'] = packed.info[row]['name']
+    return new_individual
+
+
+def cascade_values(packed, stats, pairs):
+
+    """
+    DESCRIPTION
+    This function measures the cascade values of pairs of rows, the second
+    row of each pair as a candidate of the first.
+
+    INPUT
+    packed = a GalleryArrays object
+    stats = the query_stats of each row
+    pairs = a list of (query row, row) tuples
+
+    OUTPUT
+    values = an (n, 5) float array of the four stat differences and the
+             grid overlap of each pair (see MEASURES)
+    """
+
+    values = numpy.zeros((len(pairs), len(MEASURES)))
+    for key, (query, row) in enumerate(pairs):
+        values[key, :4] = packed.stat_differences(stats[query][0], [row])[0]
+        values[key, 4] = packed.grid_overlap(stats[query][1], [row])[0]
+    #return
+    return values
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Management command which times the reference point functions of ref_fun
+against the per-point loops they replaced on the stored shape templates, and
+checks they find the same points.
+
+    python manage.py benchmark_ref_points --shapes snapper --repeat 3
+
+The fish_fun functions call ref_fun, so the old loops are the reference
+versions kept in identify/tests.py. The tail fork is checked by timing the 
+triangle search instead: the 10,000 random samples of
+opencv_fun.profile_largest_triangle against the exact search of
+ref_fun.profile_largest_triangle, comparing the area of the triangles found.
+"""
+
+#import python libraries
+import time
+import numpy
+
+#import django
+from django.core.management.base import BaseCommand
+
+# import shared modules
+from identification_library import assets
+from identification_library.modules import fish_fun
+from identification_library.modules import opencv_fun
+from identification_library.modules import ref_fun
+
+# the loops replaced by ref_fun
+from identify.tests import old_ref_fish_lips, old_ref_tail_upper, old_ref_fish_head
+
+
+class Command(BaseCommand):
+
+    help = 'Time the ref_fun reference point functions against the old loops'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shapes', default='snapper',
+                            help='comma separated shape types of memory_shapes.json')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='number of times each function is timed')
+
+    def handle(self, *args, **options):
+        shapes = assets.memory_shapes()
+        fishes = [fish for shapeType in options['shapes'].split(',')
+                  for fish in shapes[shapeType].values()]
+        #the head is found from the upper lip and the upper tail point
+        refs = [(fish_fun.ref_fish_lips(fish)[0], fish_fun.ref_tail_across(fish)[0])
+                for fish in fishes]
+        self.stdout.write('%d contours, %d points on average' %
+                          (len(fishes), numpy.mean([len(x) for x in fishes])))
+        #the old loop and the ref_fun version of each function, by contour number
+        functions = [
+            ('ref_fish_lips', lambda key: old_ref_fish_lips(fishes[key]),
+             lambda key: ref_fun.ref_fish_lips(fishes[key])),
+            ('ref_tail_upper', lambda key: old_ref_tail_upper(fishes[key]),
+             lambda key: ref_fun.ref_tail_upper(fishes[key])),
+            ('ref_fish_head', lambda key: old_ref_fish_head(fishes[key], *refs[key]),
+             lambda key: ref_fun.ref_fish_head(fishes[key], *refs[key]))]
+        for name, old_function, new_function in functions:
+            old_time, old_points = self.time_function(old_function, len(fishes),
+                                                      options['repeat'])
+            new_time, new_points = self.time_function(new_function, len(fishes),
+                                                      options['repeat'])
+            same = sum(x == y for x, y in zip(old_points, new_points))
+            self.stdout.write('%-15s loop     %8.3f ms  ref_fun %8.3f ms  %6.1fx  %d/%d same' % (
+                name, old_time * 1000, new_time * 1000,
+                old_time / max(new_time, 1e-9), same, len(fishes)))
+        #the triangle search of ref_tail_fork on the profile of each tail
+        profiles = [self.tail_profile(fish) for fish in fishes]
+        old_time, old_triangles = self.time_function(
+            lambda key: opencv_fun.profile_largest_triangle(profiles[key], 10000),
+            len(fishes), options['repeat'])
+        new_time, new_triangles = self.time_function(
+            lambda key: ref_fun.profile_largest_triangle(profiles[key]),
+            len(fishes), options['repeat'])
+        old_areas = numpy.array([self.triangle_area(x, y) for x, y in zip(profiles, old_triangles)])
+        new_areas = numpy.array([self.triangle_area(x, y) for x, y in zip(profiles, new_triangles)])
+        self.stdout.write('%-15s random   %8.3f ms  exact   %8.3f ms  %6.1fx  '
+                          'larger on %d/%d, smaller on %d' % (
+                              'tail triangle', old_time * 1000, new_time * 1000,
+                              old_time / max(new_time, 1e-9),
+                              (new_areas > old_areas).sum(), len(fishes),
+                              (new_areas < old_areas).sum()))
+
+    def time_function(self, function, count, repeat):
+
+        """
+        DESCRIPTION
+        This function runs a reference point function on every contour.
+
+        INPUT
+        function = a function of the contour number
+        count = the number of contours
+        repeat = the number of times to run each contour
+
+        OUTPUT
+        elapsed = the average time per contour in seconds
+        points = the points found for each contour
+        """
+
+        start = time.time()
+        for x in range(repeat):
+            points = [function(key) for key in range(count)]
+        #return
+        return (time.time() - start) / (count * repeat), points
+
+    def tail_profile(self, fish):
+
+        """
+        DESCRIPTION
+        This function builds the profile of the last 20% of a fish searched by
+        ref_fun.ref_tail_fork.
+
+        INPUT
+        fish = a contour in standard opencv format
+
+        OUTPUT
+        profile = the profile of the tail (see opencv_fun.contour_to_profile)
+        """
+
+        center = opencv_fun.contour_center(fish)
+        pos_1 = fish[:, 0, 0].min()
+        pos_2 = fish[:, 0, 0].max()
+        fish_tail = fish[fish[:, 0, 0] >= int(pos_1 + ((pos_2 - pos_1)*0.80))]
+        fish_tail = numpy.roll(fish_tail, -numpy.argmin(fish_tail[:, 0, 0]), axis=0)
+        #return
+        return opencv_fun.contour_to_profile(fish_tail, center)
+
+    def triangle_area(self, profile, triangle):
+
+        """
+        DESCRIPTION
+        This function measures a profile triangle in whole pixels.
+
+        INPUT
+        profile = a profile
+        triangle = the three profile positions, or None
+
+        OUTPUT
+        area = the area of the triangle (0 for None)
+        """
+
+        if triangle is None:
+            return 0
+        a, b, c = profile[triangle].astype(int)
+        #return
+        return abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])) / 2.0
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Management command which times getTagMatchData against growing FishData
+tables, to check the indexed tag lookup does not grow with the table.
+
+    python manage.py benchmark_tag_match --sizes 1000,10000,100000
+
+The rows are added inside a transaction which is rolled back at the end, so
+the database is left unchanged.
+"""
+
+#import python libraries
+import time
+
+#import django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+# import shared modules
+from identification_library.identifyImage import getTagMatchData
+
+# import model
+from identify.models import FishData
+
+
+class Command(BaseCommand):
+
+    help = 'Time the tag match lookup against growing FishData tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='comma separated table sizes')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='number of lookups timed at each size')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(x) for x in options['sizes'].split(','))
+        with transaction.atomic():
+            #start after the existing rows
+            first = (FishData.objects.order_by('-imageId')
+                     .values_list('imageId', flat=True).first() or 0) + 1
+            added = 0
+            for size in sizes:
+                #bulk_create skips the signals, so the gallery is not loaded
+                FishData.objects.bulk_create(
+                    [self.make_row(first + x) for x in range(added, size)])
+                added = max(added, size)
+                #look up tags spread over the table, one match in ten
+                tags = ['T%d' % (x * size // options['repeat'] // 10)
+                        for x in range(options['repeat'])]
+                start = time.time()
+                for tag in tags:
+                    getTagMatchData({'name': '-'}, tag)
+                elapsed = (time.time() - start) / len(tags)
+                self.stdout.write('%8d rows: %.3f ms per lookup' %
+                                  (FishData.objects.count(), elapsed * 1000))
+            transaction.set_rollback(True)
+
+    def make_row(self, imageId):
+
+        """
+        DESCRIPTION
+        This function builds a synthetic FishData row. Every tenth row has a
+        pitTag, every tenth of the rest a report, the others neither.
+
+        INPUT
+        imageId = the imageId of the row
+
+        OUTPUT
+        data_individual = an unsaved FishData object
+        """
+
+        tag = 'T%d' % (imageId // 10)
+        return FishData(imageId=imageId, name='bench_%d' % imageId,
+                        population='bench', tank='bench',
+                        date='19-01-01', baseTag=str(imageId),
+                        pitTag=tag if imageId % 10 == 0 else '-',
+                        report=tag if imageId % 100 == 5 else '-')
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Management command which converts the spot data to and from the binary
+gallery export file (see galleryfile.py).
+
+    python manage.py gallery_file export gallery.bin --source json
+    python manage.py gallery_file export gallery.bin --source fishdata
+    python manage.py gallery_file import gallery.bin
+    python manage.py gallery_file info gallery.bin
+
+The json source is the old snapper-spot-data.json dataset. Importing adds the
+images of the file which are not in FishData yet, an image without an 
+imageId is given a negative one, as uploads use the upload time in seconds
+and a later upload could otherwise replace it. The live search reads
+FishData, so an exported file is only used to move or back up the spot data.
+"""
+
+#import python libraries
+import json
+import os
+import time
+
+#import django
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+
+# import shared modules
+from biometric_app_site.settings import JSON_ROOT
+from identification_library import galleryfile
+
+# import model
+from identify.models import FishData
+
+
+class Command(BaseCommand):
+
+    help = 'Export, import or describe a binary gallery export file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['export', 'import', 'info'])
+        parser.add_argument('path', help='the gallery file')
+        parser.add_argument('--source', default='fishdata',
+                            choices=['fishdata', 'json'],
+                            help='data exported to the gallery file')
+        parser.add_argument('--json', default=JSON_ROOT + '/snapper-spot-data.json',
+                            help='JSON dataset read by --source json')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        if options['action'] == 'export':
+            if options['source'] == 'json':
+                records = galleryfile.json_records(options['json'])
+            else:
+                records = galleryfile.fishdata_records()
+            count = galleryfile.write_gallery_file(options['path'], records)
+            self.stdout.write('%d images written to %s in %.1fs' %
+                              (count, options['path'], time.time() - start))
+        elif options['action'] == 'import':
+            count = self.import_file(galleryfile.GalleryFile(options['path']))
+            self.stdout.write('%d images added to FishData in %.1fs' %
+                              (count, time.time() - start))
+        else:
+            gallery = galleryfile.GalleryFile(options['path'])
+            self.stdout.write('%d images, %d spots, %d strings, %d bytes' %
+                              (len(gallery), len(gallery.spots),
+                               len(gallery.string_offsets) - 1,
+                               os.path.getsize(gallery.path)))
+
+    def import_file(self, gallery):
+
+        """
+        DESCRIPTION
+        This function saves the images of a gallery file which are not in
+        FishData yet. The rows are saved one at a time so the signals store
+        the features of each row and update the gallery.
+
+        INPUT
+        gallery = a GalleryFile object
+
+        OUTPUT
+        count = the number of rows added
+        """
+
+        imageIds = set(FishData.objects.values_list('imageId', flat=True))
+        names = set(FishData.objects.values_list('name', flat=True))
+        #new imageIds count down from below the lowest imageId and 0
+        nextId = min(FishData.objects.aggregate(Min('imageId'))['imageId__min'] or 0, 0) - 1
+        count = 0
+        for row in range(len(gallery)):
+            record = gallery.record(row)
+            if record['imageId'] in imageIds or record['name'] in names:
+                continue
+            #images from the JSON dataset have no imageId
+            imageId = record['imageId']
+            if imageId is None:
+                imageId = nextId
+            nextId = min(nextId, imageId - 1)
+            FishData(imageId=imageId, name=record['name'],
+                     population=record['population'], date=record['date'],
+                     baseTag=record['baseTag'], tank=record['tank'] or '-',
+                     pitTag=record['pitTag'] or '-', report=record['report'] or '-',
+                     spots=json.dumps(record['spots']),
+                     refNose=json.dumps(record['ref_nose']) if record['ref_nose'] else '',
+                     refTail=json.dumps(record['ref_tail']) if record['ref_tail'] else '',
+                     refHead=json.dumps(record['ref_head']) if record['ref_head'] else '').save()
+            count += 1
+        #return
+        return count
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Management command which matches every FishData row against the rest of the
+gallery and writes the identity clusters found back to baseTag.
+
+    python manage.py reidentify --workers 4 --checkpoint reidentify.json
+
+Progress is saved to the checkpoint file, so an interrupted run continues
+from where it stopped when it is started again with the same settings. The
+checkpoint records the gallery change counter (see gallery.stamp_changes)
+and a run is not resumed when FishData has changed since, as the rows 
+already done would not have been matched against the changed rows. The
+checkpoint is marked finished once the clusters are saved, and the next run
+then starts again from the start, so the command can be run periodically. The
+match scores are cached, so a run with a different matchquality only aligns
+the pairs it did not align before.
+"""
+
+#import python libraries
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+#import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+# import shared modules
+from biometric_app_site.settings import SEARCH_WORKERS
+from identification_library import reidentify
+from identification_library import scorecache
+from identification_library.identities import rebuild_identities
+from identification_library.gallery import get_gallery, gallery as process_gallery
+from identification_library.gallery import stamp_changes
+
+# import model
+from identify.models import FishData
+
+
+class Command(BaseCommand):
+
+    help = ('Match every FishData row against the gallery and write the '
+            'identity clusters to baseTag')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--method', default='fish_ransac',
+                            help='alignment method (see fish_fun.align_matrix)')
+        parser.add_argument('--matchquality', type=int, default=12,
+                            help='number of matching spots needed for a match')
+        parser.add_argument('--block', default='both',
+                            choices=sorted(reidentify.BLOCK_FIELDS),
+                            help='only match rows with the same population '
+                                 'and/or tank')
+        parser.add_argument('--workers', type=int, default=SEARCH_WORKERS,
+                            help='number of worker processes')
+        parser.add_argument('--chunk', type=int, default=32,
+                            help='number of rows sent to a worker at a time')
+        parser.add_argument('--checkpoint', default='reidentify.json',
+                            help='file used to save and resume progress')
+        parser.add_argument('--save-every', type=int, default=60,
+                            help='seconds between checkpoint saves')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='report the clusters without saving baseTag')
+
+    def handle(self, *args, **options):
+        settings = {'method': options['method'],
+                    'matchquality': options['matchquality'],
+                    'block': options['block'],
+                    'stamp': stamp_changes()}
+        #resume from the checkpoint if it was made with the same settings
+        #and FishData has not changed since
+        state = self.load_checkpoint(options['checkpoint'], settings)
+        done = set(state['done'])
+        #load the gallery once and split it into blocks
+        gallery = get_gallery()
+        blocks = reidentify.gallery_blocks(gallery, options['block'])
+        rows = [row for row, info in enumerate(gallery.info)
+                if info['imageId'] not in done]
+        chunks = [rows[x:x + options['chunk']]
+                  for x in range(0, len(rows), options['chunk'])]
+        self.stdout.write('%d rows in %d blocks, %d rows to match' %
+                          (len(gallery), len(set(blocks.tolist())), len(rows)))
+        start = time.time()
+        saved = time.time()
+        checked = 0
+        self.cache = {'hits': 0, 'misses': 0}
+        try:
+            for imageIds, pairs, aligned in self.run_chunks(
+                    gallery, blocks, chunks, settings, options['workers']):
+                state['done'] += imageIds
+                state['pairs'] += pairs
+                checked += aligned
+                if time.time() - saved > options['save_every']:
+                    self.save_checkpoint(options['checkpoint'], state)
+                    saved = time.time()
+                    self.stdout.write('%d/%d rows, %d aligned, %d matches, '
+                                      '%.0fs' % (len(state['done']),
+                                                 len(gallery), checked,
+                                                 len(state['pairs']),
+                                                 time.time() - start))
+        finally:
+            self.save_checkpoint(options['checkpoint'], state)
+        self.stdout.write('%d rows aligned, %d matches in %.0fs' %
+                          (checked, len(state['pairs']), time.time() - start))
+        self.stdout.write('score cache: %d hits, %d misses' %
+                          (self.cache['hits'], self.cache['misses']))
+        #join the matches into clusters and save the baseTags
+        clusters = reidentify.cluster_pairs(state['pairs'])
+        updated = self.save_clusters(clusters, options['dry_run'])
+        self.stdout.write('%d clusters, %d baseTags %s' %
+                          (len(clusters), updated,
+                           'to change' if options['dry_run'] else 'changed'))
+        #the baseTags were saved without the signals, rebuild the identities
+        if updated > 0 and not options['dry_run']:
+            self.stdout.write('%d identities' % rebuild_identities())
+        #the next run starts again instead of resuming this one
+        state['finished'] = True
+        self.save_checkpoint(options['checkpoint'], state)
+
+    def run_chunks(self, gallery, blocks, chunks, settings, workers):
+
+        """
+        DESCRIPTION
+        This function matches the chunks of rows, in the worker processes if
+        more than one worker is used. Only a few chunks are submitted ahead
+        of the results, so the pending results stay small. The cached scores
+        of each chunk are read before it is sent and the new scores are 
+        saved when it returns, counting the cached scores the chunk used.
+
+        INPUT
+        gallery = a GalleryArrays object
+        blocks = an int array with the block number of each row
+        chunks = a list of lists of row numbers
+        settings = a dictionary of the method, matchquality and block
+        workers = the number of worker processes
+
+        OUTPUT
+        results = a generator of (imageIds, pairs, checked) for each chunk
+        """
+
+        method = settings['method']
+        arguments = (method, settings['matchquality'])
+        if workers <= 1:
+            reidentify.init_worker(gallery, blocks)
+            for chunk in chunks:
+                hashes, known = self.load_scores(gallery, chunk, method)
+                result = reidentify.match_rows(chunk, *arguments, known)
+                self.save_scores(gallery, chunk, hashes, method, result[3])
+                self.cache['hits'] += result[4]
+                yield result[:3]
+            return
+        #the workers open one snapshot file of the gallery
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'gallery.snapshot')
+        gallery.write(path)
+        with directory, ProcessPoolExecutor(max_workers=workers,
+                                            initializer=reidentify.init_worker,
+                                            initargs=(path, blocks)) as executor:
+            chunks = iter(chunks)
+            pending = {}
+            while True:
+                #keep two chunks queued for every worker
+                for chunk in chunks:
+                    hashes, known = self.load_scores(gallery, chunk, method)
+                    future = executor.submit(reidentify.match_rows, chunk,
+                                             *arguments, known)
+                    pending[future] = (chunk, hashes)
+                    if len(pending) >= workers * 2:
+                        break
+                if len(pending) == 0:
+                    break
+                finished = wait(pending, return_when=FIRST_COMPLETED)[0]
+                for future in finished:
+                    chunk, hashes = pending.pop(future)
+                    result = future.result()
+                    self.save_scores(gallery, chunk, hashes, method, result[3])
+                    self.cache['hits'] += result[4]
+                    yield result[:3]
+
+    def load_scores(self, gallery, chunk, method):
+
+        """
+        DESCRIPTION
+        This function reads the cached scores of a chunk of rows.
+
+        INPUT
+        gallery = a GalleryArrays object
+        chunk = a list of row numbers
+        method = a string defining which alignment method to use
+
+        OUTPUT
+        hashes = the scorecache.params_hash of each row
+        known = a list with the cached scores of each row
+        """
+
+        hashes = [scorecache.params_hash(
+            reidentify.row_individual(gallery, row, method), method)
+            for row in chunk]
+        known = scorecache.load_scores(gallery, [gallery.info[row]['imageId']
+                                                 for row in chunk],
+                                       hashes, method)
+        return hashes, known
+
+    def save_scores(self, gallery, chunk, hashes, method, scores):
+
+        """
+        DESCRIPTION
+        This function saves the new scores of a chunk of rows.
+
+        INPUT
+        gallery = a GalleryArrays object
+        chunk = a list of row numbers
+        hashes = the scorecache.params_hash of each row
+        method = a string defining which alignment method to use
+        scores = a list with a dictionary of the new scores of each row
+        """
+
+        for row, hash_value, new in zip(chunk, hashes, scores):
+            self.cache['misses'] += scorecache.save_scores(
+                gallery, gallery.info[row]['imageId'], hash_value, method,
+                new, set())
+
+    def load_checkpoint(self, path, settings):
+
+        """
+        DESCRIPTION
+        This function reads the checkpoint file, or starts a new run if the
+        file does not exist or its run has finished.
+
+        INPUT
+        path = the checkpoint file
+        settings = a dictionary of the method, matchquality, block and the
+                   gallery change counter
+
+        OUTPUT
+        state = a dictionary of the settings, the imageIds done and the
+                matching pairs found
+        """
+
+        if not os.path.exists(path):
+            return dict(settings, done=[], pairs=[])
+        with open(path) as json_file:
+            state = json.load(json_file)
+        if state.get('finished'):
+            self.stdout.write('%s is finished, starting a new run' % path)
+            return dict(settings, done=[], pairs=[])
+        if state.get('stamp') != settings['stamp']:
+            raise CommandError('FishData has changed since %s was made, remove '
+                               'it to start a new run' % path)
+        for key, value in settings.items():
+            if state.get(key) != value:
+                raise CommandError('%s was made with %s=%s, remove it to start '
+                                   'a new run' % (path, key, state.get(key)))
+        self.stdout.write('resuming %s: %d rows done, %d matches' %
+                          (path, len(state['done']), len(state['pairs'])))
+        return state
+
+    def save_checkpoint(self, path, state):
+
+        """
+        DESCRIPTION
+        This function writes the checkpoint file, replacing the old file in
+        one step so an interrupted save does not lose the progress.
+
+        INPUT
+        path = the checkpoint file
+        state = the dictionary returned by load_checkpoint
+        """
+
+        with open(path + '.tmp', 'w') as json_file:
+            json.dump(state, json_file)
+        os.replace(path + '.tmp', path)
+
+    def save_clusters(self, clusters, dry_run):
+
+        """
+        DESCRIPTION
+        This function sets the baseTag of every image in each cluster (see
+        reidentify.cluster_tag).
+
+        INPUT
+        clusters = a list of lists of imageIds
+        dry_run = True to count the changes without saving them
+
+        OUTPUT
+        updated = the number of rows with a new baseTag
+        """
+
+        updated = 0
+        with transaction.atomic():
+            for cluster in clusters:
+                members = list(FishData.objects.filter(imageId__in=cluster)
+                               .values('imageId', 'date', 'pitTag', 'report',
+                                       'baseTag'))
+                if len(members) == 0:
+                    continue
+                baseTag = reidentify.cluster_tag(members)
+                changed = [x['imageId'] for x in members
+                           if x['baseTag'] != baseTag]
+                updated += len(changed)
+                if not dry_run and len(changed) > 0:
+                    FishData.objects.filter(imageId__in=changed).update(
+                        baseTag=baseTag)
+        #update() does not send the FishData signals, so every process 
+        #(this one too) loads its gallery again
+        if not dry_run and updated > 0:
+            process_gallery.touch()
+        #return
+        return updated
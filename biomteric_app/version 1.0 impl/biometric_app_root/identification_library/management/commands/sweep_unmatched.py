@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Management command which searches the FishData rows added since the last
+run for the uploads which found no match (see sweep.py). It is meant to be
+run on a schedule, for example from cron:
+
+    python manage.py sweep_unmatched --state sweep_unmatched.json
+
+The imageIds seen by the last run are kept in the state file. The first run
+only records the current gallery, as every upload has already been searched
+against it.
+"""
+
+#import python libraries
+import json
+import os
+import time
+
+#import django
+from django.core.management.base import BaseCommand
+
+# import shared modules
+from identification_library.gallery import get_gallery
+from identification_library.sweep import sweep_unmatched
+
+
+class Command(BaseCommand):
+
+    help = 'Search the new FishData rows for the uploads with no match'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--method', default='fish_ransac',
+                            help='alignment method (see fish_fun.align_matrix)')
+        parser.add_argument('--matchquality', type=int, default=12,
+                            help='number of matching spots needed for a match')
+        parser.add_argument('--top', type=int, default=5,
+                            help='number of ranked matches to save')
+        parser.add_argument('--state', default='sweep_unmatched.json',
+                            help='file keeping the imageIds seen by the last run')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        gallery = get_gallery()
+        imageIds = [x['imageId'] for x in gallery.info]
+        if not os.path.exists(options['state']):
+            self.save_state(options['state'], imageIds)
+            self.stdout.write('recorded %d rows, the next run searches the '
+                              'rows added after this one' % len(imageIds))
+            return
+        with open(options['state']) as json_file:
+            seen = set(json.load(json_file)['imageIds'])
+        new_imageIds = [x for x in imageIds if x not in seen]
+        results = sweep_unmatched(gallery, new_imageIds, options['method'],
+                                  options['matchquality'], options['top'])
+        #the rows are only marked as seen once every upload has been searched
+        self.save_state(options['state'], imageIds)
+        self.stdout.write('%d new rows, %d unmatched uploads searched, %d '
+                          'matched in %.1fs' % (len(new_imageIds),
+                                                results['searched'],
+                                                results['matched'],
+                                                time.time() - start))
+
+    def save_state(self, path, imageIds):
+
+        """
+        DESCRIPTION
+        This function writes the state file, replacing the old file in one
+        step.
+
+        INPUT
+        path = the state file
+        imageIds = the imageIds of the gallery rows searched
+        """
+
+        with open(path + '.tmp', 'w') as json_file:
+            json.dump({'imageIds': imageIds}, json_file)
+        os.replace(path + '.tmp', path)
@@ -6,13 +6,23 @@ Created on Fri Mar 29 10:44:52 2019
 #import python libraries
 import numpy
 import cv2
-import math
 import datetime
 import copy
 
+#import optional libraries
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 #import shared libraries
 from . import opencv_fun as opencv_fun
 from . import misc_fun as misc_fun
+from . import ref_fun as ref_fun
+
+
+#number of spot pairs above which compare_patterns uses a KD-tree
+KDTREE_LIMIT = 40000
 
 
 def extract_fish_smart(image):
@@ -288,20 +298,13 @@ def extract_fish_morphometrics(fish, points, angle):
     ref_angle = misc_fun.degrees(ref_1, ref_2)
     #correct the target angle for the angle of the references
     angle_corrected = angle + ref_angle
+    #generate the line point for each interval
+    mid_pts = [misc_fun.point_mid(ref_1, ref_2, dist) for dist in points]
+    #find the points at the specified angle
+    out_pts = opencv_fun.contour_pts_angle(fish, mid_pts, [angle_corrected] * len(mid_pts))
     #set up new contour and stats lists
-    new_stats = []
-    new_contour = [] 
-    #loop through points and find required xy coordinates
-    loop = 0
-    while loop < len(points):
-        #generate line point
-        dist = points[loop]
-        mid_pt = misc_fun.point_mid(ref_1, ref_2, dist)
-        #find point at specified angle
-        out_pt = opencv_fun.contour_pt_angle(fish, mid_pt, angle_corrected)
-        new_contour += [[out_pt]]
-        new_stats += [misc_fun.distance(mid_pt, out_pt)]
-        loop += 1
+    new_contour = [[out_pt] for out_pt in out_pts]
+    new_stats = [misc_fun.distance(mid_pt, out_pt) for mid_pt, out_pt in zip(mid_pts, out_pts)]
     #return
     return numpy.array(new_contour), new_stats 
 
@@ -331,25 +334,24 @@ def ref_tail_across(fish):
     angle_top = misc_fun.degrees_limit_range(fish_angle + 90)
     #initialize width data
     data_width = []    
-    #walk length of fish and generate dictionary of widths
-    for x in range(pos_low[0], pos_high[0]):
-        #calculate proportion
-        proportion = (x-pos_low[0])/float(pos_high[0]-pos_low[0])
-        #get points if within target proportion
-        if 0.7 < proportion < 0.9:
-            #calculate center point
-            center_pos = misc_fun.point_mid(pos_low, pos_high, proportion)
-            #walk out until edge is retched
-            cross_section_points = opencv_fun.contour_crosssection(fish, center_pos, angle_top)          
-            #check if cross-section was found
-            if cross_section_points is not None:
-                #get most distant points from the cross-section
-                points_out = misc_fun.distant_points(cross_section_points)
-                #calculate width
-                width = misc_fun.distance(points_out[0], points_out[1])
-                #add to data
-                data_width += [[proportion, width, center_pos, points_out[0], 
-                                points_out[1]]]   
+    #walk length of fish and get the proportions within the target region
+    proportions = [(x-pos_low[0])/float(pos_high[0]-pos_low[0]) 
+                   for x in range(pos_low[0], pos_high[0])]
+    proportions = [x for x in proportions if 0.7 < x < 0.9]
+    #calculate center points
+    centers = [misc_fun.point_mid(pos_low, pos_high, x) for x in proportions]
+    #find the cross-section at every center point at once
+    cross_sections = opencv_fun.contour_crosssections(fish, centers, angle_top)
+    for proportion, center_pos, cross_section_points in zip(proportions, centers, cross_sections):
+        #check if cross-section was found
+        if cross_section_points is not None:
+            #get most distant points from the cross-section
+            points_out = misc_fun.distant_points(cross_section_points)
+            #calculate width
+            width = misc_fun.distance(points_out[0], points_out[1])
+            #add to data
+            data_width += [[proportion, width, center_pos, points_out[0], 
+                            points_out[1]]]   
     #find narrowest width
     width_min = min([x[1] for x in data_width])  
     #filter to target position
@@ -370,7 +372,8 @@ def ref_tail_fork(fish):
     DESCRIPTION
     This function uses the outline of a snapper or trevally to find the 
     position of the tail fork. This function may work for other similar fish 
-    shapes.
+    shapes. The fork is the middle point of the largest inverted triangle in
+    the profile of the last 20% of the fish (see ref_fun.ref_tail_fork).
     
     INPUT
     fish = a contour in standard opencv format
@@ -379,58 +382,16 @@ def ref_tail_fork(fish):
     tail_fork = the xy coordinates of the tail fork    
     """
 
-    #find center of contour
-    center = opencv_fun.contour_center(fish)    
-    #check or convert fish to a list
-    fish = fish.tolist() 
-    #get minimum and maximum x coordinates for fish
-    pos_1 = min(x[0][0] for x in fish)
-    pos_2 = max(x[0][0] for x in fish)
-    #set tail to last 20% of fish
-    limit = int(pos_1 + ((pos_2 - pos_1)*0.80))
-    #get points from contour which are past the 80% limit
-    fish_tail = []
-    for x in fish:
-        if x[0][0] >= limit:
-            fish_tail += [x]         
-    #get the highest point in the profile as the first tail tip
-    min_x = 1000000
-    for x in range(len(fish_tail)):
-        if fish_tail[x][0][0] < min_x:
-            min_x = fish_tail[x][0][0]
-            min_x_pos = x         
-    #rotate contour so that the min_x_pos is at the start and the end
-    fish_tail = fish_tail[min_x_pos:] + fish_tail[:min_x_pos]
-    #convert contour to profile
-    profile_1 = opencv_fun.contour_to_profile(numpy.array(fish_tail), center)
-    #calculate a reduced density front_fish contour
-    epsilon = 0.065*cv2.arcLength(numpy.array(fish_tail), False)
-    approx = cv2.approxPolyDP(numpy.array(fish_tail), epsilon, False) 
-    #generate contour of reduced density
-    profile_2 = opencv_fun.contour_to_profile(approx, center) 
-    #stretch profile_2 x axis to match the profile_1 range 
-    max_1 = max([x[0] for x in profile_1])
-    max_2 = max([x[0] for x in profile_2])
-    ratio = max_1 / float(max_2)
-    profile_2 = [[x[0] * ratio, x[1]] for x in profile_2] 
-    #save contours et al..
-    fish_tail = [x[0] for x in fish_tail]
-    #find biggest triangle as tail fork
-    triangle = opencv_fun.profile_largest_triangle(profile_1, 10000)
-    #get middle point of triangle as fork_out
-    if triangle is not None:
-        fork_out = fish_tail[triangle[1]]
-    else:
-        fork_out = None
     #return
-    return fork_out
+    return ref_fun.ref_tail_fork(fish)
 
 
 def ref_tail_upper(fish): 
     
     """
     DESCRIPTION
-    This function uses a snapper contour to find the upper tip of the tail.
+    This function uses a snapper contour to find the upper tip of the tail
+    (see ref_fun.ref_tail_upper).
     
     INPUT
     fish = a snapper contour in standard opencv format
@@ -440,22 +401,8 @@ def ref_tail_upper(fish):
     
     """    
     
-    #convert the contour to a list
-    fish = fish.tolist()
-    #    
-    pos_1 = min(x[0][0] for x in fish)
-    pos_2 = max(x[0][0] for x in fish)
-    limit = int(pos_1 + ((pos_2 - pos_1)*0.80))    
-    new_fish = []
-    for x in fish:
-        if x[0][0] >= limit:
-            new_fish += [x]
-    value_1 = min(x[0][1] for x in new_fish)
-    for x in new_fish:
-        if x[0][1] == value_1:
-            ref = x[0]
-            break
-    return ref
+    #return
+    return ref_fun.ref_tail_upper(fish)
 
 
 def ref_fish_lips(fish):
@@ -465,7 +412,7 @@ def ref_fish_lips(fish):
     This function finds the upper and lower lip from a fish contour. The output
     is two xy coordinates representing the upper and lower lip position. If it 
     cannot find two distinct lips then the same xy coordinate is returned for
-    both lips
+    both lips (see ref_fun.ref_fish_lips).
     
     INPUT
     fish = a contour in standard opencv format
@@ -475,66 +422,8 @@ def ref_fish_lips(fish):
     nose_2 = an XY coordinate for the fishes bottom lip
     """
     
-    #find center of contour
-    center = opencv_fun.contour_center(fish)    
-    #select the front 5% of the fish  
-    pos_1 = min(x[0][0] for x in fish)
-    pos_2 = max(x[0][0] for x in fish)
-    limit = int(pos_1 + ((pos_2 - pos_1)*0.05))    
-    front_fish = []
-    for x in fish:
-        if x[0][0] <= limit:
-            front_fish += [x]  
-    #convert contour to profile
-    profile_1 = opencv_fun.contour_to_profile(numpy.array(front_fish), center)
-    #calculate a reduced density front_fish contour
-    epsilon = 0.065*cv2.arcLength(numpy.array(front_fish), False)
-    approx = cv2.approxPolyDP(numpy.array(front_fish), epsilon, False)
-    #generate contour of reduced density
-    profile_2 = opencv_fun.contour_to_profile(approx, center)    
-    #stretch profile_2 x axis to match the profile_1 range 
-    max_1 = max([x[0] for x in profile_1])
-    max_2 = max([x[0] for x in profile_2])
-    ratio = max_1 / float(max_2)
-    profile_2 = [[x[0] * ratio, x[1]] for x in profile_2]   
-    #select nose points from reduced profile
-    if len(profile_2) == 6:
-        nose_1 = profile_2[1]
-        nose_2 = profile_2[4]
-    elif len(profile_2) == 5:
-        nose_1 = profile_2[1]
-        nose_2 = profile_2[3]
-    elif len(profile_2) == 4:
-        nose_1 = profile_2[1]
-        nose_2 = profile_2[2]        
-    elif len(profile_2) == 3:
-        nose_1 = profile_2[1]
-        nose_2 = profile_2[1]
-    else:
-        print('problem fish_fun.ref_fish_lips: %s' % (len(profile_2)))
-        nose_1 = profile_2[1]
-        nose_2 = profile_2[1]
-    #find the related points in the front_fish contour
-    nose_dist_1 = 10000000
-    nose_dist_2 = 10000000
-    loop = 0
-    while loop < len(profile_1):
-        if abs(nose_1[0] - profile_1[loop][0]) < nose_dist_1:
-            nose_dist_1 = abs(nose_1[0] - profile_1[loop][0])
-            nose_out_1 = front_fish[loop][0]
-        if abs(nose_2[0] - profile_1[loop][0]) < nose_dist_2:
-            nose_dist_2 = abs(nose_2[0] - profile_1[loop][0])
-            nose_out_2 = front_fish[loop][0]                  
-        loop += 1
-    #select which nose point is the upper lip
-    if nose_out_1[1] < nose_out_2[1]:
-        nose_1 = nose_out_1.tolist()
-        nose_2 = nose_out_2.tolist()
-    else:
-        nose_1 = nose_out_2.tolist()
-        nose_2 = nose_out_1.tolist()
     #return
-    return nose_1, nose_2
+    return ref_fun.ref_fish_lips(fish)
 
 
 def ref_fish_head(fish, ref_nose, ref_tail):
@@ -543,7 +432,7 @@ def ref_fish_head(fish, ref_nose, ref_tail):
     DESCRIPTION
     This function uses a fish contour and reference points for the upper lip 
     and narrowest cross-section of the tail to generate a third head reference 
-    point. 
+    point (see ref_fun.ref_fish_head).
     
     INPUT
     fish = a contour in standard opencv format
@@ -554,26 +443,8 @@ def ref_fish_head(fish, ref_nose, ref_tail):
     ref = an xy coordinate for the ref point on the top of the fishes head
     """
     
-    #initialize output variable
-    ref_head = None
-    #get angle between ref_1 and ref_3
-    deltaX = ref_tail[0] - ref_nose[0]
-    deltaY = ref_tail[1] - ref_nose[1]
-    angle = math.atan2(deltaY, deltaX)*(180/math.pi)
-    #get starting pos 30% along from ref_1 towards ref_3
-    pos_start = [int(ref_nose[0] + ((ref_tail[0] - ref_nose[0])*0.3)),
-                 int(ref_nose[1] + ((ref_tail[1] - ref_nose[1])*0.3))]
-    #calculate point on fish outline at set angle from pos_start
-    closest = 1000
-    for x in fish:
-        deltaX = pos_start[0] - x[0][0]
-        deltaY = pos_start[1] - x[0][1]
-        test_angle = math.atan2(deltaY, deltaX)*(180/math.pi)
-        if abs(test_angle - (90 + angle)) < closest:
-            closest = abs(test_angle - (90 + angle))
-            ref_head = numpy.ndarray.tolist(x[0])
     #return
-    return ref_head
+    return ref_fun.ref_fish_head(fish, ref_nose, ref_tail)
 
  
 def search_for_pattern(dataset, new_individual, limit, perm, method):
@@ -646,7 +517,14 @@ def align_patterns(ind_1, ind_2, method):
     This function takes the data from two individuals (spots + ref points) and
     aligns the second individual to the same space as the first individual. A
     range of different reference point methods can be used for this alignment
-    including, random, radius, triangle, and fish_ref.
+    including, random, radius, triangle, fish_ref, fish_standard and 
+    fish_ransac. The fish_standard and fish_ransac methods expect both spot 
+    patterns to already be in the standard space generated by 
+    standardize_pattern, so only the secondary alignment is run. fish_ransac 
+    uses the deterministic opencv_fun.ref_affine_ransac instead of the 
+    random radius method, so a single pass gives a stable result. When no 
+    alignment can be found (fish_ransac with fewer than two spots) an empty 
+    pattern is returned, so the pair has no matching spots.
     
     THOUGHT: The initial bounding box positioning in this function should be 
     moved to a separate step in the same way that common_space is used in 
@@ -661,7 +539,41 @@ def align_patterns(ind_1, ind_2, method):
     OUTPUT
     pattern_aligned = the spots from the second individual aligned to the first
     """
-       
+    
+    #get the final transformation matrix and the pattern it applies to
+    matrix, pattern = align_matrix(ind_1, ind_2, method)
+    #no alignment means no matching spots
+    if matrix is None:
+        return []
+    #generate final aligned pattern
+    pattern_aligned = affine_transform(matrix, pattern)
+    #return
+    return pattern_aligned
+
+
+def align_matrix(ind_1, ind_2, method):
+    
+    """
+    DESCRIPTION
+    This function finds the affine matrix used by align_patterns to align the
+    second individual to the first individual. For the radius and fish_ref 
+    methods the spots of the second individual are first moved by a primary
+    alignment, so the pattern the matrix applies to is also returned. Both 
+    are used by align_patterns_batch to align many candidates at once.
+    
+    INPUT
+    ind_1 = data from the first individual (spots + ref points)
+    ind_2 = data from the second individual (spots + ref points)
+    method = a string defining which method to use
+    
+    OUTPUT
+    matrix = the final affine transformation matrix, or None when fish_ransac
+             can not find reference points (fewer than two spots)
+    pattern = the spots of the second individual the matrix applies to
+    """
+    
+    #the pattern which the final matrix is applied to
+    pattern = ind_2['spots']
     if method == 'radius':
         #get ref points based on bounding box
         ref_1 = opencv_fun.ref_bounding(numpy.array(ind_1['spots']))
@@ -673,19 +585,10 @@ def align_patterns(ind_1, ind_2, method):
         #generate affine matrix
         matrix = opencv_fun.affine_matrix(ref_1, ref_2)
         #convert pattern_2 to same position as pattern_1
-        pattern_aligned = []
-        for point in ind_2['spots']:
-            #convert to new position
-            point_new  = opencv_fun.affine_apply(matrix, point)
-            #convert points to integers
-            point_new = [int(x) for x in point_new]
-            #add to pattern_new
-            pattern_aligned += [point_new] 
-        #set ind_2 spots to pattern_new position
-        ind_2['spots'] = pattern_aligned            
+        pattern = affine_transform(matrix, pattern)
         #generate radius based ref points
         ref_1, ref_2 = opencv_fun.ref_affine_radius(ind_1['spots'], 
-                                                    pattern_aligned, 
+                                                    pattern, 
                                                     100, 0.1, 100)
         #generate the third ref point
         ref_1 += [opencv_fun.ref_affine_third(ref_1[0], ref_1[1])] 
@@ -716,16 +619,15 @@ def align_patterns(ind_1, ind_2, method):
         #generate affine matrix
         matrix = opencv_fun.affine_matrix(ref_1, ref_2)       
         #convert pattern_2 to same position as pattern_1
-        pattern_aligned = []
-        for point in ind_2['spots']:
-            #convert to new position
-            point_new  = opencv_fun.affine_apply(matrix, point)
-            #convert points to integers
-            point_new = [int(x) for x in point_new]
-            #add to pattern_new
-            pattern_aligned += [point_new]            
-        #set ind_2 spots to pattern_new position
-        ind_2['spots'] = pattern_aligned       
+        pattern = affine_transform(matrix, pattern)
+        #ref points for secondary alignment using radius method
+        ref_1, ref_2 = opencv_fun.ref_affine_radius(ind_1['spots'], 
+                                                    pattern, 
+                                                    100, 0.1, 100)       
+        #generate the third ref point
+        ref_1 += [opencv_fun.ref_affine_third(ref_1[0], ref_1[1])] 
+        ref_2 += [opencv_fun.ref_affine_third(ref_2[0], ref_2[1])]
+    elif method == 'fish_standard':
         #ref points for secondary alignment using radius method
         ref_1, ref_2 = opencv_fun.ref_affine_radius(ind_1['spots'], 
                                                     ind_2['spots'], 
@@ -733,20 +635,81 @@ def align_patterns(ind_1, ind_2, method):
         #generate the third ref point
         ref_1 += [opencv_fun.ref_affine_third(ref_1[0], ref_1[1])] 
         ref_2 += [opencv_fun.ref_affine_third(ref_2[0], ref_2[1])]
+    elif method == 'fish_ransac':
+        #ref points for secondary alignment using batched RANSAC
+        ref_1, ref_2 = opencv_fun.ref_affine_ransac(ind_1['spots'], 
+                                                    ind_2['spots'], 
+                                                    0.1, 0.99, 1000)       
+        #too few spots to align is treated as no match
+        if ref_1 is None:
+            return None, pattern
+        #generate the third ref point
+        ref_1 += [opencv_fun.ref_affine_third(ref_1[0], ref_1[1])] 
+        ref_2 += [opencv_fun.ref_affine_third(ref_2[0], ref_2[1])]
 
     #generate the final transformation matrix
     matrix = opencv_fun.affine_matrix(ref_1, ref_2)  
-    #generate final aligned pattern
-    pattern_aligned = []
-    for point in ind_2['spots']:
-        #convert to new position
-        point_new  = opencv_fun.affine_apply(matrix, point)
-        #convert points to integers
-        point_new = [int(x) for x in point_new]
-        #add point to pattern
-        pattern_aligned += [point_new]                
     #return
-    return pattern_aligned
+    return matrix, pattern
+
+
+def align_patterns_batch(matrices, spots, offsets):
+    
+    """
+    DESCRIPTION
+    This function applies a separate affine matrix to each pattern in a set of
+    spot patterns in a single vectorized operation. The patterns are passed 
+    as one concatenated array of spots with the start position of each 
+    pattern, so the whole gallery can be aligned in one call. The output 
+    matches affine_apply followed by conversion of each value to int.
+    
+    INPUT
+    matrices = an (N, 2, 3) array with one affine matrix per pattern
+    spots = an (S, 2) array of the concatenated xy coordinates
+    offsets = the start position of each pattern in spots (length N + 1)
+    
+    OUTPUT
+    aligned = an (S, 2) int array of the aligned xy coordinates
+    """
+    
+    #repeat each matrix for every spot in its pattern
+    counts = numpy.diff(numpy.asarray(offsets, numpy.int64))
+    matrix = numpy.repeat(numpy.asarray(matrices, numpy.float64), counts, axis=0)
+    #select the spots covered by the offsets
+    points = numpy.asarray(spots)[offsets[0]:offsets[-1]]
+    x = points[:, 0].astype(numpy.float64)
+    y = points[:, 1].astype(numpy.float64)
+    #generate x and y coordinate
+    new_x = matrix[:, 0, 0] * x + matrix[:, 0, 1] * y + matrix[:, 0, 2]
+    new_y = matrix[:, 1, 0] * x + matrix[:, 1, 1] * y + matrix[:, 1, 2]
+    #convert to integers (truncated towards zero like int())
+    aligned = numpy.stack([new_x, new_y], axis=1).astype(numpy.int64)
+    #return
+    return aligned
+
+
+def affine_transform(matrix, pattern):
+    
+    """
+    DESCRIPTION
+    This function applies an affine matrix to every xy coordinate in a single
+    pattern and converts the new coordinates to integers.
+    
+    INPUT
+    matrix = an affine transformation matrix
+    pattern = a list of xy coordinates
+    
+    OUTPUT
+    pattern_new = a list of xy coordinates
+    """
+    
+    #convert the pattern to an array
+    points = numpy.asarray(pattern).reshape(-1, 2)
+    #align as a batch of one
+    pattern_new = align_patterns_batch(numpy.asarray(matrix)[None], points, 
+                                       [0, len(points)])
+    #return
+    return pattern_new.tolist()
 
 
 def standardize_pattern(pattern_1):
@@ -773,14 +736,7 @@ def standardize_pattern(pattern_1):
     #generate affine matrix
     matrix = opencv_fun.affine_matrix(ref_2, ref_1)       
     #convert pattern_2 to same position as pattern_1
-    pattern_standardized = []
-    for point in pattern_1['spots']:
-        #convert to new position
-        point_new  = opencv_fun.affine_apply(matrix, point)
-        #convert points to integers
-        point_new = [int(x) for x in point_new]
-        #add to pattern_new
-        pattern_standardized += [point_new]     
+    pattern_standardized = affine_transform(matrix, pattern_1['spots'])
     #return
     return pattern_standardized
 
@@ -791,7 +747,11 @@ def compare_patterns(pattern_1, pattern_2):
     DESCRIPTION
     This function finds the matching spots between two patterns and returns a
     list containing the distance for each match + the relative distance to 
-    the next closest match.
+    the next closest match. A spot in pattern_1 is matched to its closest spot
+    in pattern_2 if it is also the closest spot in pattern_1 to that spot.
+    
+    The distances are calculated as a single numpy distance matrix. For large
+    patterns a KD-tree is used instead so the full matrix is not built.
     
     INPUT
     pattern_1 = a list of xy coordinates
@@ -801,28 +761,123 @@ def compare_patterns(pattern_1, pattern_2):
     dist_list = a list containing distances for each spot in pattern_1
     """ 
     
-    #init an empty dist_list
-    dist_list = []
-    #loop through each spot in pattern_1
-    for spot in pattern_1:
-        #calculate distances to spots in pattern_2
-        dist = [misc_fun.distance(spot, x) for x in pattern_2]
-        #get minimum dist
-        dist_min = min(dist)
-        #get position of closest spot
-        closest = dist.index(min(dist))
-        #calculate distances from closest spot to pattern_1
-        dist_2 = [misc_fun.distance(pattern_2[closest], x) for x in pattern_1]
-        #get minimum dist_2
-        dist_min_2 = min(dist_2)
-        if dist_min == dist_min_2:
-            #sort distance
-            dist.sort()
-            #add to count if passed limit
-            if dist[0] == 0:
-                dist_list += [[dist_min, 0]]
-            else:
-                dist_list += [[dist_min, dist[0]/float(dist[1])]]
+    #convert the patterns to float arrays
+    points_1 = numpy.asarray(pattern_1, numpy.float64).reshape(-1, 2)
+    points_2 = numpy.asarray(pattern_2, numpy.float64).reshape(-1, 2)
+    #no matches can be made with an empty pattern
+    if len(points_1) == 0 or len(points_2) == 0:
+        return []
+    #select the distance method based on the size of the patterns
+    if cKDTree is not None and len(points_1) * len(points_2) > KDTREE_LIMIT:
+        dist_min, dist_next, mutual = compare_patterns_kdtree(points_1, points_2)
+    else:
+        dist_min, dist_next, mutual = compare_patterns_matrix(points_1, points_2)
+    #calculate the ratio to the next closest spot
+    dist_min = dist_min[mutual]
+    dist_next = dist_next[mutual]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        ratio = numpy.where(dist_min == 0, 0.0, dist_min / dist_next)
+    #return
+    return [[x, y] for x, y in zip(dist_min.tolist(), ratio.tolist())]
+
+
+def pattern_distance(points_1, points_2):
+
+    """
+    DESCRIPTION
+    This function calculates the distance between two arrays of xy coordinates
+    using the same operations as misc_fun.distance, so the values are 
+    identical to the pure python version.
+
+    INPUT
+    points_1 = an (n, 2) float array
+    points_2 = an (n, 2) float array (or broadcastable to points_1)
+
+    OUTPUT
+    dist = an array of distances
+    """
+
+    #calculate the difference in each dimension
+    dx = points_1[..., 0] - points_2[..., 0]
+    dy = points_1[..., 1] - points_2[..., 1]
+    #return
+    return numpy.sqrt(dx*dx + dy*dy)
+
+
+def compare_patterns_matrix(points_1, points_2):
+
+    """
+    DESCRIPTION
+    This function runs the compare_patterns search using a full distance 
+    matrix between the two patterns.
+
+    INPUT
+    points_1 = an (n, 2) float array
+    points_2 = an (m, 2) float array
+
+    OUTPUT
+    dist_min = the distance from each point_1 to its closest point_2
+    dist_next = the distance to the second closest point_2 (nan if none)
+    mutual = boolean array, True if point_1 is closest to its closest point_2
+    """
+
+    #calculate the distance matrix between the patterns
+    dist = pattern_distance(points_1[:, None, :], points_2[None, :, :])
+    #get the closest spot in pattern_2 for each spot in pattern_1
+    closest = numpy.argmin(dist, axis=1)
+    dist_min = dist[numpy.arange(len(points_1)), closest]
+    #get the next closest distance
+    if len(points_2) > 1:
+        dist_next = numpy.partition(dist, 1, axis=1)[:, 1]
+    else:
+        dist_next = numpy.full(len(points_1), numpy.nan)
+    #check the closest spot in pattern_2 has the same distance back
+    mutual = dist_min == dist.min(axis=0)[closest]
+    #return
+    return dist_min, dist_next, mutual
+
+
+def compare_patterns_kdtree(points_1, points_2):
+
+    """
+    DESCRIPTION
+    This function runs the compare_patterns search using KD-trees, which is 
+    faster than the distance matrix for patterns with many spots. Distances 
+    are recalculated from the tree indices so they are identical to the 
+    matrix version and ties are resolved to the lowest index.
+
+    INPUT
+    points_1 = an (n, 2) float array
+    points_2 = an (m, 2) float array
+
+    OUTPUT
+    dist_min = the distance from each point_1 to its closest point_2
+    dist_next = the distance to the second closest point_2 (nan if none)
+    mutual = boolean array, True if point_1 is closest to its closest point_2
+    """
+
+    #build a tree for each pattern
+    tree_1 = cKDTree(points_1)
+    tree_2 = cKDTree(points_2)
+    #get the two closest spots in pattern_2 for each spot in pattern_1
+    neighbours = min(2, len(points_2))
+    tree_dist, closest = tree_2.query(points_1, k=neighbours)
+    closest = closest.reshape(len(points_1), neighbours)
+    dist_min = pattern_distance(points_1, points_2[closest[:, 0]])
+    if neighbours > 1:
+        dist_next = pattern_distance(points_1, points_2[closest[:, 1]])
+        #resolve tied closest spots to the lowest index in pattern_2
+        for x in numpy.nonzero(dist_min == dist_next)[0]:
+            ties = tree_2.query_ball_point(points_1[x], dist_min[x] + 1e-6)
+            ties = [y for y in ties 
+                    if pattern_distance(points_1[x], points_2[y]) == dist_min[x]]
+            closest[x, 0] = min(ties)
+    else:
+        dist_next = numpy.full(len(points_1), numpy.nan)
+    #get the closest distance back to pattern_1 for each spot in pattern_2
+    tree_dist, closest_back = tree_1.query(points_2[closest[:, 0]], k=1)
+    dist_back = pattern_distance(points_2[closest[:, 0]], points_1[closest_back])
+    #check the closest spot in pattern_2 has the same distance back
+    mutual = dist_min == dist_back
     #return
-    return dist_list    
- 
\ No newline at end of file
+    return dist_min, dist_next, mutual
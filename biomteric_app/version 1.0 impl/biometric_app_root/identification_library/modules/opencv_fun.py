@@ -8,6 +8,7 @@ Created on Thu May 17 13:24:08 2018
 import cv2
 import numpy
 import math
+import itertools
 import statistics
 import random
 
@@ -16,6 +17,11 @@ import random
 from . import misc_fun as misc_fun
 
 
+# limit on the number of spot distances held at once when scoring the 
+# hypotheses of ref_affine_ransac (8 bytes each)
+RANSAC_DISTANCES = 2**20
+
+
 def contour_crosssection(contour, position, angle_cross_1):
     
     """
@@ -33,44 +39,63 @@ def contour_crosssection(contour, position, angle_cross_1):
     postion_out = xy coordinates of the outer edge
     """ 
     
+    #return
+    return contour_crosssections(contour, [position], angle_cross_1)[0]
+
+
+def contour_crosssections(contour, positions, angle_cross_1):
+    
+    """
+    DESCRIPTION
+    This function runs contour_crosssection for a list of starting positions
+    at once. For each position the contour segments which are less than 20 
+    degrees wide (seen from the position) and contain either cross-section 
+    angle are selected, and the two most distant start points of these 
+    segments are returned. The angles to every contour point are calculated
+    for all positions in one step, and ties between equally distant pairs are
+    resolved in the same order as the pairwise loop of contour_crosssection.
+    
+    INPUT
+    contour = a contour in standard opencv format
+    positions = a list of xy coordinates of the starting positions
+    angle_cross_1 = the angle (degrees) at which to find the edge
+    
+    OUTPUT
+    positions_out = a list with the two xy coordinates of the edges for each
+                    position, or None if they were not found
+    """ 
+    
     #generate the alternate angle for the cross-section
     angle_cross_2 = misc_fun.degrees_limit_range(angle_cross_1 + 180)  
-    #initialize position_out
-    position_out = None    
-    #initialize empty data dictionary
-    data = []
-    #get set of points either side
-    for x in range(0, len(contour)-1):
-        #calculate angle to each position
-        angle_1 = misc_fun.degrees(position, contour[x][0])
-        angle_2 = misc_fun.degrees(position, contour[x+1][0])
-        #search for target angle if 20 degree region is found
-        if abs(angle_1 - angle_2) < 20:
-            #create aa angle list
-            angle_list = [angle_1, angle_2]
-            #sort the angle list
-            angle_list.sort()
-            #check if either angle_cross is within the region
-            if angle_list[0] <= angle_cross_1 <= angle_list[1]:
-                data += [[contour[x][0], contour[x+1][0]]]
-            if angle_list[0] <= angle_cross_2 <= angle_list[1]:
-                data += [[contour[x][0], contour[x+1][0]]]
-                
-    #set empty output points
-    position_out = None
-    distance_max = 0
-    #check if position_out is already found
-    if len(data) > 1:
-        #get two most distant points
-        for x in data:
-            for y in data:
-                if misc_fun.distance(x[0], y[0]) >= distance_max:
-                    #update max distance
-                    distance_max = misc_fun.distance(x[0], y[0])
-                    #set as output points
-                    position_out = [x[0], y[0]]  
+    #calculate the angle from each position to each contour point
+    points = numpy.asarray(contour).reshape(-1, 2)
+    positions = numpy.asarray(positions, numpy.float64).reshape(-1, 2)
+    angles = numpy.degrees(numpy.arctan2(points[None, :, 1] - positions[:, None, 1],
+                                         points[None, :, 0] - positions[:, None, 0])) + 180
+    #get the angle range of each segment between two contour points
+    angle_low = numpy.minimum(angles[:, :-1], angles[:, 1:])
+    angle_high = numpy.maximum(angles[:, :-1], angles[:, 1:])
+    region = numpy.abs(angles[:, :-1] - angles[:, 1:]) < 20
+    #check if either angle_cross is within the region
+    cross_1 = region & (angle_low <= angle_cross_1) & (angle_cross_1 <= angle_high)
+    cross_2 = region & (angle_low <= angle_cross_2) & (angle_cross_2 <= angle_high)
+    counts = cross_1.astype(int) + cross_2.astype(int)
+    #loop through the positions and get the two most distant points
+    positions_out = []
+    for count in counts:
+        #segments crossing both angles are added twice
+        data = numpy.repeat(numpy.arange(len(count)), count)
+        if len(data) < 2:
+            positions_out += [None]
+            continue
+        data_points = points[data].astype(numpy.float64)
+        difference = data_points[:, None, :] - data_points[None, :, :]
+        distance = numpy.sqrt(difference[:, :, 0]**2 + difference[:, :, 1]**2)
+        #the last pair at the maximum distance is kept
+        x, y = divmod(numpy.flatnonzero(distance == distance.max())[-1], len(data))
+        positions_out += [[points[data[x]], points[data[y]]]]
     #return 
-    return position_out
+    return positions_out
 
 
 def contour_mask_image(image, contour):
@@ -545,7 +570,7 @@ def contour_pt_angle(contour, pos, angle):
     DESCRIPTION
     This function finds the edge of a contour at a specified angle from a 
     specified starting point. If it fails to find the edge of the contour then
-    it returns None.
+    it returns None. See contour_pts_angle to find several edges at once.
     
     INPUT
     contour = a contour in standard opencv format
@@ -556,19 +581,55 @@ def contour_pt_angle(contour, pos, angle):
     out = the target xy coordinate  
     """
     
-    #init an empty output variable
-    out = None
-    #generate a black image with the contour drawn in white
-    img = numpy.zeros((5000,5000,3), numpy.uint8)
-    cv2.drawContours(img, [contour], -1, (255,255,255), -1)
-    #loop through distances until edge of contour is found
-    for x in range(5, 1000):
-        #generate the xy coordinate
-        new_pt = misc_fun.point_distance(pos, x, angle + 180)
-        #check if it has moved outside the contour
-        if img[new_pt[1]][new_pt[0]][0] == 0:
-            out = new_pt
-            break
+    #return
+    return contour_pts_angle(contour, [pos], [angle])[0]
+
+
+def contour_pts_angle(contour, positions, angles): 
+    
+    """
+    DESCRIPTION
+    This function finds the edge of a contour for a list of starting points 
+    and angles. Each search steps away from its starting point (from 5 to 999
+    pixels) at angle + 180 degrees and returns the first whole pixel step 
+    outside the filled contour. The contour is drawn once, only inside its
+    bounding box (see contours_canvas), and every step of a search is 
+    checked in one numpy step, which gives the same points as walking a 
+    5000x5000 image of the contour. If no edge is found None is returned.
+    
+    INPUT
+    contour = a contour in standard opencv format
+    positions = a list of starting xy coordinates
+    angles = a list with the angle of each search
+    
+    OUTPUT
+    out = a list with the target xy coordinate of each search (or None)
+    """
+    
+    #draw the filled contour into an image of its bounding box
+    blank, shifted, low = contours_canvas([contour], 1, 1)
+    cv2.drawContours(blank, shifted, -1, 255, -1)
+    #the distance of every step from the starting point
+    steps = numpy.arange(5, 1000, dtype=numpy.float64)
+    out = []
+    for position, angle in zip(positions, angles):
+        #generate the xy coordinate of every step as misc_fun.point_distance
+        radians = math.radians(angle + 180)
+        x = (position[0] + steps*math.cos(radians)).astype(numpy.int64)
+        y = (position[1] + steps*math.sin(radians)).astype(numpy.int64)
+        #check which steps are on the contour, the image only covers the contour
+        x_image = x - low[0]
+        y_image = y - low[1]
+        within = ((x_image >= 0) & (x_image < blank.shape[1]) & 
+                  (y_image >= 0) & (y_image < blank.shape[0]))
+        drawn = numpy.zeros(len(steps), bool)
+        drawn[within] = blank[y_image[within], x_image[within]] > 0
+        #take the first step outside the contour
+        outside = numpy.flatnonzero(~drawn)
+        if len(outside) == 0:
+            out += [None]
+        else:
+            out += [[int(x[outside[0]]), int(y[outside[0]])]]
     #return
     return out
 
@@ -725,32 +786,67 @@ def contour_ROI(image, contour):
     return image_ROI
   
 
-def contours_overlap(contour_1, contour_2):
+def contours_canvas(contours, pad, scale):
+    
+    """
+    DESCRIPTION
+    This function generates a blank image which only covers the bounding box
+    of a list of contours and moves the contours into it, so they can be 
+    drawn without allocating an image the size of the whole photo.
+    
+    INPUT
+    contours = a contour list in standard opencv format
+    pad = the number of pixels to add around the bounding box
+    scale = the scale at which to draw the contours (1 = full resolution)
+    
+    OUTPUT
+    blank = a greyscale image of zeros
+    shifted = the contours moved (and scaled) into the image
+    offset = the xy coordinate of the image origin in the scaled contour space
+    """
+    
+    #find the bounding box of all contours
+    points = numpy.concatenate([numpy.asarray(x).reshape(-1, 2) for x in contours])
+    low = numpy.floor(points.min(axis=0) * scale).astype(numpy.int32) - pad
+    high = numpy.ceil(points.max(axis=0) * scale).astype(numpy.int32) + pad
+    #generate the image and move the contours into it
+    blank = numpy.zeros((high[1] - low[1] + 1, high[0] - low[0] + 1), numpy.uint8)
+    shifted = [(numpy.round(numpy.asarray(x).reshape(-1, 1, 2) * scale)
+                .astype(numpy.int32) - low) for x in contours]
+    #return
+    return blank, shifted, low
+
+
+def contours_overlap(contour_1, contour_2, scale=1):
     
     """
     DESCRIPTION
     This function calculates proportion of two contours that are not overlaping
     relative to the area of each contour. It returns the average of the two 
     values. The closer this number is to zero the better the overlapp between
-    the two contours. If it fails it returns None.
+    the two contours. If it fails it returns None. The contours are only drawn
+    into their bounding box (see contours_canvas), which gives the same result
+    as drawing them at their position in the image. A scale below 1 draws 
+    them at a reduced resolution, which is faster but approximate.
     
     INPUT
     contour1 = a contour in standard opencv format
     contour2 = a contour in standard opencv format
+    scale = the scale at which to draw the contours (1 = full resolution)
     
     OUTPUT
     output = the proportion of the contours not overlapping
     """
     
-    #generate picture of overlap for each version
-    blank1 = numpy.zeros((5000,5000,1), numpy.uint8)
-    cv2.drawContours(blank1, [contour_1], 0, (255), -1)
-    cv2.drawContours(blank1, [contour_2], 0, (0), -1)
-    beyond_1 = cv2.countNonZero(blank1)
-    blank2 = numpy.zeros((5000,5000,1), numpy.uint8)
-    cv2.drawContours(blank2, [contour_2], 0, (255), -1)
-    cv2.drawContours(blank2, [contour_1], 0, (0), -1)
-    beyond_2 = cv2.countNonZero(blank2)
+    #generate picture of each contour in their bounding box
+    blank, (shifted_1, shifted_2) = contours_canvas([contour_1, contour_2], 0, scale)[:2]
+    blank1 = blank.copy()
+    cv2.drawContours(blank1, [shifted_1], 0, (255), -1)
+    blank2 = blank
+    cv2.drawContours(blank2, [shifted_2], 0, (255), -1)
+    #count the pixels of each contour outside the other
+    beyond_1 = cv2.countNonZero(cv2.subtract(blank1, blank2)) / float(scale * scale)
+    beyond_2 = cv2.countNonZero(cv2.subtract(blank2, blank1)) / float(scale * scale)
 
     #calculate area of the contours
     area_1 = cv2.contourArea(contour_1)
@@ -1003,18 +1099,11 @@ def morph_bounding_dist(contour, points, angle):
     ref_2 = contour_pt_angle(contour, center, ref_angle-180)   
     #correct the target angle using the reference angle
     angle_corrected = angle + ref_angle
-    #set up new contour and stats lists
-    new_contour = [] 
-    #loop through points and find required xy coordinates
-    loop = 0
-    while loop < len(points):
-        #generate line point
-        dist = points[loop]
-        mid_pt = misc_fun.point_mid(ref_1, ref_2, dist)
-        #find point at specified angle
-        out_pt = contour_pt_angle(contour, mid_pt, angle_corrected)
-        new_contour += [[out_pt]]
-        loop += 1
+    #generate the line point for each proportion
+    mid_pts = [misc_fun.point_mid(ref_1, ref_2, dist) for dist in points]
+    #find the points at the specified angle
+    out_pts = contour_pts_angle(contour, mid_pts, [angle_corrected] * len(mid_pts))
+    new_contour = [[out_pt] for out_pt in out_pts]
     #return
     return numpy.array(new_contour)
 
@@ -1035,22 +1124,17 @@ def morph_bounding_radial(contour, angles):
     new_contour = a standard opencv contour which contains the xy morphometric points
     """
 
-    #initiate empty output list
-    new_contour = []
     #get the contour center
     center = contour_center(contour)    
     #generate the two reference points
     ref_1B, ref_2B, ref_3B = ref_bounding(contour)
     #get the angle
     ref_angle = misc_fun.degrees(ref_1B, ref_2B)
-    #loop through all angles and generate points
-    for pos in angles:
-        #generate corrected angles
-        angle_corrected = pos + ref_angle
-        #get point
-        point = contour_pt_angle(contour, center, angle_corrected)
-        #add to output data
-        new_contour += [[point]]
+    #generate corrected angles
+    angles_corrected = [pos + ref_angle for pos in angles]
+    #get the points for all angles
+    points = contour_pts_angle(contour, [center] * len(angles), angles_corrected)
+    new_contour = [[point] for point in points]
     #return
     return numpy.array(new_contour)
 
@@ -1209,6 +1293,154 @@ def ref_affine_radius(pattern_1, pattern_2, perm, radius_drop_off, match_attempt
     return points_1, points_2
 
 
+def ref_affine_ransac(pattern_1, pattern_2, radius_drop_off, confidence, 
+                      max_hypotheses, batch_size = 128, seed = 0):
+    
+    """
+    DESCRIPTION
+    This function finds two points to use as affine transformation references
+    for two patterns which are already roughly aligned (eg. in standard 
+    space). It is a batched RANSAC version of ref_affine_radius. Two point 
+    hypotheses are generated as arrays, each point in pattern_1 being paired
+    with a random point of pattern_2 within the radius (or the closest point
+    if none are inside the radius). Every hypothesis in a batch is scored at
+    once by the number of spots that compare_patterns would count as a match
+    (ratio < 0.15) after the similarity transform defined by the two pairs 
+    (see ransac_scores). A batch is scored a few hypotheses at a time so no 
+    more than RANSAC_DISTANCES distances are held at once, whatever the 
+    number of spots.
+    
+    Sampling stops once enough hypotheses have been tried to find an all 
+    inlier pair with the given confidence, using the best inlier ratio w 
+    found so far: N = log(1 - confidence) / log(1 - w^2). The random 
+    generator is seeded, so the same two patterns always give the same 
+    reference points. If no valid hypothesis is found two random points of 
+    pattern_1 are paired with their closest points in pattern_2, drawn from
+    the same seeded generator.
+    
+    INPUT
+    pattern_1 = the first set of xy coordinates
+    pattern_2 = the second set of xy coordinates
+    radius_drop_off = the search radius as a ratio of the pattern_1 length
+    confidence = the probability of having sampled an all inlier pair
+    max_hypotheses = the maximum number of hypotheses to score
+    batch_size = the number of hypotheses scored in each batch
+    seed = the seed for the random generator
+    
+    OUTPUT
+    points_1 = the reference points for pattern_1, or None if either pattern
+               has fewer than two spots
+    points_2 = the reference points for pattern_2, or None
+    """
+    
+    points_1 = numpy.asarray(pattern_1, numpy.float64).reshape(-1, 2)
+    points_2 = numpy.asarray(pattern_2, numpy.float64).reshape(-1, 2)
+    n = len(points_1)
+    m = len(points_2)
+    #two points are needed in each pattern to build a hypothesis
+    if n < 2 or m < 2:
+        return None, None
+    #get length of pattern_1 along longest axis
+    ref = ref_bounding(numpy.array(pattern_1))
+    dist_max = misc_fun.distance(ref[0], ref[2])
+    #the points of pattern_2 within the radius of each point in pattern_1
+    dist = numpy.sqrt(((points_1[:, None, :] - points_2[None, :, :])**2).sum(axis=2))
+    inside = dist < radius_drop_off * dist_max
+    closest = dist.argmin(axis=1)
+    #use complex numbers so a similarity transform is a multiply and add
+    complex_1 = points_1[:, 0] + 1j * points_1[:, 1]
+    complex_2 = points_2[:, 0] + 1j * points_2[:, 1]
+    
+    random_state = numpy.random.RandomState(seed)
+    best_score = -1
+    best_pos = None
+    tried = 0
+    needed = max_hypotheses
+    while tried < min(needed, max_hypotheses):
+        size = int(min(batch_size, max_hypotheses - tried))
+        #select two different random points in pattern_1
+        pos_a = random_state.randint(0, n, size)
+        pos_b = (pos_a + random_state.randint(1, n, size)) % n
+        #pair each with a random point of pattern_2 inside the radius
+        match_a = numpy.where(inside[pos_a], random_state.random_sample((size, m)), -1).argmax(axis=1)
+        match_a = numpy.where(inside[pos_a].any(axis=1), match_a, closest[pos_a])
+        match_b = numpy.where(inside[pos_b], random_state.random_sample((size, m)), -1).argmax(axis=1)
+        match_b = numpy.where(inside[pos_b].any(axis=1), match_b, closest[pos_b])
+        #a ref point can not be selected twice
+        valid = ((complex_1[pos_a] != complex_1[pos_b]) & 
+                 (complex_2[match_a] != complex_2[match_b]))
+        tried += size
+        if not valid.any():
+            continue
+        pos_a, pos_b = pos_a[valid], pos_b[valid]
+        match_a, match_b = match_a[valid], match_b[valid]
+        #similarity transform moving the pattern_2 pair onto the pattern_1 pair
+        scale = (complex_1[pos_b] - complex_1[pos_a]) / (complex_2[match_b] - complex_2[match_a])
+        shift = complex_1[pos_a] - scale * complex_2[match_a]
+        #score a few hypotheses at a time so the distances fit in the limit
+        chunk = max(1, RANSAC_DISTANCES // (n * m))
+        scores = numpy.concatenate([
+            ransac_scores(complex_1, complex_2, scale[x:x + chunk], shift[x:x + chunk])
+            for x in range(0, len(scale), chunk)])
+        #keep the best hypothesis (first one on ties)
+        best = int(scores.argmax())
+        if scores[best] > best_score:
+            best_score = scores[best]
+            best_pos = [pos_a[best], pos_b[best], match_a[best], match_b[best]]
+        #update the number of hypotheses needed from the inlier ratio
+        ratio = min(best_score / float(n), 1.0)
+        if ratio >= 1:
+            needed = 0
+        elif ratio > 0:
+            needed = math.log(1 - confidence) / math.log(1 - ratio**2)
+    
+    #fall back to the closest points if no valid hypothesis was found
+    if best_pos is None:
+        pos_a, pos_b = random_state.choice(n, 2, replace=False)
+        best_pos = [pos_a, pos_b, closest[pos_a], closest[pos_b]]
+    #get xy coordinates for both sets of points
+    points_1 = [list(pattern_1[best_pos[0]]), list(pattern_1[best_pos[1]])]
+    points_2 = [list(pattern_2[best_pos[2]]), list(pattern_2[best_pos[3]])]
+    #return
+    return points_1, points_2
+
+
+def ransac_scores(complex_1, complex_2, scale, shift):
+    
+    """
+    DESCRIPTION
+    This function scores a set of ref_affine_ransac hypotheses by the number 
+    of spots that compare_patterns would count as a match (ratio < 0.15). The
+    distances of every hypothesis are held at once, len(scale) x n x m values.
+    
+    INPUT
+    complex_1 = the points of pattern_1 as complex numbers
+    complex_2 = the points of pattern_2 as complex numbers
+    scale = the complex scale of each hypothesis
+    shift = the complex shift of each hypothesis
+    
+    OUTPUT
+    scores = a numpy array with the number of matching spots of each hypothesis
+    """
+    
+    n = len(complex_1)
+    moved = scale[:, None] * complex_2[None, :] + shift[:, None]
+    #distance from each pattern_1 spot to each moved pattern_2 spot
+    moved_dist = numpy.abs(complex_1[None, :, None] - moved[:, None, :])
+    #score as compare_patterns, counting mutual matches with ratio < 0.15
+    nearest = moved_dist.argmin(axis=2)
+    if len(complex_2) > 1:
+        two = numpy.partition(moved_dist, 1, axis=2)
+        dist_min, dist_next = two[:, :, 0], two[:, :, 1]
+    else:
+        dist_min, dist_next = moved_dist[:, :, 0], numpy.full(moved_dist.shape[:2], numpy.nan)
+    mutual = numpy.take_along_axis(moved_dist.argmin(axis=1), nearest, axis=1) == numpy.arange(n)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        matched = (dist_min == 0) | (dist_min / dist_next < 0.15)
+    #return
+    return (matched & mutual).sum(axis=1)
+
+
 def ref_affine_triangle(pattern_1, pattern_2, perm, dist_dif):
     
     """
@@ -1437,10 +1669,13 @@ def filter_contours_cluster(contours, size, number):
     contours_out = a contour list in standard opencv format
     """
     
-    #initialize a background image
-    blank1 = numpy.zeros((2000,2000,1), numpy.uint8)  
+    #nothing to filter without contours
+    if len(contours) == 0:
+        return []
+    #initialize a background image around the contours with room for dilation
+    blank1, shifted, offset = contours_canvas(contours, size * number + 1, 1)
     #draw contours onto image in white
-    cv2.drawContours(blank1, contours, -1, 255, -1)
+    cv2.drawContours(blank1, shifted, -1, 255, -1)
     #dilate contours to a target level which overlaps the cluster
     kernel = numpy.ones((size,size), numpy.uint8)
     dilation = cv2.dilate(blank1, kernel, iterations = number)
@@ -1452,8 +1687,8 @@ def filter_contours_cluster(contours, size, number):
         cluster_max = max([cv2.contourArea(x) for x in clusters])
     else:
         cluster_max = 0
-    #filter contours to get the largest cluster
-    cluster = [x for x in clusters if cv2.contourArea(x) == cluster_max]
+    #filter contours to get the largest cluster and move it back to the image
+    cluster = [x + offset for x in clusters if cv2.contourArea(x) == cluster_max]
     #filter out any contours which are not found inside the cluster
     contours_out = []
     for contour in contours:
@@ -1635,25 +1870,24 @@ def contour_to_profile(contour, ref_point):
     ref_point = the position to use as the center of the profile 
     
     OUTPUT
-    profile = a linear profile of the contour [[x,y],[x,y],[x,y]]    
-    """
-    
-    #init empty list for profile
-    profile = []
-    #init distance around variable
-    around = 0
-    #convert xy points of the contour to a linear profile
-    loop = 0
-    while loop  < len(contour):
-        #calculate distance to center
-        value = misc_fun.distance(ref_point, contour[loop][0])
-        #update distance around
-        around = cv2.arcLength(contour[:loop+1], False)
-        #update profile
-        profile += [[around, value]]
-        loop += 1     
+    profile = a linear profile of the contour as an (n, 2) numpy array     
+    """
+    
+    #get the xy points of the contour
+    points = numpy.asarray(contour, numpy.float64).reshape(-1, 2)
+    #calculate distance around the contour from the cumulative segment lengths,
+    #single precision segments added in double precision as cv2.arcLength does
+    segments = numpy.diff(points, axis=0).astype(numpy.float32)
+    around = numpy.zeros(len(points))
+    around[1:] = numpy.cumsum(numpy.sqrt(segments[:, 0]*segments[:, 0] + 
+                                         segments[:, 1]*segments[:, 1]), 
+                              dtype=numpy.float64)
+    #calculate distance to center as misc_fun.distance
+    dx = points[:, 0] - float(ref_point[0])
+    dy = points[:, 1] - float(ref_point[1])
+    value = numpy.sqrt(dx*dx + dy*dy)
     #return
-    return profile
+    return numpy.stack([around, value], axis=1)
 
 
 def circle_radius(contour, radius, points):
@@ -1705,25 +1939,29 @@ def profile_largest_triangle(profile, permutations):
     best_triangle = a contour in standard opencv format
     """
 
-    #set up empty best_tri
-    best_triangle = None
-    best_size = 0
-    #run for a set number of permutations
-    for x in range(permutations):
-        #select three points
-        pos = numpy.random.choice(len(profile), 3, replace = False)
-        #sort positions based on x axis
-        pos = numpy.sort(pos)
-        #skip triangles with center point at top
-        if profile[pos[0]][1] > profile[pos[1]][1]:
-            if profile[pos[2]][1] > profile[pos[1]][1]:   
-                #get triangle
-                triangle = numpy.array([[profile[pos[0]]], [profile[pos[1]]], [profile[pos[2]]]]).astype(int)                
-                #get area
-                area = cv2.contourArea(numpy.array(triangle))
-                if area > best_size:
-                    best_triangle = pos
-                    best_size = area
+    #check profile is a numpy array
+    profile = numpy.asarray(profile)
+    if len(profile) < 3:
+        return None
+    #select three different points for each permutation and sort them along 
+    #the x axis
+    pos = numpy.array([numpy.random.choice(len(profile), 3, replace = False)
+                       for x in range(permutations)]).reshape(-1, 3)
+    pos = numpy.sort(pos, axis=1)
+    #skip triangles with center point at top
+    y = profile[:, 1][pos]
+    pos = pos[(y[:, 0] > y[:, 1]) & (y[:, 2] > y[:, 1])]
+    if len(pos) == 0:
+        return None
+    #get area of each triangle in whole pixels
+    triangle = profile[pos].astype(int)
+    area = numpy.abs((triangle[:, 1, 0] - triangle[:, 0, 0]) * (triangle[:, 2, 1] - triangle[:, 0, 1]) -
+                     (triangle[:, 2, 0] - triangle[:, 0, 0]) * (triangle[:, 1, 1] - triangle[:, 0, 1])) / 2.0
+    #select the largest triangle
+    best = numpy.argmax(area)
+    if area[best] <= 0:
+        return None
+    best_triangle = pos[best]
     #return
     return best_triangle
 
@@ -1804,6 +2042,88 @@ def pattern_spacing_closest(pattern):
     return average, stdv 
 
 
+def pattern_triangle_keys(pattern, neighbours, ratio_bins, angle_bins, cell_size, 
+                          expand = False):
+
+    """
+    DESCRIPTION
+    This function generates the geometric hash keys for a pattern of xy 
+    points. A triangle is built from each point and every pair of its closest
+    neighbours. The triangle is described by the lengths of its two shorter 
+    sides over the length of its longest side, the angle of its longest side
+    (0 to 180 degrees) and the cell of its center in a coarse grid. The 
+    patterns are expected to be in standard space (see 
+    fish_fun.standardize_pattern), so the angle and the cell place the 
+    triangle on the fish, while the side ratios do not change with small 
+    differences in scale. The five values are quantized into bins and 
+    combined into a single integer key.
+    
+    When expand is True each triangle also generates the keys of all the 
+    neighbouring bins (the angle wraps around at 180 degrees), so a query 
+    still finds triangles whose values have moved slightly across a bin edge.
+    
+    INPUT
+    pattern = a set of xy coordinates in a list or array
+    neighbours = the number of closest points used to build triangles
+    ratio_bins = the number of bins for each side ratio (0 to 1)
+    angle_bins = the number of bins for the angle of the longest side
+    cell_size = the size of each grid cell in pixels
+    expand = include the neighbouring bins of each key
+    
+    OUTPUT
+    keys = a sorted int64 numpy array of the unique keys for the pattern
+    """       
+    
+    points = numpy.asarray(pattern, numpy.float64).reshape(-1, 2)
+    #at least three points are needed for a triangle
+    if len(points) < 3:
+        return numpy.zeros(0, numpy.int64)
+    #find the closest neighbours of each point
+    dist = numpy.sqrt(((points[:, None, :] - points[None, :, :])**2).sum(axis=2))
+    number = min(neighbours, len(points) - 1)
+    closest = numpy.argsort(dist, axis=1, kind='stable')[:, 1:number + 1]
+    #build a triangle for each point and pair of its neighbours
+    pairs = numpy.array(list(itertools.combinations(range(number), 2)))
+    corners = numpy.stack([numpy.repeat(numpy.arange(len(points)), len(pairs)),
+                           closest[:, pairs[:, 0]].ravel(), 
+                           closest[:, pairs[:, 1]].ravel()], axis=1)
+    #the side opposite each corner, sorted by length
+    opposite = numpy.array([[1, 2], [0, 2], [0, 1]])
+    sides = dist[corners[:, opposite[:, 0]], corners[:, opposite[:, 1]]]
+    order = numpy.argsort(sides, axis=1, kind='stable')
+    sides = numpy.take_along_axis(sides, order, axis=1)
+    #skip the triangles with two points in the same place
+    keep = sides[:, 0] > 0
+    corners, sides, order = corners[keep], sides[keep], order[keep]
+    if len(corners) == 0:
+        return numpy.zeros(0, numpy.int64)
+    #the angle of the longest side
+    ends = numpy.take_along_axis(corners, opposite[order[:, 2]], axis=1)
+    vector = points[ends[:, 1]] - points[ends[:, 0]]
+    angle = numpy.mod(numpy.arctan2(vector[:, 1], vector[:, 0]), math.pi)
+    #the center of the triangle
+    center = points[corners].mean(axis=1)
+    #quantize the five values into bins
+    values = numpy.stack([numpy.floor(sides[:, 0] / sides[:, 2] * ratio_bins),
+                          numpy.floor(sides[:, 1] / sides[:, 2] * ratio_bins),
+                          numpy.floor(angle / math.pi * angle_bins) % angle_bins,
+                          numpy.floor(center[:, 0] / cell_size),
+                          numpy.floor(center[:, 1] / cell_size)], axis=1)
+    values = values.astype(numpy.int64)
+    if expand:
+        shifts = numpy.array(list(itertools.product([-1, 0, 1], repeat=5)))
+        values = (values[:, None, :] + shifts[None, :, :]).reshape(-1, 5)
+        values[:, 2] = values[:, 2] % angle_bins
+    #combine into one key with 10 bits for each value, cells centered on zero
+    values[:, 3:] += 512
+    values = numpy.clip(values, 0, 1023)
+    keys = numpy.zeros(len(values), numpy.int64)
+    for column in range(5):
+        keys = keys * 1024 + values[:, column]
+    #return
+    return numpy.unique(keys)
+
+
 def image_blur_subtraction(image_grey, blur_size, clahe_size):
     
     """
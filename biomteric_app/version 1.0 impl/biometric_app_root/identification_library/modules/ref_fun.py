@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Reference point functions for fish contours which work on the (N,1,2) numpy
+contour array directly. ref_fish_lips and ref_tail_upper select the front 
+and back of the fish with boolean masks instead of scanning a list of 
+points, and give the same points as the loops they replaced. ref_fish_head
+gives the same point as the loop in fish_fun.ref_fish_head. ref_tail_fork 
+checks every inverted triangle in the tail profile instead of 10,000 random 
+samples, so it always returns the largest one. fish_fun.ref_fish_lips,
+ref_tail_upper and ref_tail_fork call these functions.
+"""
+
+#import python libraries
+import numpy
+import cv2
+import math
+
+#import shared libraries
+from . import opencv_fun as opencv_fun
+
+
+def ref_fish_lips(fish):
+
+    """
+    DESCRIPTION
+    This function finds the upper and lower lip from a fish contour (see 
+    fish_fun.ref_fish_lips). The front 5% of the fish is turned into a 
+    profile and a reduced density profile, and the lips are the points of 
+    the full profile closest to the corners of the reduced one. If it cannot
+    find two distinct lips then the same xy coordinate is returned for both
+    lips.
+
+    INPUT
+    fish = a contour in standard opencv format
+
+    OUTPUT
+    nose_1 = an XY coordinate for the fishes top lip
+    nose_2 = an XY coordinate for the fishes bottom lip
+    """
+
+    #find center of contour
+    center = opencv_fun.contour_center(fish)
+    #select the front 5% of the fish  
+    fish = numpy.asarray(fish)
+    pos_1 = fish[:, 0, 0].min()
+    pos_2 = fish[:, 0, 0].max()
+    limit = int(pos_1 + ((pos_2 - pos_1)*0.05))
+    front_fish = fish[fish[:, 0, 0] <= limit]
+    #convert contour to profile
+    profile_1 = opencv_fun.contour_to_profile(front_fish, center)
+    #calculate a reduced density front_fish contour
+    epsilon = 0.065*cv2.arcLength(front_fish, False)
+    approx = cv2.approxPolyDP(front_fish, epsilon, False)
+    #generate contour of reduced density
+    profile_2 = opencv_fun.contour_to_profile(approx, center)
+    #stretch profile_2 x axis to match the profile_1 range 
+    ratio = profile_1[:, 0].max() / float(profile_2[:, 0].max())
+    profile_2 = profile_2 * [ratio, 1]
+    #select nose points from reduced profile
+    if len(profile_2) == 6:
+        nose_1 = profile_2[1]
+        nose_2 = profile_2[4]
+    elif len(profile_2) == 5:
+        nose_1 = profile_2[1]
+        nose_2 = profile_2[3]
+    elif len(profile_2) == 4:
+        nose_1 = profile_2[1]
+        nose_2 = profile_2[2]    
+    elif len(profile_2) == 3:
+        nose_1 = profile_2[1]
+        nose_2 = profile_2[1]
+    else:
+        print('problem ref_fun.ref_fish_lips: %s' % (len(profile_2)))
+        nose_1 = profile_2[1]
+        nose_2 = profile_2[1]
+    #find the related points in the front_fish contour
+    nose_out_1 = front_fish[numpy.argmin(numpy.abs(profile_1[:, 0] - nose_1[0]))][0]
+    nose_out_2 = front_fish[numpy.argmin(numpy.abs(profile_1[:, 0] - nose_2[0]))][0]
+    #select which nose point is the upper lip
+    if nose_out_1[1] < nose_out_2[1]:
+        nose_1 = nose_out_1.tolist()
+        nose_2 = nose_out_2.tolist()
+    else:
+        nose_1 = nose_out_2.tolist()
+        nose_2 = nose_out_1.tolist()
+    #return
+    return nose_1, nose_2
+
+
+def ref_tail_upper(fish):
+
+    """
+    DESCRIPTION
+    This function finds the upper tip of the tail of a snapper contour: the
+    highest point (lowest y) of the last 20% of the fish, the first one in 
+    contour order when several are equally high.
+
+    INPUT
+    fish = a snapper contour in standard opencv format
+
+    OUTPUT
+    ref = the xy coordinates for the upper tip of the snapper tail
+    """
+
+    #get points from contour which are past the 80% limit
+    points = numpy.asarray(fish).reshape(-1, 2)
+    pos_1 = points[:, 0].min()
+    pos_2 = points[:, 0].max()
+    limit = int(pos_1 + ((pos_2 - pos_1)*0.80))
+    tail = points[points[:, 0] >= limit]
+    #return
+    return tail[numpy.argmin(tail[:, 1])].tolist()
+
+
+def ref_fish_head(fish, ref_nose, ref_tail):
+
+    """
+    DESCRIPTION
+    This function finds the head reference point: the point on the fish
+    outline closest to 90 degrees from the nose-tail line, seen from 30% along
+    that line.
+
+    INPUT
+    fish = a contour in standard opencv format
+    ref_nose = an XY coordinate for upper lip
+    ref_tail = an XY coordinate for the fishes tail
+
+    OUTPUT
+    ref = an xy coordinate for the ref point on the top of the fishes head
+    """
+
+    #get angle between ref_nose and ref_tail
+    angle = math.atan2(ref_tail[1] - ref_nose[1], ref_tail[0] - ref_nose[0])*(180/math.pi)
+    #get starting pos 30% along from ref_nose towards ref_tail
+    pos_start = [int(ref_nose[0] + ((ref_tail[0] - ref_nose[0])*0.3)),
+                 int(ref_nose[1] + ((ref_tail[1] - ref_nose[1])*0.3))]
+    #calculate the angle to every point on the fish outline
+    points = numpy.asarray(fish).reshape(-1, 2)
+    test_angle = numpy.arctan2(pos_start[1] - points[:, 1],
+                               pos_start[0] - points[:, 0])*(180/math.pi)
+    difference = numpy.abs(test_angle - (90 + angle))
+    best = numpy.argmin(difference)
+    #no point is closer than 1000 degrees
+    if difference[best] >= 1000:
+        return None
+    #return
+    return points[best].tolist()
+
+
+def ref_tail_fork(fish):
+
+    """
+    DESCRIPTION
+    This function finds the position of the tail fork as the middle point of
+    the largest inverted triangle in the profile of the last 20% of the fish
+    (see fish_fun.ref_tail_fork).
+
+    INPUT
+    fish = a contour in standard opencv format
+
+    OUTPUT
+    tail_fork = the xy coordinates of the tail fork
+    """
+
+    #find center of contour
+    center = opencv_fun.contour_center(fish)
+    #get points from contour which are past the 80% limit
+    fish = numpy.asarray(fish)
+    pos_1 = fish[:, 0, 0].min()
+    pos_2 = fish[:, 0, 0].max()
+    limit = int(pos_1 + ((pos_2 - pos_1)*0.80))
+    fish_tail = fish[fish[:, 0, 0] >= limit]
+    #rotate contour so that the lowest x point is at the start and the end
+    fish_tail = numpy.roll(fish_tail, -numpy.argmin(fish_tail[:, 0, 0]), axis=0)
+    #convert contour to profile and find biggest triangle as tail fork
+    triangle = profile_largest_triangle(opencv_fun.contour_to_profile(fish_tail, center))
+    #get middle point of triangle as fork_out
+    if triangle is None:
+        return None
+    #return
+    return fish_tail[triangle[1], 0].tolist()
+
+
+def profile_largest_triangle(profile):
+
+    """
+    DESCRIPTION
+    This function finds the largest inverted triangle in a profile (three 
+    points in order with the middle point below the other two) by checking 
+    every triangle, without random samples. Each middle point is checked in
+    one vectorized step over every pair of higher points on either side of 
+    it. An upper bound on the area each middle point can give is calculated
+    for all of them at once from the furthest points on either side, and the
+    middle points are checked from the largest bound down, stopping once the
+    bound is not larger than the best area found. The result is the same as
+    checking every middle point. For each middle point only the corners of 
+    the convex hull of the points on either side are paired, as the area of
+    a triangle is largest at one of them. The area is measured in whole 
+    pixels as in
+    opencv_fun.profile_largest_triangle. When several triangles have the 
+    same area the one found first is kept.
+
+    INPUT
+    profile = the profile generated based on a contour (see contour_to_profile)
+
+    OUTPUT
+    best_triangle = a numpy array of the three profile positions, or None
+    """
+
+    #check profile is a numpy array
+    profile = numpy.asarray(profile)
+    if len(profile) < 3:
+        return None
+    y = profile[:, 1]
+    whole = profile.astype(int)
+    #the middle points need a higher point on both sides
+    middle = numpy.arange(1, len(profile) - 1)
+    middle = middle[(numpy.maximum.accumulate(y)[:-2] > y[1:-1]) &
+                    (numpy.maximum.accumulate(y[::-1])[::-1][2:] > y[1:-1])]
+    #the furthest distance along each axis to a point on either side
+    low_1 = numpy.minimum.accumulate(whole)[middle - 1]
+    high_1 = numpy.maximum.accumulate(whole)[middle - 1]
+    low_2 = numpy.minimum.accumulate(whole[::-1])[::-1][middle + 1]
+    high_2 = numpy.maximum.accumulate(whole[::-1])[::-1][middle + 1]
+    reach_1 = numpy.maximum(whole[middle] - low_1, high_1 - whole[middle])
+    reach_2 = numpy.maximum(whole[middle] - low_2, high_2 - whole[middle])
+    #upper bound on the area of any triangle around each middle point
+    bound = (reach_1[:, 0] * reach_2[:, 1] + reach_1[:, 1] * reach_2[:, 0]) / 2.0
+    order = numpy.argsort(-bound, kind='stable')
+    best_area = 0
+    best_triangle = None
+    for j, limit in zip(middle[order], bound[order]):
+        if limit <= best_area:
+            break
+        #the points on either side which are higher than the middle point
+        side_1 = numpy.flatnonzero(y[:j] > y[j])
+        side_2 = j + 1 + numpy.flatnonzero(y[j + 1:] > y[j])
+        #the area is largest at a corner of the convex hull of each side
+        side_1 = side_1[hull(whole[side_1])]
+        side_2 = side_2[hull(whole[side_2])]
+        #area of the triangles of every pair of corners
+        offset_1 = whole[side_1] - whole[j]
+        offset_2 = whole[side_2] - whole[j]
+        area = numpy.abs(offset_1[:, 0, None] * offset_2[None, :, 1] -
+                         offset_1[:, 1, None] * offset_2[None, :, 0]) / 2.0
+        best = numpy.argmax(area)
+        if area.flat[best] > best_area:
+            best_area = area.flat[best]
+            best_triangle = numpy.array([side_1[best // len(side_2)], j,
+                                         side_2[best % len(side_2)]])
+    #return
+    return best_triangle
+
+
+def hull(points):
+
+    """
+    DESCRIPTION
+    This function finds the corners of the convex hull of a set of points.
+
+    INPUT
+    points = an (n, 2) int array of xy coordinates
+
+    OUTPUT
+    corners = a sorted numpy array of the positions of the hull corners
+    """
+
+    #opencv needs at least three points
+    if len(points) < 3:
+        return numpy.arange(len(points))
+    corners = cv2.convexHull(points.astype(numpy.int32).reshape(-1, 1, 2),
+                             returnPoints=False)
+    #return
+    return numpy.sort(corners.ravel())
@@ -10,14 +10,11 @@ import numpy
 import copy
 import os
 import json
-import time
 
 
 #import shared modules
 from . import opencv_fun as opencv_fun
-
-# import json file path
-from biometric_app_site.settings import JSON_ROOT
+from .. import assets
 
 
 def edge_optimized(image, shapes, permutations_min, permutations_max, quality_min):
@@ -49,30 +46,9 @@ def edge_optimized(image, shapes, permutations_min, permutations_max, quality_mi
     best_contrast = the contrast value for the returned contour
     """
 
-    #define the memory location
-    memory_contour_file = JSON_ROOT + '/memory_contours.json' 
-    memory_shapes_file = JSON_ROOT + '/memory_shapes.json' 
-    print(memory_contour_file)
-    
-    #load memory files
-    while True:
-        try:
-            with open(memory_contour_file, 'r') as f:
-                print(1)
-                print(f)
-                print(json.load(f))
-                contourMemory = json.load(f) 
-               
-            with open(memory_shapes_file, 'r') as f:
-                print(2)
-                shapeMemory = json.load(f)  
-                
-            print(3)
-            break
-        except:
-            print('failed to load memory1: edge_optimized')
-            #wait for a few seconds
-            time.sleep(random.randint(1,5))
+    #load memory files, read once per process (see assets.py)
+    contourMemory = assets.memory_contours()
+    shapeMemory = assets.memory_shapes()
 
     #determine the background color
     background_values, background_channel = opencv_fun.image_background(image)
@@ -141,33 +117,37 @@ def edge_optimized(image, shapes, permutations_min, permutations_max, quality_mi
             if best_value >= quality_min:
                 if x >= permutations_min:
                     break     
-    #add method to memory
+    #add method to memory, the file is changed through the assets lock as 
+    #contourMemory is shared with the other requests (see assets.py)
     if method_used is not None:
         memoryUnit = {'contour_method': method_used}
-        try:
-            if len(contourMemory[method_used['shape_type']]) < 1000:
-               contourMemory[method_used['shape_type']] += [memoryUnit]
-            else:
-               del contourMemory[method_used['shape_type']][0]
-               contourMemory[method_used['shape_type']] += [memoryUnit]
-        except:
-            contourMemory[method_used['shape_type']] = [memoryUnit]            
-    #save updated memory
-    while True:
-        try:
-            with open(memory_contour_file, 'w') as f:
-                json.dump(contourMemory, f)
-            break
-        except:
-            print('failed to save memory2: edge_optimized')
-            #wait for a few seconds
-            time.sleep(random.randint(1,5))
+        assets.update_json('memory_contours.json', 
+                           lambda memory: add_memory_unit(memory, method_used['shape_type'], memoryUnit))
             
     #return best_match
     if best_value is not None:
         return best_contour, best_value, best_overlap, best_contrast
 
 
+def add_memory_unit(contourMemory, shapeType, memoryUnit):
+    
+    """
+    DESCRIPTION
+    This function adds a successful thresholding parameter set to the memory
+    of a shape type, keeping the latest 1000 sets.
+    
+    INPUT
+    contourMemory = a dictionary of shape type -> list of parameter sets
+    shapeType = the shape type the parameters were used for
+    memoryUnit = the parameter set to add
+    """
+    
+    memory = contourMemory.setdefault(shapeType, [])
+    memory += [memoryUnit]
+    if len(memory) > 1000:
+        del memory[0]
+
+
 def generate_edge_parameters():
     
     """
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel version of the gallery search used by getBioMatchData.
+
+The candidate rows are split into shards which are aligned and compared in a
+ProcessPoolExecutor. When the pool is started the packed gallery is written 
+to a snapshot file, which each worker opens with a read-only mmap (see 
+read_snapshot), so the workers share one copy of the gallery arrays instead
+of each unpickling its own. When rows are saved afterwards each shard is 
+sent the changes made to the gallery since then (see Gallery.change), which
+the worker applies to its own copy, and the pool is only started again with the
+whole gallery when the changes are too many or the gallery was reloaded. 
+Nothing in the workers needs django to be set up, so the pool also works 
+when new processes are spawned instead of forked. As soon as
+one shard finds a match above the match quality the shared stop event is set,
+so the other workers give up and the shards not yet started are cancelled.
+For a ranked search every shard returns its own top rows, which are merged.
+Each shard is sent the cached scores of its rows and returns the scores it
+aligned, which are added to the cache of the search (see scorecache.py), 
+with the number of rows it read from the cache.
+"""
+
+#import python libraries
+import atexit
+import os
+import tempfile
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# import shared modules
+from . import functions
+from .gallery import gallery as process_gallery, apply_change, read_snapshot
+
+
+# the gallery the worker was started with, the latest version of it with 
+# the number of changes applied, and the stop event inside each worker process
+worker_base = None
+worker_gallery = None
+worker_applied = 0
+worker_stop = None
+
+
+def init_worker(gallery, stop):
+
+    """
+    DESCRIPTION
+    This function is run once in each worker process to open the gallery
+    and keep the shared stop event.
+
+    INPUT
+    gallery = a GalleryArrays object, or the path of a snapshot file (see 
+              GalleryArrays.write)
+    stop = a multiprocessing Event shared by all workers
+    """
+
+    global worker_base, worker_gallery, worker_applied, worker_stop
+    if isinstance(gallery, str):
+        gallery = read_snapshot(gallery)
+    worker_base = gallery
+    worker_gallery = gallery
+    worker_applied = 0
+    worker_stop = stop
+
+
+def worker_snapshot(changes):
+
+    """
+    DESCRIPTION
+    This function brings the gallery of a worker up to the version used by
+    a search. The changes are applied to the latest version of the worker,
+    or to the gallery it was started with if the search uses an older one.
+
+    INPUT
+    changes = the list of changes since the gallery the pool was started 
+              with (see Gallery.changes_between)
+
+    OUTPUT
+    gallery = the GalleryArrays object used by the search
+    """
+
+    global worker_gallery, worker_applied
+    if len(changes) < worker_applied:
+        worker_gallery = worker_base
+        worker_applied = 0
+    for change in changes[worker_applied:]:
+        worker_gallery = apply_change(worker_gallery, change)
+    worker_applied = len(changes)
+    return worker_gallery
+
+
+def shard_cache(cache, rows):
+    #the cached scores of the rows of one shard
+    if cache is None:
+        return {}
+    return {row: cache[row] for row in rows if row in cache}
+
+
+def search_shard(new_individual, rows, method, matchquality, deadline, known,
+                 changes):
+
+    """
+    DESCRIPTION
+    This function scores one shard of gallery rows inside a worker and stops
+    at the first row with more than matchquality matching spots, when
+    another worker has already found a match or when the deadline passes.
+
+    INPUT
+    new_individual = the individual to match
+    rows = a list of gallery row numbers
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    deadline = the time.time() at which to stop, or None for no limit
+    known = a dictionary of the cached scores of the rows
+    changes = the changes of the gallery since the pool was started
+
+    OUTPUT
+    match = a tuple of (row, match_value) or None if no match was found
+    checked = the number of rows checked
+    scores = a dictionary of the scores aligned by the shard
+    hits = the number of rows read from the cache
+    """
+
+    gallery = worker_snapshot(changes)
+    cache = dict(known)
+    cache_counts = {'hits': 0}
+    checked = 0
+    for start in range(0, len(rows), functions.CHUNK_SIZE):
+        if worker_stop.is_set():
+            break
+        if deadline is not None and time.time() > deadline:
+            break
+        chunk = rows[start:start + functions.CHUNK_SIZE]
+        checked += len(chunk)
+        match_values = functions.score_gallery_rows(gallery,
+                                                    new_individual,
+                                                    chunk, method, cache,
+                                                    cache_counts)
+        for row, match_value in zip(chunk, match_values):
+            if match_value > matchquality:
+                worker_stop.set()
+                return ((row, match_value), checked, new_scores(cache, known),
+                        cache_counts['hits'])
+    return None, checked, new_scores(cache, known), cache_counts['hits']
+
+
+def new_scores(cache, known):
+    #the scores aligned by a shard, to be sent back to the search
+    return {row: value for row, value in cache.items() if row not in known}
+
+
+def rank_shard(new_individual, rows, method, matchquality, top, deadline,
+               known, changes):
+
+    """
+    DESCRIPTION
+    This function finds the top scoring rows of one shard inside a worker
+    (see functions.rank_gallery_rows).
+
+    INPUT
+    new_individual = the individual to match
+    rows = a list of gallery row numbers
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    top = the number of rows to return
+    deadline = the time.time() at which to stop, or None for no limit
+    known = a dictionary of the cached scores of the rows
+    changes = the changes of the gallery since the pool was started
+
+    OUTPUT
+    ranked = a list of (row, match_value) tuples, best first
+    checked = the number of rows checked
+    scores = a dictionary of the scores aligned by the shard
+    hits = the number of rows read from the cache
+    """
+
+    gallery = worker_snapshot(changes)
+    cache = dict(known)
+    cache_counts = {'hits': 0}
+    ranked, checked = functions.rank_gallery_rows(gallery,
+                                                  new_individual, rows, method,
+                                                  matchquality, top, deadline,
+                                                  cache, cache_counts)
+    return ranked, checked, new_scores(cache, known), cache_counts['hits']
+
+
+class SearchPool(object):
+
+    """
+    DESCRIPTION
+    A process pool holding a copy of one gallery snapshot. A search against
+    a later snapshot of the same gallery sends the workers the changes 
+    since then. The pool is restarted when the snapshot can not be reached
+    by changes, when there are more than GALLERY_CHANGES of them or when 
+    the number of workers changes. Searches are run one at a time as the
+    workers share a single stop event.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.gallery = None
+        self.workers = 0
+        self.stop = None
+        self.path = None
+
+    def start(self, gallery, workers):
+        #stop the old workers before writing the new gallery
+        self.shutdown()
+        handle, self.path = tempfile.mkstemp(prefix='gallery-', suffix='.snapshot')
+        os.close(handle)
+        gallery.write(self.path)
+        self.stop = multiprocessing.Event()
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=init_worker,
+                                            initargs=(self.path, self.stop))
+        self.gallery = gallery
+        self.workers = workers
+
+    def shutdown(self):
+
+        """
+        DESCRIPTION
+        This function stops the worker processes and removes their snapshot
+        file. The workers have no shards left, so waiting for them only 
+        waits for them to exit, after which nothing has the file open.
+        """
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.path is not None:
+            os.remove(self.path)
+        self.executor = None
+        self.gallery = None
+        self.path = None
+
+    def prepare(self, gallery, workers):
+        #the changes since the gallery of the workers, restarting the pool 
+        #if the gallery can not be reached or the number of workers changed
+        changes = None
+        if self.executor is not None and self.workers == workers:
+            if self.gallery is gallery:
+                changes = []
+            else:
+                changes = process_gallery.changes_between(self.gallery.version,
+                                                          gallery.version)
+        if changes is None:
+            self.start(gallery, workers)
+            changes = []
+        self.stop.clear()
+        return changes
+
+    def search(self, gallery, new_individual, rows, method, matchquality,
+               workers, deadline, cache=None, cache_counts=None):
+
+        """
+        DESCRIPTION
+        This function splits the rows into shards and searches them in
+        parallel, returning the first match reported by any shard.
+
+        INPUT
+        gallery = a GalleryArrays object
+        new_individual = the individual to match
+        rows = a list of gallery row numbers, most promising first
+        method = a string defining which alignment method to use
+        matchquality = the number of matching spots needed for a match
+        workers = the number of worker processes
+        deadline = the time.time() at which to stop, or None for no limit
+        cache = the score cache of the search (see scorecache.py), the 
+                scores aligned by the shards are added to it, or None
+        cache_counts = a dictionary whose 'hits' value is increased by the
+                       number of rows the shards read from the cache, or None
+
+        OUTPUT
+        match = a tuple of (row, match_value) or None if no match was found
+        checked = the number of rows checked
+        """
+
+        with self.lock:
+            changes = self.prepare(gallery, workers)
+            #interleave the rows so every shard starts with promising rows
+            shards = workers * 4
+            futures = [self.executor.submit(search_shard, new_individual,
+                                            rows[x::shards], method,
+                                            matchquality, deadline,
+                                            shard_cache(cache, rows[x::shards]),
+                                            changes)
+                       for x in range(shards) if len(rows[x::shards]) > 0]
+            match = None
+            for future in as_completed(futures):
+                match = future.result()[0]
+                if match is not None:
+                    break
+            #cancel the shards which have not started yet
+            self.stop.set()
+            running = [x for x in futures if not x.cancel()]
+            #the running shards stop at their next chunk
+            checked = sum(x.result()[1] for x in running)
+            for future in running:
+                if cache is not None:
+                    cache.update(future.result()[2])
+                if cache_counts is not None:
+                    cache_counts['hits'] += future.result()[3]
+            return match, checked
+
+    def rank(self, gallery, new_individual, rows, method, matchquality,
+             top, workers, deadline, cache=None, cache_counts=None):
+
+        """
+        DESCRIPTION
+        This function splits the rows into shards, ranks each shard in
+        parallel and merges the top rows of every shard.
+
+        INPUT
+        gallery = a GalleryArrays object
+        new_individual = the individual to match
+        rows = a list of gallery row numbers, most promising first
+        method = a string defining which alignment method to use
+        matchquality = the number of matching spots needed for a match
+        top = the number of rows to return
+        workers = the number of worker processes
+        deadline = the time.time() at which to stop, or None for no limit
+        cache = the score cache of the search (see scorecache.py), the 
+                scores aligned by the shards are added to it, or None
+        cache_counts = a dictionary whose 'hits' value is increased by the
+                       number of rows the shards read from the cache, or None
+
+        OUTPUT
+        ranked = a list of (row, match_value) tuples, best first
+        checked = the number of rows checked
+        """
+
+        with self.lock:
+            changes = self.prepare(gallery, workers)
+            #interleave the rows so every shard starts with promising rows
+            shards = workers * 4
+            futures = [self.executor.submit(rank_shard, new_individual,
+                                            rows[x::shards], method,
+                                            matchquality, top, deadline,
+                                            shard_cache(cache, rows[x::shards]),
+                                            changes)
+                       for x in range(shards) if len(rows[x::shards]) > 0]
+            ranked = []
+            checked = 0
+            for future in futures:
+                ranked += future.result()[0]
+                checked += future.result()[1]
+                if cache is not None:
+                    cache.update(future.result()[2])
+                if cache_counts is not None:
+                    cache_counts['hits'] += future.result()[3]
+        #equal values keep the order of the rows list
+        position = {row: x for x, row in enumerate(rows)}
+        ranked.sort(key=lambda x: (-x[1], position[x[0]]))
+        return ranked[:top], checked
+
+
+# the pool shared by every request handled by this process, stopped when
+# the process exits so its snapshot file is removed
+search_pool = SearchPool()
+atexit.register(search_pool.shutdown)
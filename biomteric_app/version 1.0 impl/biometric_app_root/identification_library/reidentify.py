@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+All-pairs re-identification of the FishData gallery.
+
+Every row is matched against the later rows of its block (the rows with the
+same population and/or tank) which pass the prefilter of a normal search
+(see GalleryArrays.candidates), so each pair is aligned at most once and
+each row is aligned with at most the shortlist and FALLBACK_CANDIDATES
+rows instead of its whole block. The
+pairs with more than matchquality matching spots are joined into identity
+clusters with a union-find. The rows are matched in chunks by a pool of
+worker processes, which share one read-only mmap of a snapshot file of the
+gallery (see GalleryArrays.write), and only the
+matching pairs are kept so the memory used does not grow with the number of
+pairs checked. The scores cached by earlier runs are reused and the new
+scores are returned to be cached (see scorecache.py). The run is driven by
+the reidentify management command.
+"""
+
+#import python libraries
+import numpy
+
+# import shared modules
+from . import functions
+from .gallery import query_stats, read_snapshot
+
+
+# the fields used to split the gallery into blocks
+BLOCK_FIELDS = {'population': ['population'],
+                'tank': ['tank'],
+                'both': ['population', 'tank'],
+                'none': []}
+
+
+# the gallery and block of each row inside each worker process
+worker_gallery = None
+worker_blocks = None
+
+
+def gallery_blocks(gallery, block):
+
+    """
+    DESCRIPTION
+    This function numbers the block of every gallery row.
+
+    INPUT
+    gallery = a GalleryArrays object
+    block = a key of BLOCK_FIELDS
+
+    OUTPUT
+    blocks = an int array with the block number of each row
+    """
+
+    numbers = {}
+    blocks = numpy.zeros(len(gallery), numpy.int64)
+    for row, info in enumerate(gallery.info):
+        key = tuple(info[x] for x in BLOCK_FIELDS[block])
+        blocks[row] = numbers.setdefault(key, len(numbers))
+    #return
+    return blocks
+
+
+def init_worker(gallery, blocks):
+
+    """
+    DESCRIPTION
+    This function is run once in each worker process to open the gallery
+    and keep the block numbers.
+
+    INPUT
+    gallery = a GalleryArrays object, or the path of a snapshot file (see 
+              GalleryArrays.write)
+    blocks = an int array with the block number of each row
+    """
+
+    global worker_gallery, worker_blocks
+    if isinstance(gallery, str):
+        gallery = read_snapshot(gallery)
+    worker_gallery = gallery
+    worker_blocks = blocks
+
+
+def row_individual(gallery, row, method):
+
+    """
+    DESCRIPTION
+    This function returns a gallery row in the individual format built by
+    analyzeData.
+
+    INPUT
+    gallery = a GalleryArrays object
+    row = the row number
+    method = a string defining which alignment method to use
+
+    OUTPUT
+    new_individual = a dictionary with the spots, ref points, spots_standard
+                     (None unless a standard space method is used), name and
+                     imageId of the row
+    """
+
+    new_individual = gallery.individual(row)
+    new_individual['name'] = gallery.info[row]['name']
+    new_individual['imageId'] = gallery.info[row]['imageId']
+    if method in functions.STANDARD_METHODS and gallery.standard[row]:
+        new_individual['spots_standard'] = gallery.pattern_standard(row)
+    else:
+        new_individual['spots_standard'] = None
+    #return
+    return new_individual
+
+
+def match_row(gallery, blocks, row, method, matchquality, cache=None,
+              cache_counts=None):
+
+    """
+    DESCRIPTION
+    This function matches one gallery row against the later rows of the
+    same block which pass the prefilter.
+
+    INPUT
+    gallery = a GalleryArrays object
+    blocks = an int array with the block number of each row
+    row = the row number to match
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    cache = the score cache of the row (see functions.score_gallery_rows)
+    cache_counts = the cache hit counts passed to score_gallery_rows, or None
+
+    OUTPUT
+    pairs = a list of (row, row, match_value) tuples for the matches
+    checked = the number of rows aligned
+    """
+
+    #only the later rows of the block, so every pair is seen once
+    subset = blocks == blocks[row]
+    subset[:row + 1] = False
+    if not subset.any():
+        return [], 0
+    new_individual = row_individual(gallery, row, method)
+    standard = new_individual['spots_standard'] is not None
+    counts = numpy.diff(gallery.offsets)
+    stats = query_stats(new_individual)
+    pairs = []
+    checked = 0
+    #the shortlist first, then the fallback rows when it has no match
+    for fallback in [False, True]:
+        rows, removed = gallery.candidates(new_individual, standard, set(),
+                                           subset=subset, fallback=fallback,
+                                           stats=stats)
+        #skip the rows which can not have enough matching spots
+        rows = [x for x in rows if min(counts[row], counts[x]) > matchquality]
+        for start in range(0, len(rows), functions.CHUNK_SIZE):
+            chunk = rows[start:start + functions.CHUNK_SIZE]
+            match_values = functions.score_gallery_rows(gallery, new_individual,
+                                                        chunk, method, cache,
+                                                        cache_counts)
+            pairs += [(row, x, match_value) for x, match_value in
+                      zip(chunk, match_values) if match_value > matchquality]
+        checked += len(rows)
+        if len(pairs) > 0 or not standard:
+            break
+    #return
+    return pairs, checked
+
+
+def match_rows(rows, method, matchquality, known):
+
+    """
+    DESCRIPTION
+    This function matches a chunk of gallery rows inside a worker (see
+    match_row). The pairs are returned as imageIds so they stay valid if
+    the run is resumed against a reloaded gallery.
+
+    INPUT
+    rows = a list of row numbers
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    known = a list with the cached scores of each row
+
+    OUTPUT
+    imageIds = the imageIds of the rows matched
+    pairs = a list of (imageId, imageId, match_value) tuples
+    checked = the number of rows aligned
+    scores = a list with a dictionary of the new scores of each row
+    hits = the number of scores read from the cache
+    """
+
+    imageIds = []
+    pairs = []
+    checked = 0
+    scores = []
+    cache_counts = {'hits': 0}
+    for row, cached in zip(rows, known):
+        cache = dict(cached)
+        found, aligned = match_row(worker_gallery, worker_blocks, row, method,
+                                   matchquality, cache, cache_counts)
+        scores += [{x: value for x, value in cache.items() if x not in cached}]
+        imageIds += [worker_gallery.info[row]['imageId']]
+        pairs += [(worker_gallery.info[x]['imageId'],
+                   worker_gallery.info[y]['imageId'], match_value)
+                  for x, y, match_value in found]
+        checked += aligned
+    #return
+    return imageIds, pairs, checked, scores, cache_counts['hits']
+
+
+def find_root(parents, item):
+
+    """
+    DESCRIPTION
+    This function finds the root of an item in a union-find, halving the
+    path on the way.
+
+    INPUT
+    parents = a dictionary of item to parent item
+    item = the item to look up
+
+    OUTPUT
+    root = the root item of the cluster
+    """
+
+    parents.setdefault(item, item)
+    while parents[item] != item:
+        parents[item] = parents[parents[item]]
+        item = parents[item]
+    #return
+    return item
+
+
+def cluster_pairs(pairs):
+
+    """
+    DESCRIPTION
+    This function joins the matching pairs into identity clusters.
+
+    INPUT
+    pairs = a list of (imageId, imageId, match_value) tuples
+
+    OUTPUT
+    clusters = a list of sorted lists of imageIds, one for each cluster of
+               more than one image
+    """
+
+    parents = {}
+    for item_1, item_2, match_value in pairs:
+        root_1 = find_root(parents, item_1)
+        root_2 = find_root(parents, item_2)
+        if root_1 != root_2:
+            parents[max(root_1, root_2)] = min(root_1, root_2)
+    clusters = {}
+    for item in list(parents):
+        clusters.setdefault(find_root(parents, item), []).append(item)
+    #return
+    return [sorted(x) for x in clusters.values()]
+
+
+def cluster_tag(members):
+
+    """
+    DESCRIPTION
+    This function picks the baseTag of an identity cluster in the same order
+    as getBioMatchData picks matchPitTag: the first pitTag, then the first
+    report, otherwise the baseTag (or imageId) of the oldest image.
+
+    INPUT
+    members = a list of dictionaries with the imageId, date, pitTag, report
+              and baseTag of each image in the cluster
+
+    OUTPUT
+    baseTag = the baseTag for every image in the cluster
+    """
+
+    members = sorted(members, key=lambda x: x['date'])
+    for field in ['pitTag', 'report']:
+        for member in members:
+            if member[field] and member[field] != '-':
+                return member[field]
+    #return
+    return members[0]['baseTag'] or str(members[0]['imageId'])
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Persisted cache of the match scores between a query image and the gallery.
+
+A score is stored for each (query imageId, gallery imageId, method, params
+hash) together with the number of spot pairs compared (the inliers) and the
+alignment matrix of the standard space methods. The
+params hash covers the query pattern and the settings of the alignment, so
+a query with different spots never reads an old score. The scores of a
+gallery row are deleted when its spots or ref points change (see
+signals.py). The cache is read into a dictionary of row to (match_value,
+inliers, matrix) before a search and the scores aligned during the search are saved
+afterwards (see functions.score_gallery_rows). Only the scores of the
+deterministic methods (functions.FIXED_METHODS) are cached, the other methods
+draw random samples and a stored score would be read back as if it were
+final.
+"""
+
+#import python libraries
+import hashlib
+import json
+import numpy
+
+#import shared modules
+from . import functions
+
+# import model
+from identify.models import PairScore
+
+
+# settings of the alignment and comparison, change SCORE_VERSION whenever
+# align_patterns or compare_patterns give different results
+SCORE_VERSION = 2
+SCORE_PARAMS = {'ransac': [0.1, 0.99, 1000], 'compare': 0.15}
+
+# FishData fields which change the score of a row
+SCORE_FIELDS = ['spots', 'refNose', 'refTail', 'refHead']
+
+
+def params_hash(new_individual, method):
+
+    """
+    DESCRIPTION
+    This function generates the hash of the query pattern and the alignment
+    settings used as part of the cache key.
+
+    INPUT
+    new_individual = the individual to match
+    method = a string defining which alignment method to use
+
+    OUTPUT
+    hash = a 40 character hex string
+    """
+
+    def plain(value):
+        #numpy arrays are stored as lists
+        if value is None:
+            return None
+        return numpy.asarray(value).tolist()
+
+    key = [SCORE_VERSION, SCORE_PARAMS, method] + [
+        plain(new_individual.get(x)) for x in
+        ['spots', 'spots_standard', 'ref_nose', 'ref_tail', 'ref_head']]
+    #return
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def load_scores(gallery, queryImageIds, hashes, method):
+
+    """
+    DESCRIPTION
+    This function reads the cached scores of a list of queries with a single
+    query.
+
+    INPUT
+    gallery = a GalleryArrays object
+    queryImageIds = a list of query imageIds
+    hashes = the params_hash of each query
+    method = a string defining which alignment method to use
+
+    OUTPUT
+    caches = a list with a dictionary of gallery row to (match_value, 
+             inliers, matrix) for each query
+    """
+
+    caches = [{} for x in queryImageIds]
+    if method not in functions.FIXED_METHODS or len(queryImageIds) == 0:
+        return caches
+    position = {(x, y): key for key, (x, y) in
+                enumerate(zip(queryImageIds, hashes))}
+    for score in (PairScore.objects.filter(queryImageId__in=queryImageIds,
+                                           paramsHash__in=hashes, method=method)
+                  .values_list('queryImageId', 'paramsHash', 'galleryImageId',
+                               'score', 'inliers', 'matrix')):
+        key = position.get(score[:2])
+        row = gallery.index.get(score[2])
+        #skip the rows which are no longer in the gallery
+        if key is None or row is None:
+            continue
+        matrix = json.loads(score[5]) if score[5] else None
+        caches[key][row] = (score[3], score[4], matrix)
+    #return
+    return caches
+
+
+def save_scores(gallery, queryImageId, hash_value, method, cache, known):
+
+    """
+    DESCRIPTION
+    This function saves the scores aligned during a search.
+
+    INPUT
+    gallery = a GalleryArrays object
+    queryImageId = the imageId of the query
+    hash_value = the params_hash of the query
+    method = a string defining which alignment method to use
+    cache = the dictionary of row to (match_value, inliers, matrix) after the
+            search
+    known = the rows which were read from the cache
+
+    OUTPUT
+    saved = the number of scores saved
+    """
+
+    if method not in functions.FIXED_METHODS:
+        return 0
+    scores = [PairScore(queryImageId=queryImageId,
+                        galleryImageId=gallery.info[row]['imageId'],
+                        method=method, paramsHash=hash_value,
+                        score=match_value, inliers=inliers,
+                        matrix='' if matrix is None else json.dumps(matrix))
+              for row, (match_value, inliers, matrix) in cache.items()
+              if row not in known]
+    PairScore.objects.bulk_create(scores, ignore_conflicts=True)
+    #return
+    return len(scores)
+
+
+def invalidate(imageId):
+
+    """
+    DESCRIPTION
+    This function deletes every cached score of an image, as a query or as a
+    gallery row.
+
+    INPUT
+    imageId = the imageId of the changed or deleted FishData row
+    """
+
+    PairScore.objects.filter(queryImageId=imageId).delete()
+    PairScore.objects.filter(galleryImageId=imageId).delete()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Signal receivers which keep the in-memory gallery, the identity table and the
+score cache in step with FishData, and move the gallery change counter so 
+the other processes load their gallery again.
+"""
+
+#import django libraries
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+# import the process-wide gallery
+from .gallery import gallery
+from .features import update_features
+from .identities import update_identity
+from . import scorecache
+
+# import model
+from identify.models import FishData, Identity
+
+
+@receiver(pre_save, sender=FishData)
+def fish_data_saving(sender, instance, **kwargs):
+    #calculate the derived fields from the spots and ref points
+    update_features(instance)
+    #keep the old baseTag so its identity can be updated after the save, 
+    #the old row is only read from the database when the gallery is not loaded
+    #or another process has changed FishData since
+    if gallery.current():
+        previous = gallery.saved_row(instance)
+    else:
+        previous = (FishData.objects.filter(pk=instance.pk)
+                    .values('baseTag', *scorecache.SCORE_FIELDS).first())
+        if previous is not None:
+            #the cached scores are out of date when the spots or ref points change
+            previous['scoresChanged'] = any(previous[x] != getattr(instance, x) 
+                                            for x in scorecache.SCORE_FIELDS)
+    instance.previousBaseTag = previous['baseTag'] if previous else None
+    instance.scoresChanged = previous is not None and previous['scoresChanged']
+
+
+@receiver(post_save, sender=FishData)
+def fish_data_saved(sender, instance, **kwargs):
+    #add the new or changed row to the gallery
+    gallery.update(instance)
+    gallery.touch(True)
+    #update the identity the row joined and the one it left
+    update_identity(str(instance.baseTag))
+    previous = getattr(instance, 'previousBaseTag', None)
+    if previous and previous != str(instance.baseTag):
+        update_identity(previous)
+    if getattr(instance, 'scoresChanged', False):
+        scorecache.invalidate(instance.imageId)
+
+
+@receiver(post_delete, sender=FishData)
+def fish_data_deleted(sender, instance, **kwargs):
+    #drop the deleted row from the gallery
+    gallery.remove(instance.imageId)
+    gallery.touch(True)
+    update_identity(str(instance.baseTag))
+    scorecache.invalidate(instance.imageId)
+
+
+@receiver(post_save, sender=Identity)
+def identity_saved(sender, instance, **kwargs):
+    #use the new medoid of the identity in the gallery
+    gallery.update_identity(instance.baseTag, instance.medoidImageId)
+    gallery.touch(True)
+
+
+@receiver(post_delete, sender=Identity)
+def identity_deleted(sender, instance, **kwargs):
+    #drop the identity from the gallery
+    gallery.update_identity(instance.baseTag, None)
+    gallery.touch(True)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental re-identification of the uploads which found no match.
+
+When new FishData rows have been added, every Identify row with the status
+'Match not Found' is searched again using the spots stored when it was
+uploaded, against the new rows only. The spots of a bio search upload which
+found no match are stored outside the gallery (see FishData.inGallery), and
+the row joins the gallery once a match is found. The image is not processed again and
+the rest of the gallery, which was searched at upload time, is not aligned
+again. Uploads with a pitTag are checked with the indexed tag lookup instead
+(see getTagMatchData). The sweep is driven by the sweep_unmatched management
+command.
+"""
+
+#import python libraries
+import json
+import numpy
+
+# import shared modules
+from . import functions
+from . import identifyImage
+from .reidentify import row_individual
+
+# import model
+from identify.models import Identify, FishData
+
+
+def sweep_unmatched(gallery, new_imageIds, method, matchquality, matchTop):
+
+    """
+    DESCRIPTION
+    This function searches the new gallery rows for every unmatched upload
+    and saves the matches found, in the same way as views.tryAgain.
+
+    INPUT
+    gallery = a GalleryArrays object
+    new_imageIds = the imageIds of the FishData rows added since the last
+                   sweep
+    method = a string defining which alignment method to use
+    matchquality = the number of matching spots needed for a match
+    matchTop = the number of ranked matches to return for each upload
+
+    OUTPUT
+    results = a dictionary with the number of unmatched uploads searched
+              and the number of matches found
+    """
+
+    #the new rows are the only rows searched
+    subset = numpy.zeros(len(gallery), bool)
+    subset[[gallery.index[x] for x in new_imageIds if x in gallery.index]] = True
+    results = {'searched': 0, 'matched': 0}
+    if not subset.any():
+        return results
+    unmatched = list(Identify.objects.filter(status='Match not Found'))
+    #the stored spots of the uploads which are not in the gallery
+    stored = FishData.objects.in_bulk([x.imageId for x in unmatched 
+                                       if x.imageId not in gallery.index])
+    for dataToCheck in unmatched:
+        row = gallery.index.get(dataToCheck.imageId)
+        if row is not None:
+            new_individual = row_individual(gallery, row, method)
+        else:
+            #uploads without spots could not be processed
+            new_individual = identifyImage.storedIndividual(stored.get(dataToCheck.imageId))
+            if new_individual is None:
+                continue
+            if method not in functions.STANDARD_METHODS:
+                new_individual['spots_standard'] = None
+        if dataToCheck.pitTag != '-':
+            matchData = identifyImage.getTagMatchData(new_individual, dataToCheck.pitTag)
+        else:
+            matchData = identifyImage.getBioMatchData(gallery, new_individual, [method],
+                                                      matchquality, 1, matchTop, None,
+                                                      subset=subset)
+        results['searched'] += 1
+        matching_image_list = matchData['matching_image_list']
+        if len(matching_image_list) == 0:
+            continue
+        results['matched'] += 1
+        #update the stored spots of the upload as views.tryAgain does
+        spotObj = FishData.objects.get(pk=dataToCheck.imageId)
+        spotObj.population = matching_image_list[0]['population']
+        spotObj.report = matchData['matchPitTag']
+        if dataToCheck.pitTag != '-':
+            spotObj.pitTag = matchData['matchPitTag']
+        if matchData['matchPitTag'] != '-':
+            spotObj.baseTag = matchData['matchPitTag']
+        elif not spotObj.inGallery:
+            spotObj.baseTag = dataToCheck.imageId
+        spotObj.inGallery = True
+        spotObj.save()
+        #save the match details of the upload
+        dataToCheck.population = matching_image_list[0]['population']
+        dataToCheck.matchingImageId = json.dumps(matchData['matching_image_id_list'])
+        dataToCheck.matchingScore = json.dumps(matchData['matching_score_list'])
+        dataToCheck.status = 'Match Found'
+        dataToCheck.save()
+    #return
+    return results
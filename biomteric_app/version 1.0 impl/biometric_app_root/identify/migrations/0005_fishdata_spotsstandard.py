@@ -0,0 +1,66 @@
+import json
+import math
+import cv2
+import numpy
+from django.db import migrations, models
+
+
+# the nose and tail position in standard space
+STANDARD_NOSE = [100, 400]
+STANDARD_TAIL = [600, 400]
+
+
+def third_point(ref_1, ref_2):
+    # the generic third reference point used for the affine matrix, copied
+    # from opencv_fun.ref_affine_third so later library changes do not change
+    # this migration
+    angle = math.degrees(math.atan2(ref_2[1] - ref_1[1], ref_2[0] - ref_1[0])) + 180
+    dist = math.sqrt((float(ref_1[0]) - float(ref_2[0]))**2 +
+                     (float(ref_1[1]) - float(ref_2[1]))**2) / float(3)
+    middle = [(ref_1[0] + ref_2[0]) / float(2), (ref_1[1] + ref_2[1]) / float(2)]
+    radians = math.radians(360 + angle - 90)
+    return [int(middle[0] + dist * math.cos(radians)),
+            int(middle[1] + dist * math.sin(radians))]
+
+
+def standard_spots(spots, ref_nose, ref_tail):
+    # move the spots so the nose and tail are at STANDARD_NOSE and 
+    # STANDARD_TAIL (see fish_fun.standardize_pattern)
+    old = numpy.array([ref_nose, third_point(ref_nose, ref_tail), ref_tail],
+                      numpy.float32)
+    new = numpy.array([STANDARD_NOSE, third_point(STANDARD_NOSE, STANDARD_TAIL),
+                       STANDARD_TAIL], numpy.float32)
+    matrix = cv2.getAffineTransform(old, new)
+    points = numpy.asarray(spots, numpy.float64).reshape(-1, 2)
+    x = matrix[0, 0] * points[:, 0] + matrix[0, 1] * points[:, 1] + matrix[0, 2]
+    y = matrix[1, 0] * points[:, 0] + matrix[1, 1] * points[:, 1] + matrix[1, 2]
+    return numpy.stack([x, y], axis=1).astype(numpy.int64).tolist()
+
+
+def backfill_spots_standard(apps, schema_editor):
+    # calculate the standard space spots for the existing rows
+    FishData = apps.get_model('identify', 'FishData')
+    for data_individual in FishData.objects.all():
+        ref_nose = json.loads(data_individual.refNose) if data_individual.refNose else None
+        ref_tail = json.loads(data_individual.refTail) if data_individual.refTail else None
+        if ref_nose is None or ref_tail is None:
+            continue
+        spots = json.loads(data_individual.spots) if data_individual.spots else []
+        data_individual.spotsStandard = json.dumps(standard_spots(spots, ref_nose, ref_tail))
+        data_individual.save(update_fields=['spotsStandard'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0004_auto_20190924_1200'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fishdata',
+            name='spotsStandard',
+            field=models.TextField(blank=True),
+        ),
+        migrations.RunPython(backfill_spots_standard, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0005_fishdata_spotsstandard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identify',
+            name='matchingScore',
+            field=models.TextField(blank=True),
+        ),
+    ]
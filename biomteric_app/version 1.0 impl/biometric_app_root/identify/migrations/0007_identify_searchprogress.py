@@ -0,0 +1,17 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0006_identify_matchingscore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identify',
+            name='searchProgress',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
@@ -0,0 +1,110 @@
+import json
+import math
+import numpy
+from django.db import migrations, models
+
+
+# occupancy grid in standard space, nose at x=100 and tail at x=600
+GRID_BOUNDS = [100, 300, 600, 500]
+GRID_SIZE = [16, 8]
+
+
+def distance(point_a, point_b):
+    # misc_fun.distance
+    return math.sqrt(((float(point_a[0])-float(point_b[0]))**2) +
+                     ((float(point_a[1])-float(point_b[1]))**2))
+
+
+def pattern_stats(spots, spots_standard, ref_nose, ref_head, ref_tail):
+    # the prefilter statistics of features.pattern_stats, copied here with the
+    # same loops and order of operations so the existing rows get the same
+    # values as rows saved later, and later library changes do not change
+    # this migration
+    stats = {'spotCount': len(spots), 'spacingAverage': None,
+             'spacingClosest': None, 'noseTailRatio': None,
+             'gridSignature': ''}
+    if spots_standard is not None:
+        # average distance between every pair of different spots
+        # (opencv_fun.pattern_spacing_average)
+        dist_list = []
+        for spot_1 in spots_standard:
+            for spot_2 in spots_standard:
+                dist = distance(spot_1, spot_2)
+                if dist > 0:
+                    dist_list += [dist]
+        stats['spacingAverage'] = sum(dist_list)/float(len(dist_list)) if len(dist_list) > 0 else 0
+        # average distance to the closest other spot
+        # (opencv_fun.pattern_spacing_closest)
+        dist_list = []
+        for spot_1 in spots_standard:
+            dist_single = sorted([distance(spot_1, spot_2) for spot_2 in spots_standard])
+            if len(dist_single) > 1:
+                dist_list += [dist_single[1]]
+        stats['spacingClosest'] = sum(dist_list)/float(len(dist_list)) if len(dist_list) > 0 else 0
+        # occupancy grid with one bit per cell (features.grid_signature)
+        points = numpy.asarray(spots_standard, numpy.float64).reshape(-1, 2)
+        grid = numpy.zeros(GRID_SIZE[::-1], bool)
+        x = numpy.floor((points[:, 0] - GRID_BOUNDS[0]) * GRID_SIZE[0] /
+                        float(GRID_BOUNDS[2] - GRID_BOUNDS[0])).astype(int)
+        y = numpy.floor((points[:, 1] - GRID_BOUNDS[1]) * GRID_SIZE[1] /
+                        float(GRID_BOUNDS[3] - GRID_BOUNDS[1])).astype(int)
+        inside = (x >= 0) & (x < GRID_SIZE[0]) & (y >= 0) & (y < GRID_SIZE[1])
+        grid[y[inside], x[inside]] = True
+        stats['gridSignature'] = numpy.packbits(grid).tobytes().hex()
+    # ratio of the nose to head distance to the nose to tail distance
+    if ref_nose is not None and ref_head is not None and ref_tail is not None:
+        length = distance(ref_nose, ref_tail)
+        if length > 0:
+            stats['noseTailRatio'] = distance(ref_nose, ref_head) / float(length)
+    return stats
+
+
+def backfill_pattern_stats(apps, schema_editor):
+    # calculate the prefilter statistics for the existing rows
+    FishData = apps.get_model('identify', 'FishData')
+    for data_individual in FishData.objects.all():
+        stats = pattern_stats(
+            json.loads(data_individual.spots) if data_individual.spots else [],
+            json.loads(data_individual.spotsStandard) if data_individual.spotsStandard else None,
+            json.loads(data_individual.refNose) if data_individual.refNose else None,
+            json.loads(data_individual.refHead) if data_individual.refHead else None,
+            json.loads(data_individual.refTail) if data_individual.refTail else None)
+        for key in stats:
+            setattr(data_individual, key, stats[key])
+        data_individual.save(update_fields=list(stats))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0007_identify_searchprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fishdata',
+            name='spotCount',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='fishdata',
+            name='spacingAverage',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='fishdata',
+            name='spacingClosest',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='fishdata',
+            name='noseTailRatio',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='fishdata',
+            name='gridSignature',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.RunPython(backfill_pattern_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0008_fishdata_pattern_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fishdata',
+            name='baseTag',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='fishdata',
+            name='name',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='fishdata',
+            name='pitTag',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='fishdata',
+            name='population',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='fishdata',
+            name='report',
+            field=models.CharField(blank=True, db_index=True, max_length=50),
+        ),
+    ]
@@ -0,0 +1,71 @@
+import itertools
+import json
+import numpy
+from django.db import migrations, models
+
+
+# gaussian splatted grid of features.pattern_embedding
+GRID_BOUNDS = [100, 300, 600, 500]
+EMBEDDING_SIZE = [24, 8]
+EMBEDDING_SIGMA = 16
+
+
+def pattern_embedding(spots_standard):
+    # the fixed length embedding of features.pattern_embedding, copied here so
+    # later library changes do not change this migration
+    points = numpy.asarray(spots_standard, numpy.float64).reshape(-1, 2)
+    x = GRID_BOUNDS[0] + (numpy.arange(EMBEDDING_SIZE[0]) + 0.5) * \
+        (GRID_BOUNDS[2] - GRID_BOUNDS[0]) / float(EMBEDDING_SIZE[0])
+    y = GRID_BOUNDS[1] + (numpy.arange(EMBEDDING_SIZE[1]) + 0.5) * \
+        (GRID_BOUNDS[3] - GRID_BOUNDS[1]) / float(EMBEDDING_SIZE[1])
+    weight_x = numpy.exp(-(x[None, :] - points[:, 0:1])**2 / (2.0 * EMBEDDING_SIGMA**2))
+    weight_y = numpy.exp(-(y[None, :] - points[:, 1:2])**2 / (2.0 * EMBEDDING_SIGMA**2))
+    embedding = numpy.dot(weight_y.T, weight_x).ravel()
+    embedding = embedding - embedding.mean()
+    length = numpy.linalg.norm(embedding)
+    if length > 0:
+        embedding = embedding / length
+    return embedding.astype(numpy.float32)
+
+
+def identity_medoid(members):
+    # the sighting most similar to the others (see identities.identity_medoid)
+    standard = [x for x in members if x['spotsStandard']]
+    if len(standard) == 0:
+        return max(members, key=lambda x: len(json.loads(x['spots'] or '[]')))['imageId']
+    embeddings = numpy.array([pattern_embedding(json.loads(x['spotsStandard']))
+                              for x in standard])
+    totals = numpy.dot(embeddings, embeddings.T).sum(axis=1)
+    return standard[int(numpy.argmax(totals))]['imageId']
+
+
+def build_identities(apps, schema_editor):
+    # one identity for each baseTag of the existing rows
+    FishData = apps.get_model('identify', 'FishData')
+    Identity = apps.get_model('identify', 'Identity')
+    rows = (FishData.objects.exclude(baseTag='').order_by('baseTag')
+            .values('baseTag', 'imageId', 'spots', 'spotsStandard').iterator())
+    for baseTag, members in itertools.groupby(rows, lambda x: x['baseTag']):
+        members = list(members)
+        Identity.objects.create(baseTag=baseTag, 
+                                medoidImageId=identity_medoid(members),
+                                sightings=len(members))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0009_fishdata_tag_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Identity',
+            fields=[
+                ('baseTag', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('medoidImageId', models.IntegerField(default=0)),
+                ('sightings', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(build_identities, migrations.RunPython.noop),
+    ]
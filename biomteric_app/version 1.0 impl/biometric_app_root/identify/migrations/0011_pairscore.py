@@ -0,0 +1,27 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0010_identity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PairScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queryImageId', models.IntegerField(db_index=True)),
+                ('galleryImageId', models.IntegerField(db_index=True)),
+                ('method', models.CharField(max_length=50)),
+                ('paramsHash', models.CharField(max_length=40)),
+                ('score', models.IntegerField(default=0)),
+                ('matrix', models.TextField(blank=True)),
+            ],
+            options={
+                'unique_together': {('queryImageId', 'galleryImageId', 'method', 'paramsHash')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0011_pairscore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fishdata',
+            name='pipelineVersion',
+            field=models.IntegerField(default=0),
+        ),
+    ]
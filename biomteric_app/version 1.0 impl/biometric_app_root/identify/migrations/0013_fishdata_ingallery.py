@@ -0,0 +1,17 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0012_fishdata_pipelineversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fishdata',
+            name='inGallery',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+    ]
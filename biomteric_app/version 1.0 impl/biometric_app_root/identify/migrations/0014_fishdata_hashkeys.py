@@ -0,0 +1,93 @@
+import itertools
+import json
+import math
+import numpy
+from django.db import migrations, models
+
+
+# settings of the geometric hash (features.HASH_VERSION and HASH_*), the
+# stored keys start with the version so rows written here are generated
+# again by the gallery if the hash settings change later
+HASH_VERSION = 1
+HASH_NEIGHBOURS = 4
+HASH_RATIO_BINS = 40
+HASH_ANGLE_BINS = 48
+HASH_CELL_SIZE = 40
+
+
+def pattern_triangle_keys(points):
+    # the keys of opencv_fun.pattern_triangle_keys without expand, copied
+    # here with the same order of operations so the existing rows get the
+    # same keys as rows saved later, and later library changes do not change
+    # this migration
+    if len(points) < 3:
+        return numpy.zeros(0, numpy.int64)
+    # the closest neighbours of each point
+    dist = numpy.sqrt(((points[:, None, :] - points[None, :, :])**2).sum(axis=2))
+    number = min(HASH_NEIGHBOURS, len(points) - 1)
+    closest = numpy.argsort(dist, axis=1, kind='stable')[:, 1:number + 1]
+    # a triangle for each point and pair of its neighbours
+    pairs = numpy.array(list(itertools.combinations(range(number), 2)))
+    corners = numpy.stack([numpy.repeat(numpy.arange(len(points)), len(pairs)),
+                           closest[:, pairs[:, 0]].ravel(),
+                           closest[:, pairs[:, 1]].ravel()], axis=1)
+    # the side opposite each corner, sorted by length
+    opposite = numpy.array([[1, 2], [0, 2], [0, 1]])
+    sides = dist[corners[:, opposite[:, 0]], corners[:, opposite[:, 1]]]
+    order = numpy.argsort(sides, axis=1, kind='stable')
+    sides = numpy.take_along_axis(sides, order, axis=1)
+    # skip the triangles with two points in the same place
+    keep = sides[:, 0] > 0
+    corners, sides, order = corners[keep], sides[keep], order[keep]
+    if len(corners) == 0:
+        return numpy.zeros(0, numpy.int64)
+    # the angle of the longest side and the center of the triangle
+    ends = numpy.take_along_axis(corners, opposite[order[:, 2]], axis=1)
+    vector = points[ends[:, 1]] - points[ends[:, 0]]
+    angle = numpy.mod(numpy.arctan2(vector[:, 1], vector[:, 0]), math.pi)
+    center = points[corners].mean(axis=1)
+    # quantize the five values and combine them into one key
+    values = numpy.stack([numpy.floor(sides[:, 0] / sides[:, 2] * HASH_RATIO_BINS),
+                          numpy.floor(sides[:, 1] / sides[:, 2] * HASH_RATIO_BINS),
+                          numpy.floor(angle / math.pi * HASH_ANGLE_BINS) % HASH_ANGLE_BINS,
+                          numpy.floor(center[:, 0] / HASH_CELL_SIZE),
+                          numpy.floor(center[:, 1] / HASH_CELL_SIZE)], axis=1)
+    values = values.astype(numpy.int64)
+    values[:, 3:] += 512
+    values = numpy.clip(values, 0, 1023)
+    keys = numpy.zeros(len(values), numpy.int64)
+    for column in range(5):
+        keys = keys * 1024 + values[:, column]
+    return numpy.unique(keys)
+
+
+def stored_hash_keys(spots_standard):
+    # the text of features.stored_hash_keys, from the whole number spots
+    points = numpy.array(spots_standard or [], numpy.int32).reshape(-1, 2)
+    keys = numpy.asarray(pattern_triangle_keys(points.astype(numpy.float64)), '<i8')
+    return '%d:%s' % (HASH_VERSION, keys.tobytes().hex())
+
+
+def backfill_hash_keys(apps, schema_editor):
+    # store the geometric hash keys of the existing rows
+    FishData = apps.get_model('identify', 'FishData')
+    for data_individual in FishData.objects.all():
+        data_individual.hashKeys = stored_hash_keys(
+            json.loads(data_individual.spotsStandard) if data_individual.spotsStandard else None)
+        data_individual.save(update_fields=['hashKeys'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0013_fishdata_ingallery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fishdata',
+            name='hashKeys',
+            field=models.TextField(blank=True),
+        ),
+        migrations.RunPython(backfill_hash_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+def clear_scores(apps, schema_editor):
+    # the cached scores were saved without the inliers, they are aligned again
+    PairScore = apps.get_model('identify', 'PairScore')
+    PairScore.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0014_fishdata_hashkeys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pairscore',
+            name='inliers',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(clear_scores, migrations.RunPython.noop),
+    ]
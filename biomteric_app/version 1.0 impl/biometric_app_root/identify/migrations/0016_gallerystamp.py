@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+def create_stamp(apps, schema_editor):
+    # the single row holding the gallery change counter
+    GalleryStamp = apps.get_model('identify', 'GalleryStamp')
+    GalleryStamp.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identify', '0015_pairscore_inliers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GalleryStamp',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('changes', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_stamp, migrations.RunPython.noop),
+    ]
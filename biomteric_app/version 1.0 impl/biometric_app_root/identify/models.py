@@ -10,6 +10,8 @@ class Identify(models.Model):
     population = models.CharField(max_length=100, blank=True)
     tank = models.CharField(max_length=100, blank=False)
     matchingImageId = models.TextField(blank=True)
+    matchingScore = models.TextField(blank=True)
+    searchProgress = models.CharField(max_length=50, blank=True)
     status = models.CharField(max_length=50, blank=True)
     pitTag = models.CharField(max_length=50, blank=True)
     def str(self):
@@ -17,19 +19,57 @@ class Identify(models.Model):
 
 class FishData(models.Model):
     imageId = models.IntegerField(primary_key=True)
-    name = models.CharField(max_length=100, blank=True)
+    name = models.CharField(max_length=100, blank=True, db_index=True)
     imageUrl = models.ImageField(upload_to='dataset/', blank=True)
     spots = models.TextField(blank=True)
+    spotsStandard = models.TextField(blank=True)
     refNose = models.TextField(blank=True)
     refHead = models.TextField(blank=True)
     refTail = models.TextField(blank=True)
-    population = models.CharField(max_length=100, blank=True)
+    population = models.CharField(max_length=100, blank=True, db_index=True)
     tank = models.CharField(max_length=100, blank=False)
     date = models.CharField(max_length=50, blank=True)
     time = models.CharField(max_length=50, blank=True)
-    baseTag = models.CharField(max_length=50, blank=True)
-    pitTag = models.CharField(max_length=50, blank=True)
-    report = models.CharField(max_length=50, blank=True)
+    baseTag = models.CharField(max_length=50, blank=True, db_index=True)
+    pitTag = models.CharField(max_length=50, blank=True, db_index=True)
+    report = models.CharField(max_length=50, blank=True, db_index=True)
+    spotCount = models.IntegerField(default=0, db_index=True)
+    spacingAverage = models.FloatField(null=True, blank=True, db_index=True)
+    spacingClosest = models.FloatField(null=True, blank=True, db_index=True)
+    noseTailRatio = models.FloatField(null=True, blank=True, db_index=True)
+    gridSignature = models.CharField(max_length=32, blank=True)
+    hashKeys = models.TextField(blank=True)
+    pipelineVersion = models.IntegerField(default=0)
+    inGallery = models.BooleanField(default=True, db_index=True)
+
+    def str(self):
+        return str(self.imageId)
+
+class Identity(models.Model):
+    baseTag = models.CharField(max_length=50, primary_key=True)
+    medoidImageId = models.IntegerField(default=0)
+    sightings = models.IntegerField(default=0)
+
+    def str(self):
+        return str(self.baseTag)
+
+class PairScore(models.Model):
+    queryImageId = models.IntegerField(db_index=True)
+    galleryImageId = models.IntegerField(db_index=True)
+    method = models.CharField(max_length=50)
+    paramsHash = models.CharField(max_length=40)
+    score = models.IntegerField(default=0)
+    inliers = models.IntegerField(default=0)
+    matrix = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('queryImageId', 'galleryImageId', 'method', 'paramsHash')
+
+    def str(self):
+        return str(self.queryImageId) + '-' + str(self.galleryImageId)
+
+class GalleryStamp(models.Model):
+    changes = models.BigIntegerField(default=0)
 
     def str(self):
-        return str(self.imageId)
\ No newline at end of file
+        return str(self.changes)
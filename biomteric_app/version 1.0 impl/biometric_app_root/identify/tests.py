@@ -1 +1,1412 @@
 from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+import io
+import importlib
+import os
+import tempfile
+import json
+import math
+import random
+import time
+import collections
+import cv2
+import numpy
+
+from biometric_app_site.settings import JSON_ROOT
+from identification_library import assets
+from identification_library import batch
+from identification_library import features
+from identification_library import functions
+from identification_library import galleryfile
+from identification_library import gallery as gallery_module
+from identification_library.gallery import gallery, decode_points, decode_stats, decode_row, row_fields, GalleryArrays
+from identification_library.gallery import apply_change, stamp_move, read_snapshot
+from identification_library import identifyImage
+from identification_library.identities import identity_medoid, MEDOID_FIELDS
+from identification_library import parallel
+from identification_library import reidentify
+from identification_library import scorecache
+from identification_library.sweep import sweep_unmatched
+from identification_library.modules import fish_fun
+from identification_library.modules import misc_fun
+from identification_library.modules import opencv_fun
+from identification_library.modules import ref_fun
+from identification_library.modules import untidy_fun
+
+from identify.models import FishData, Identity, Identify, PairScore, GalleryStamp
+
+
+# number of tagged individuals loaded from the real spot dataset
+RECALL_TAGS = 100
+# number of untagged images added to the gallery as distractors
+RECALL_DISTRACTORS = 200
+
+
+def real_records():
+
+    """
+    DESCRIPTION
+    This function reads the real spot dataset and groups the images named
+    date_tag_side by tag and side, which are the sightings of one side of
+    one individual.
+
+    OUTPUT
+    records = a list of the images (see galleryfile.json_records)
+    groups = a list of lists of record numbers, one for each individual
+             with more than one image
+    """
+
+    records = galleryfile.json_records(os.path.join(JSON_ROOT, 'snapper-spot-data.json'))
+    groups = collections.defaultdict(list)
+    for key, record in enumerate(records):
+        parts = record['name'].split('_')
+        if len(parts) == 3:
+            groups[(parts[1], parts[2])].append(key)
+    groups = [groups[x] for x in sorted(groups) if len(groups[x]) > 1]
+    return records, groups
+
+
+def save_records(records):
+    #save the records as FishData rows, the signals fill in the features
+    for key, record in enumerate(records):
+        parts = record['name'].split('_')
+        FishData(imageId=key + 1, name=record['name'], population=record['population'],
+                 date=record['date'], tank='-', baseTag=parts[1], pitTag='-', report='-',
+                 spots=json.dumps(record['spots']), refNose=json.dumps(record['ref_nose']),
+                 refTail=json.dumps(record['ref_tail']),
+                 refHead=json.dumps(record['ref_head'])).save()
+
+
+def gallery_stats(new_individual):
+    #the prefilter statistics of an individual (see GalleryArrays.cascade)
+    return decode_stats(features.pattern_stats(
+        new_individual['spots'], new_individual['spots_standard'], new_individual['ref_nose'],
+        new_individual['ref_head'], new_individual['ref_tail']))
+
+
+class RealDataRecallTest(TestCase):
+
+    """
+    Recall of the candidate shortlists on a small part of the real spot
+    dataset: the share of queries with another image of the same individual
+    in the shortlist.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        groups = groups[:RECALL_TAGS]
+        tagged = set(x for group in groups for x in group)
+        untagged = [x for x in range(len(records)) if len(records[x]['name'].split('_')) == 2]
+        keep = sorted(tagged) + untagged[:RECALL_DISTRACTORS]
+        save_records([records[x] for x in keep])
+        cls.records = [records[x] for x in keep]
+        cls.groups = [[keep.index(x) for x in group] for group in groups]
+
+    def setUp(self):
+        gallery.load()
+        self.arrays = gallery.arrays()
+
+    def recall(self, shortlist, number):
+        #the share of queries with a sighting of the same individual in the shortlist
+        found = 0
+        queries = 0
+        for group in self.groups:
+            for key in group:
+                row = self.arrays.index[key + 1]
+                spots_standard = self.arrays.pattern_standard(row).tolist()
+                rows = [x for x in shortlist(spots_standard, number + 1) if x != row][:number]
+                found += any(self.arrays.index[x + 1] in rows for x in group if x != key)
+                queries += 1
+        return found / float(queries)
+
+    def test_hash_recall(self):
+        vote = self.arrays.vote
+        nearest = lambda pattern, number: self.arrays.nearest(
+            features.pattern_embedding(pattern), number)[0]
+        recall_vote = self.recall(lambda pattern, number: vote(pattern, number)[0], 10)
+        recall_nearest = self.recall(nearest, 10)
+        self.assertGreaterEqual(recall_vote, 0.9)
+        self.assertGreater(recall_vote, recall_nearest)
+
+    def query(self, row):
+        #a gallery row as a new individual
+        new_individual = self.arrays.individual(row)
+        new_individual['spots_standard'] = self.arrays.pattern_standard(row).tolist()
+        new_individual['name'] = self.arrays.info[row]['name']
+        return new_individual
+
+    def test_candidates_fallback(self):
+        #with a cap above the gallery size the shortlist and the fallback rows
+        #together are every row passing the cascade
+        shortlist_found = 0
+        found = 0
+        limit = gallery_module.FALLBACK_CANDIDATES
+        gallery_module.FALLBACK_CANDIDATES = len(self.arrays)
+        try:
+            for group in self.groups:
+                for key in group:
+                    row = self.arrays.index[key + 1]
+                    new_individual = self.query(row)
+                    shortlist = self.arrays.candidates(new_individual, True, set())[0]
+                    rest = self.arrays.candidates(new_individual, True, set(), fallback=True)[0]
+                    everything = [x for x in range(len(self.arrays)) if x != row]
+                    passed = self.arrays.cascade(*gallery_stats(new_individual), everything)[0]
+                    self.assertEqual(set(shortlist).intersection(rest), set())
+                    self.assertEqual(set(shortlist + rest), set(passed))
+                    truth = [self.arrays.index[x + 1] for x in group if x != key]
+                    shortlist_found += any(x in shortlist for x in truth)
+                    found += any(x in passed for x in truth)
+        finally:
+            gallery_module.FALLBACK_CANDIDATES = limit
+        #most queries find their match in the shortlist, without the fallback
+        self.assertGreaterEqual(shortlist_found / float(found), 0.9)
+
+    def test_candidates_fallback_cap(self):
+        #the fallback aligns at most FALLBACK_CANDIDATES rows, the nearest by
+        #embedding after the shortlist
+        limit = gallery_module.FALLBACK_CANDIDATES
+        gallery_module.FALLBACK_CANDIDATES = 20
+        try:
+            for key in self.groups[0]:
+                row = self.arrays.index[key + 1]
+                new_individual = self.query(row)
+                shortlist = self.arrays.candidates(new_individual, True, set())[0]
+                rest = self.arrays.candidates(new_individual, True, set(), fallback=True)[0]
+                self.assertLessEqual(len(rest), 20)
+                self.assertEqual(set(shortlist).intersection(rest), set())
+                #the rows aligned are the nearest rows outside the shortlist
+                nearest = self.arrays.nearest(
+                    features.pattern_embedding(new_individual['spots_standard']),
+                    len(self.arrays))[0]
+                voted = self.arrays.vote(new_individual['spots_standard'],
+                                         gallery_module.HASH_CANDIDATES)[0]
+                skipped = set(voted + nearest[:gallery_module.EMBEDDING_CANDIDATES] + 
+                              self.arrays.unhashed)
+                following = [x for x in nearest if x not in skipped][:20]
+                self.assertTrue(set(rest) <= set(following))
+                self.assertLess(len(rest), len(self.arrays) - len(shortlist) - 1)
+        finally:
+            gallery_module.FALLBACK_CANDIDATES = limit
+
+    def test_cascade_recall(self):
+        #the cascade keeps every sighting fish_ransac aligns as a match (see
+        #the benchmark_cascade command for the whole dataset)
+        matches = 0
+        for group in self.groups:
+            for key in group:
+                row = self.arrays.index[key + 1]
+                new_individual = self.query(row)
+                truth = [self.arrays.index[x + 1] for x in group if x != key]
+                values = functions.score_gallery_rows(self.arrays, new_individual, truth,
+                                                      'fish_ransac')
+                truth = [x for x, value in zip(truth, values)
+                         if value > identifyImage.MATCH_QUALITY]
+                passed = self.arrays.cascade(*gallery_stats(new_individual), truth)[0]
+                self.assertEqual(passed, truth)
+                matches += len(truth)
+        self.assertGreater(matches, len(self.groups))
+
+
+class PatternStatsTest(TestCase):
+
+    """
+    The prefilter statistics and hash keys backfilled by migrations 0008 and
+    0014 are the same as those of a row saved later.
+    """
+
+    def test_migration_stats(self):
+        migration = importlib.import_module('identify.migrations.0008_fishdata_pattern_stats')
+        for record in real_records()[0][:100]:
+            spots_standard = features.standard_spots(record['spots'], record['ref_nose'],
+                                                     record['ref_tail'])
+            spots_standard = json.loads(json.dumps(spots_standard))
+            refs = [record['ref_nose'], record['ref_head'], record['ref_tail']]
+            self.assertEqual(migration.pattern_stats(record['spots'], spots_standard, *refs),
+                             features.pattern_stats(record['spots'], spots_standard, *refs))
+
+    def test_migration_hash_keys(self):
+        #the hash keys backfilled by migration 0014 are the keys of a row saved later
+        migration = importlib.import_module('identify.migrations.0014_fishdata_hashkeys')
+        for record in real_records()[0][:100]:
+            spots_standard = features.standard_spots(record['spots'], record['ref_nose'],
+                                                     record['ref_tail'])
+            spots_standard = json.loads(json.dumps(spots_standard))
+            self.assertEqual(migration.stored_hash_keys(spots_standard),
+                             features.stored_hash_keys(spots_standard))
+        self.assertEqual(migration.stored_hash_keys(None), features.stored_hash_keys(None))
+
+
+def rebuilt(packed):
+    #the snapshot built from the database in the same row order
+    items = [decode_row(row_fields(FishData.objects.get(pk=x['imageId']))) for x in packed.info]
+    return GalleryArrays([x['pattern'] for x in items], [x['pattern_standard'] for x in items],
+                         [x['refs'] for x in items], [x['info'] for x in items],
+                         [x['keys'] for x in items], [x['stats'] for x in items],
+                         [x['grid'] for x in items], [x['embedding'] for x in items],
+                         dict(Identity.objects.values_list('baseTag', 'medoidImageId')))
+
+
+class GalleryUpdateTest(TestCase):
+
+    """
+    The snapshot updated one row at a time by the FishData signals is the
+    same as the snapshot built from the database.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        save_records(records[:60])
+        cls.records = records[60:80]
+
+    def setUp(self):
+        gallery.load()
+
+    def snapshot(self, packed):
+        #the snapshot as opened by the worker processes of parallel.py
+        path = os.path.join(tempfile.mkdtemp(), 'gallery.snapshot')
+        packed.write(path)
+        return read_snapshot(path)
+
+    def assertSameSnapshot(self, packed, expected):
+        for name in ['spots', 'spots_standard', 'offsets', 'standard', 'ref_nose', 'ref_tail',
+                     'ref_head', 'stats', 'grid', 'embedding', 'hash_counts', 'representative']:
+            numpy.testing.assert_array_equal(getattr(packed, name), getattr(expected, name), name)
+        for name in ['info', 'order', 'index', 'unhashed', 'sightings', 'names']:
+            self.assertEqual(getattr(packed, name), getattr(expected, name), name)
+        #keys with the same value may be in any row order
+        numpy.testing.assert_array_equal(packed.hash_keys, expected.hash_keys)
+        self.assertEqual(sorted(zip(packed.hash_keys.tolist(), packed.hash_rows.tolist())),
+                         sorted(zip(expected.hash_keys.tolist(), expected.hash_rows.tolist())))
+
+    def test_updates(self):
+        state = random.Random(4)
+        base = self.snapshot(gallery.arrays())
+        for step in range(40):
+            imageIds = list(gallery.arrays().index)
+            action = state.choice(['add', 'spots', 'baseTag', 'date', 'delete', 'identity'])
+            if action == 'add' and self.records:
+                record = self.records.pop()
+                FishData(imageId=1000 + step, name=record['name'], date=record['date'],
+                         tank='-', baseTag=state.choice(['', 'a', 'b']), pitTag='-', report='-',
+                         spots=json.dumps(record['spots']), refNose=json.dumps(record['ref_nose']),
+                         refTail=json.dumps(record['ref_tail']),
+                         refHead=json.dumps(record['ref_head'])).save()
+            elif action == 'delete':
+                FishData.objects.get(pk=state.choice(imageIds)).delete()
+            elif action == 'identity':
+                Identity(baseTag=state.choice(['a', 'b']), 
+                         medoidImageId=state.choice(imageIds)).save()
+            else:
+                data_individual = FishData.objects.get(pk=state.choice(imageIds))
+                if action == 'spots':
+                    data_individual.spots = json.dumps(json.loads(data_individual.spots)[1:])
+                elif action == 'baseTag':
+                    data_individual.baseTag = state.choice(['', 'a', 'b'])
+                else:
+                    data_individual.date = state.choice(['2015-01-01', '2016-09-23'])
+                data_individual.save()
+            self.assertSameSnapshot(gallery.arrays(), rebuilt(gallery.arrays()))
+            #the workers of parallel.py reach the same snapshot from the changes,
+            #until the gallery starts again from a new snapshot
+            changes = gallery.changes_between(base.version, gallery.arrays().version)
+            if changes is None:
+                base = self.snapshot(gallery.arrays())
+                changes = []
+            packed = base
+            for change in changes:
+                packed = apply_change(packed, change)
+            self.assertSameSnapshot(packed, gallery.arrays())
+
+    def test_snapshot_file(self):
+        #the snapshot file gives back the snapshot, as read-only arrays
+        Identity(baseTag='a', medoidImageId=gallery.arrays().info[0]['imageId']).save()
+        packed = self.snapshot(gallery.arrays())
+        self.assertSameSnapshot(packed, gallery.arrays())
+        self.assertEqual(packed.identities, gallery.arrays().identities)
+        self.assertEqual(packed.version, gallery.arrays().version)
+        self.assertFalse(packed.spots.flags.writeable)
+        row = gallery.arrays().order[0]
+        new_individual = packed.individual(row)
+        new_individual['spots_standard'] = packed.pattern_standard(row).tolist()
+        new_individual['name'] = 'query'
+        self.assertEqual(packed.candidates(new_individual, True, set()),
+                         gallery.arrays().candidates(new_individual, True, set()))
+
+    def test_saved_row(self):
+        #the old row is read from the gallery instead of the database
+        data_individual = FishData.objects.order_by('imageId').first()
+        data_individual.baseTag = 'changed'
+        self.assertEqual(gallery.saved_row(data_individual)['scoresChanged'], False)
+        data_individual.refHead = json.dumps([1, 2])
+        self.assertEqual(gallery.saved_row(data_individual)['scoresChanged'], True)
+        self.assertNotEqual(gallery.saved_row(data_individual)['baseTag'], 'changed')
+
+    def test_hash_keys(self):
+        #the keys stored with each row are the keys of its standard spots
+        for data_individual in FishData.objects.all():
+            fields = row_fields(data_individual)
+            keys = features.hash_keys(decode_row(fields)['pattern_standard'])
+            numpy.testing.assert_array_equal(features.decode_hash_keys(fields['hashKeys']), keys)
+        #the keys of an older hash are generated again
+        fields['hashKeys'] = '0:'
+        numpy.testing.assert_array_equal(decode_row(fields)['keys'], keys)
+
+    def test_stamp(self):
+        #a change saved without the signals is seen once the stamp is moved
+        imageId = gallery.arrays().info[0]['imageId']
+        FishData.objects.filter(pk=imageId).update(baseTag='updated')
+        self.assertNotEqual(gallery.arrays().info[0]['baseTag'], 'updated')
+        gallery.touch()
+        self.assertEqual(gallery.arrays().info[gallery.arrays().index[imageId]]['baseTag'], 'updated')
+        #a change made through the signals does not load the gallery again
+        packed = gallery.arrays()
+        data_individual = FishData.objects.get(pk=imageId)
+        data_individual.baseTag = 'saved'
+        data_individual.save()
+        self.assertTrue(gallery.current())
+        self.assertEqual(gallery.arrays().version[0], packed.version[0])
+        #the change counter is a single row which moves by one for each change
+        changes = GalleryStamp.objects.get().changes
+        gallery.touch(True)
+        self.assertEqual(GalleryStamp.objects.get().changes, changes + 1)
+        self.assertTrue(gallery.current())
+        #a change made by another process loads the gallery again
+        stamp_move()
+        self.assertFalse(gallery.current())
+        self.assertNotEqual(gallery.arrays().version[0], packed.version[0])
+
+
+class StoredUnmatchedTest(TestCase):
+
+    """
+    The spots of an upload which found no match are kept outside the gallery
+    and searched again by searchStoredData and the sweep.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        save_records([records[x] for x in range(40) if x not in groups[0]])
+        cls.query = records[groups[0][0]]
+        cls.sighting = records[groups[0][1]]
+
+    def setUp(self):
+        gallery.load()
+        FishData(imageId=500, name=self.query['name'], date=self.query['date'], tank='-',
+                 baseTag='', pitTag='-', report='-', spots=json.dumps(self.query['spots']),
+                 refNose=json.dumps(self.query['ref_nose']), refTail=json.dumps(self.query['ref_tail']),
+                 refHead=json.dumps(self.query['ref_head']),
+                 pipelineVersion=identifyImage.PIPELINE_VERSION, inGallery=False).save()
+        Identify(imageId=500, username='test', tank='-', pitTag='-', status='Match not Found').save()
+
+    def test_not_in_gallery(self):
+        self.assertNotIn(500, gallery.arrays().index)
+        gallery.load()
+        self.assertNotIn(500, gallery.arrays().index)
+        #the stored spots are searched without the image
+        result = identifyImage.searchStoredData(500, '-')
+        self.assertEqual(result['new_individual']['spots'], self.query['spots'])
+        self.assertNotIn(500, result.get('matching_image_id_list', []))
+
+    def test_deadline(self):
+        #a search whose deadline has passed reports the part it checked
+        new_individual = identifyImage.storedIndividual(FishData.objects.get(pk=500))
+        matchData = identifyImage.getBioMatchData(gallery.arrays(), new_individual,
+                                                  identifyImage.METHODS, identifyImage.MATCH_QUALITY,
+                                                  1, identifyImage.MATCH_TOP, time.time() - 1)
+        self.assertFalse(matchData['searchComplete'])
+        checked, total = [int(x) for x in matchData['searchProgress'].split('/')]
+        self.assertGreater(total, 0)
+        self.assertLess(checked, total)
+        #the view keeps the progress of the search with the upload
+        Identify.objects.filter(pk=500).update(image='images/query.jpg')
+        deadline_ms = identifyImage.DEADLINE_MS
+        identifyImage.DEADLINE_MS = -1000
+        try:
+            self.client.post('/identify/identify_list/try-again/', {'imageId': 500},
+                             HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        finally:
+            identifyImage.DEADLINE_MS = deadline_ms
+        identifyObj = Identify.objects.get(pk=500)
+        self.assertEqual(identifyObj.status, 'Match not Found')
+        self.assertEqual(identifyObj.searchProgress, matchData['searchProgress'])
+
+    def test_sweep(self):
+        FishData(imageId=501, name=self.sighting['name'], date=self.sighting['date'], tank='-',
+                 baseTag='', pitTag='-', report='-', spots=json.dumps(self.sighting['spots']),
+                 refNose=json.dumps(self.sighting['ref_nose']),
+                 refTail=json.dumps(self.sighting['ref_tail']),
+                 refHead=json.dumps(self.sighting['ref_head'])).save()
+        results = sweep_unmatched(gallery.arrays(), [501], 'fish_ransac', 12, 5)
+        self.assertEqual(results, {'searched': 1, 'matched': 1})
+        self.assertEqual(json.loads(Identify.objects.get(pk=500).matchingImageId), [501])
+        #the upload joins the gallery once it has a match
+        self.assertIn(500, gallery.arrays().index)
+        self.assertEqual(FishData.objects.get(pk=500).baseTag, '500')
+
+
+class GalleryFileTest(TestCase):
+
+    """
+    The gallery export file gives back the records written to it, and
+    importing it keeps the baseTag and tank of each image.
+    """
+
+    def setUp(self):
+        self.records = real_records()[0][:50]
+        self.path = os.path.join(tempfile.mkdtemp(), 'gallery.bin')
+        galleryfile.write_gallery_file(self.path, self.records)
+
+    def test_records(self):
+        stored = galleryfile.GalleryFile(self.path)
+        for row, record in enumerate(self.records):
+            self.assertEqual(stored.record(row), dict(record, ref_nose=[float(x) for x in record['ref_nose']],
+                                                      ref_tail=[float(x) for x in record['ref_tail']],
+                                                      ref_head=[float(x) for x in record['ref_head']]))
+        population = self.records[0]['population']
+        self.assertEqual(stored.population_rows(population).tolist(),
+                         [x for x in range(50) if self.records[x]['population'] == population])
+        self.assertEqual(stored.code('not in the file'), -1)
+
+    def test_import(self):
+        call_command('gallery_file', 'import', self.path, stdout=io.StringIO())
+        self.assertEqual(FishData.objects.count(), 50)
+        for data_individual in FishData.objects.all():
+            self.assertEqual(data_individual.baseTag, data_individual.name.split('_')[1])
+            self.assertEqual(data_individual.tank, '-')
+        #the imported rows are in the gallery
+        self.assertEqual(len(gallery.arrays()), 50)
+
+    def test_import_ids(self):
+        #images without an imageId get negative imageIds, below the imageIds
+        #of earlier imports, which uploads by time can not reach
+        call_command('gallery_file', 'import', self.path, stdout=io.StringIO())
+        imageIds = sorted(FishData.objects.values_list('imageId', flat=True))
+        self.assertEqual(imageIds, list(range(-50, 0)))
+        path = os.path.join(os.path.dirname(self.path), 'more.bin')
+        records = [dict(x, name=x['name'] + '_copy') for x in self.records[:5]]
+        records[0]['imageId'] = 1600000000
+        galleryfile.write_gallery_file(path, records)
+        call_command('gallery_file', 'import', path, stdout=io.StringIO())
+        imageIds = sorted(FishData.objects.values_list('imageId', flat=True))
+        self.assertEqual(imageIds, list(range(-54, 0)) + [1600000000])
+        #the exported imageIds are read back
+        export = os.path.join(os.path.dirname(self.path), 'export.bin')
+        call_command('gallery_file', 'export', export, stdout=io.StringIO())
+        self.assertEqual(sorted(galleryfile.GalleryFile(export).imageId.tolist()), imageIds)
+
+
+class AssetsTest(TestCase):
+
+    """
+    A change of a JSON asset is made to a fresh copy, so the value already
+    returned to other callers does not change.
+    """
+
+    def setUp(self):
+        self.root = assets.JSON_ROOT
+        assets.JSON_ROOT = tempfile.mkdtemp()
+        with open(os.path.join(assets.JSON_ROOT, 'memory_contours.json'), 'w') as json_file:
+            json.dump({'snapper': [{'contour_method': 0}]}, json_file)
+
+    def tearDown(self):
+        assets._cache.pop('memory_contours.json', None)
+        assets.JSON_ROOT = self.root
+
+    def test_update_json(self):
+        memory = assets.memory_contours()
+        for unit in range(1, 1005):
+            assets.update_json('memory_contours.json', lambda value: untidy_fun.add_memory_unit(
+                value, 'snapper', {'contour_method': unit}))
+        self.assertEqual(memory, {'snapper': [{'contour_method': 0}]})
+        #the latest 1000 parameter sets are kept
+        self.assertEqual([x['contour_method'] for x in assets.memory_contours()['snapper']],
+                         list(range(5, 1005)))
+
+
+def old_contour_pt_angle(image, pos, angle):
+    #opencv_fun.contour_pt_angle before it stopped walking a 5000x5000 image
+    #of the contour, with the image drawn once by the caller
+    for x in range(5, 1000):
+        new_pt = misc_fun.point_distance(pos, x, angle + 180)
+        if image[new_pt[1]][new_pt[0]][0] == 0:
+            return new_pt
+    return None
+
+
+def old_contour_to_profile(contour, ref_point):
+    #opencv_fun.contour_to_profile before it used cumulative segment lengths
+    profile = []
+    for loop in range(len(contour)):
+        value = misc_fun.distance(ref_point, contour[loop][0])
+        around = cv2.arcLength(contour[:loop + 1], False)
+        profile += [[around, value]]
+    return profile
+
+
+def old_contours_overlap(contour_1, contour_2):
+    #opencv_fun.contours_overlap before it only drew the bounding box
+    blank1 = numpy.zeros((5000, 5000, 1), numpy.uint8)
+    cv2.drawContours(blank1, [contour_1], 0, (255), -1)
+    cv2.drawContours(blank1, [contour_2], 0, (0), -1)
+    blank2 = numpy.zeros((5000, 5000, 1), numpy.uint8)
+    cv2.drawContours(blank2, [contour_2], 0, (255), -1)
+    cv2.drawContours(blank2, [contour_1], 0, (0), -1)
+    return (cv2.countNonZero(blank1) / float(cv2.contourArea(contour_1)) +
+            cv2.countNonZero(blank2) / float(cv2.contourArea(contour_2))) / float(2)
+
+
+def old_filter_contours_cluster(contours, size, number):
+    #opencv_fun.filter_contours_cluster before it only drew the bounding box
+    blank1 = numpy.zeros((2000, 2000, 1), numpy.uint8)
+    cv2.drawContours(blank1, contours, -1, 255, -1)
+    dilation = cv2.dilate(blank1, numpy.ones((size, size), numpy.uint8), iterations=number)
+    ret, img_mask = cv2.threshold(dilation, 100, 255, cv2.THRESH_BINARY)
+    clusters, hierarchy = cv2.findContours(img_mask, 1, 2)
+    cluster_max = max([cv2.contourArea(x) for x in clusters])
+    cluster = [x for x in clusters if cv2.contourArea(x) == cluster_max]
+    return [x for x in contours if cv2.pointPolygonTest(
+        cluster[0], tuple(opencv_fun.contour_center(x)), True) > 0]
+
+
+def old_contour_crosssection(contour, position, angle_cross_1):
+    #opencv_fun.contour_crosssection before the positions were batched
+    angle_cross_2 = misc_fun.degrees_limit_range(angle_cross_1 + 180)
+    data = []
+    for x in range(0, len(contour) - 1):
+        angle_1 = misc_fun.degrees(position, contour[x][0])
+        angle_2 = misc_fun.degrees(position, contour[x + 1][0])
+        if abs(angle_1 - angle_2) < 20:
+            angle_list = sorted([angle_1, angle_2])
+            if angle_list[0] <= angle_cross_1 <= angle_list[1]:
+                data += [[contour[x][0], contour[x + 1][0]]]
+            if angle_list[0] <= angle_cross_2 <= angle_list[1]:
+                data += [[contour[x][0], contour[x + 1][0]]]
+    position_out = None
+    distance_max = 0
+    if len(data) > 1:
+        for x in data:
+            for y in data:
+                if misc_fun.distance(x[0], y[0]) >= distance_max:
+                    distance_max = misc_fun.distance(x[0], y[0])
+                    position_out = [x[0], y[0]]
+    return position_out
+
+
+def old_ref_tail_across(fish):
+    #fish_fun.ref_tail_across before the cross-sections were batched
+    pos_low, pos_high, line = opencv_fun.contour_center_line(fish)
+    angle_top = misc_fun.degrees_limit_range(misc_fun.degrees(pos_low, pos_high) + 90)
+    data_width = []
+    for x in range(pos_low[0], pos_high[0]):
+        proportion = (x - pos_low[0]) / float(pos_high[0] - pos_low[0])
+        if 0.7 < proportion < 0.9:
+            center_pos = misc_fun.point_mid(pos_low, pos_high, proportion)
+            cross_section_points = old_contour_crosssection(fish, center_pos, angle_top)
+            if cross_section_points is not None:
+                points_out = misc_fun.distant_points(cross_section_points)
+                width = misc_fun.distance(points_out[0], points_out[1])
+                data_width += [[proportion, width, center_pos, points_out[0], points_out[1]]]
+    width_min = min([x[1] for x in data_width])
+    data_width = [x for x in data_width if x[1] == width_min]
+    data_points = sorted([data_width[0][3], data_width[0][4]], key=lambda x: x[1])
+    return data_points[0].tolist(), data_points[1].tolist()
+
+
+def old_ref_tail_upper(fish):
+    #fish_fun.ref_tail_upper before it moved to ref_fun
+    fish = fish.tolist()
+    pos_1 = min(x[0][0] for x in fish)
+    pos_2 = max(x[0][0] for x in fish)
+    limit = int(pos_1 + ((pos_2 - pos_1)*0.80))
+    new_fish = [x for x in fish if x[0][0] >= limit]
+    value_1 = min(x[0][1] for x in new_fish)
+    for x in new_fish:
+        if x[0][1] == value_1:
+            return x[0]
+
+
+def old_ref_fish_lips(fish):
+    #fish_fun.ref_fish_lips before it moved to ref_fun
+    center = opencv_fun.contour_center(fish)
+    pos_1 = min(x[0][0] for x in fish)
+    pos_2 = max(x[0][0] for x in fish)
+    limit = int(pos_1 + ((pos_2 - pos_1)*0.05))
+    front_fish = numpy.array([x for x in fish if x[0][0] <= limit])
+    profile_1 = old_contour_to_profile(front_fish, center)
+    approx = cv2.approxPolyDP(front_fish, 0.065*cv2.arcLength(front_fish, False), False)
+    profile_2 = old_contour_to_profile(approx, center)
+    ratio = max([x[0] for x in profile_1]) / float(max([x[0] for x in profile_2]))
+    profile_2 = [[x[0] * ratio, x[1]] for x in profile_2]
+    second = {6: 4, 5: 3, 4: 2}.get(len(profile_2), 1)
+    nose = []
+    for target in [profile_2[1], profile_2[second]]:
+        dist = 10000000
+        for loop in range(len(profile_1)):
+            if abs(target[0] - profile_1[loop][0]) < dist:
+                dist = abs(target[0] - profile_1[loop][0])
+                nose_out = front_fish[loop][0]
+        nose += [nose_out.tolist()]
+    return tuple(sorted(nose, key=lambda x: x[1])) if nose[0][1] != nose[1][1] else (nose[1], nose[0])
+
+
+def old_ref_fish_head(fish, ref_nose, ref_tail):
+    #fish_fun.ref_fish_head before it moved to ref_fun
+    ref_head = None
+    angle = math.atan2(ref_tail[1] - ref_nose[1], ref_tail[0] - ref_nose[0])*(180/math.pi)
+    pos_start = [int(ref_nose[0] + ((ref_tail[0] - ref_nose[0])*0.3)),
+                 int(ref_nose[1] + ((ref_tail[1] - ref_nose[1])*0.3))]
+    closest = 1000
+    for x in fish:
+        test_angle = math.atan2(pos_start[1] - x[0][1], pos_start[0] - x[0][0])*(180/math.pi)
+        if abs(test_angle - (90 + angle)) < closest:
+            closest = abs(test_angle - (90 + angle))
+            ref_head = numpy.ndarray.tolist(x[0])
+    return ref_head
+
+
+class ContourEdgeTest(TestCase):
+
+    """
+    The contour functions give the same results as the versions they
+    replaced, on the stored shape templates.
+    """
+
+    def setUp(self):
+        self.fishes = list(assets.memory_shapes()['snapper'].values())[:10]
+        self.state = random.Random(5)
+
+    def test_contour_pts_angle(self):
+        for fish in self.fishes:
+            image = numpy.zeros((5000, 5000, 3), numpy.uint8)
+            cv2.drawContours(image, [fish], -1, (255, 255, 255), -1)
+            low = fish.reshape(-1, 2).min(axis=0)
+            high = fish.reshape(-1, 2).max(axis=0)
+            #searches from the center and from points inside and outside the fish
+            positions = [opencv_fun.contour_center(fish)] + [
+                [self.state.uniform(low[0], high[0]), self.state.uniform(low[1], high[1])]
+                for x in range(5)]
+            positions = [x for x in positions for y in range(10)]
+            angles = [self.state.uniform(0, 360) for x in positions]
+            self.assertEqual(opencv_fun.contour_pts_angle(fish, positions, angles),
+                             [old_contour_pt_angle(image, x, y) for x, y in zip(positions, angles)])
+            self.assertEqual(opencv_fun.contour_pt_angle(fish, positions[0], angles[0]),
+                             old_contour_pt_angle(image, positions[0], angles[0]))
+
+    def test_contour_to_profile(self):
+        for fish in self.fishes:
+            center = opencv_fun.contour_center(fish)
+            numpy.testing.assert_array_equal(opencv_fun.contour_to_profile(fish, center),
+                                             numpy.array(old_contour_to_profile(fish, center)))
+            #the open tail contour searched by ref_fun.ref_tail_fork
+            tail = fish[fish[:, 0, 0] >= numpy.percentile(fish[:, 0, 0], 80)]
+            numpy.testing.assert_array_equal(opencv_fun.contour_to_profile(tail, center),
+                                             numpy.array(old_contour_to_profile(tail, center)).reshape(-1, 2))
+
+    def test_contours_overlap(self):
+        for contour_1, contour_2 in zip(self.fishes, self.fishes[1:]):
+            self.assertEqual(opencv_fun.contours_overlap(contour_1, contour_2),
+                             old_contours_overlap(contour_1, contour_2))
+            shifted = contour_1 + numpy.int32([7, -4])
+            self.assertEqual(opencv_fun.contours_overlap(contour_1, shifted),
+                             old_contours_overlap(contour_1, shifted))
+
+    def test_filter_contours_cluster(self):
+        for trial in range(5):
+            #three clusters of small round spots
+            spots = []
+            for cluster in range(3):
+                x = self.state.randint(200, 1800)
+                y = self.state.randint(200, 1800)
+                for spot in range(self.state.randint(3, 12)):
+                    center = (x + self.state.randint(-80, 80), y + self.state.randint(-80, 80))
+                    spots += [cv2.ellipse2Poly(center, (self.state.randint(3, 8),) * 2,
+                                               0, 0, 360, 30).reshape(-1, 1, 2)]
+            self.assertEqual([x.tolist() for x in opencv_fun.filter_contours_cluster(spots, 5, 3)],
+                             [x.tolist() for x in old_filter_contours_cluster(spots, 5, 3)])
+
+    def test_contour_crosssections(self):
+        for fish in self.fishes[:3]:
+            low = fish.reshape(-1, 2).min(axis=0)
+            high = fish.reshape(-1, 2).max(axis=0)
+            positions = [[self.state.uniform(low[0], high[0]), self.state.uniform(low[1], high[1])]
+                         for x in range(10)]
+            angle = self.state.uniform(0, 360)
+            plain = lambda points: None if points is None else [x.tolist() for x in points]
+            self.assertEqual([plain(x) for x in opencv_fun.contour_crosssections(fish, positions, angle)],
+                             [plain(old_contour_crosssection(fish, x, angle)) for x in positions])
+            self.assertEqual(fish_fun.ref_tail_across(fish), old_ref_tail_across(fish))
+
+    def test_ref_points(self):
+        #the reference points moved to ref_fun are the points of the old loops
+        for fish in assets.memory_shapes()['snapper'].values():
+            self.assertEqual(ref_fun.ref_tail_upper(fish), old_ref_tail_upper(fish))
+            self.assertEqual(ref_fun.ref_fish_lips(fish), old_ref_fish_lips(fish))
+            self.assertEqual(fish_fun.ref_fish_lips(fish), ref_fun.ref_fish_lips(fish))
+            ref_nose = fish_fun.ref_fish_lips(fish)[0]
+            ref_tail = fish_fun.ref_tail_across(fish)[0]
+            self.assertEqual(fish_fun.ref_fish_head(fish, ref_nose, ref_tail),
+                             old_ref_fish_head(fish, ref_nose, ref_tail))
+
+
+def old_compare_patterns(pattern_1, pattern_2):
+    #fish_fun.compare_patterns before it used a distance matrix
+    dist_list = []
+    for spot in pattern_1:
+        dist = [misc_fun.distance(spot, x) for x in pattern_2]
+        dist_min = min(dist)
+        closest = dist.index(min(dist))
+        dist_min_2 = min([misc_fun.distance(pattern_2[closest], x) for x in pattern_1])
+        if dist_min == dist_min_2:
+            dist.sort()
+            if dist[0] == 0:
+                dist_list += [[dist_min, 0]]
+            else:
+                dist_list += [[dist_min, dist[0] / float(dist[1])]]
+    return dist_list
+
+
+class PatternMatchTest(TestCase):
+
+    """
+    The vectorized pattern comparison and alignment give the same results as
+    the versions they replaced, on the real spot dataset.
+    """
+
+    def setUp(self):
+        self.records = real_records()[0][:60]
+        self.state = random.Random(2)
+
+    def jitter(self, pattern):
+        #a copy of a pattern with each spot moved by a few pixels
+        return [[x + self.state.randint(-3, 3), y + self.state.randint(-3, 3)] for x, y in pattern]
+
+    def test_compare_patterns(self):
+        for record_1, record_2 in zip(self.records[::2], self.records[1::2]):
+            for pattern in [record_2['spots'], self.jitter(record_1['spots'])]:
+                self.assertEqual(fish_fun.compare_patterns(record_1['spots'], pattern),
+                                 old_compare_patterns(record_1['spots'], pattern))
+        #spots at equal distances
+        grid_1 = [[x * 10, y * 10] for x in range(6) for y in range(6)]
+        grid_2 = [[x * 10 + 5, y * 10] for x in range(6) for y in range(6)]
+        self.assertEqual(fish_fun.compare_patterns(grid_1, grid_2),
+                         old_compare_patterns(grid_1, grid_2))
+
+    def test_compare_patterns_kdtree(self):
+        #the KD-tree path used for large patterns gives the same values
+        if fish_fun.cKDTree is None:
+            self.skipTest('scipy is not installed')
+        pattern_1 = [[self.state.randint(0, 500), self.state.randint(0, 300)] for x in range(250)]
+        pattern_2 = self.jitter(pattern_1)[:230] + pattern_1[:20]
+        self.assertGreater(len(pattern_1) * len(pattern_2), fish_fun.KDTREE_LIMIT)
+        self.assertEqual(fish_fun.compare_patterns(pattern_1, pattern_2),
+                         old_compare_patterns(pattern_1, pattern_2))
+        for record_1, record_2 in zip(self.records[::2], self.records[1::2]):
+            points_1 = numpy.array(record_1['spots'], numpy.float64)
+            points_2 = numpy.array(record_2['spots'], numpy.float64)
+            for tree, matrix in zip(fish_fun.compare_patterns_kdtree(points_1, points_2),
+                                    fish_fun.compare_patterns_matrix(points_1, points_2)):
+                numpy.testing.assert_array_equal(tree, matrix)
+
+    def test_ref_affine_ransac(self):
+        #scoring one hypothesis at a time finds the same points
+        patterns = [fish_fun.standardize_pattern(x) for x in self.records[:20]]
+        expected = [opencv_fun.ref_affine_ransac(x, y, 0.1, 0.99, 1000)
+                    for x, y in zip(patterns[::2], patterns[1::2])]
+        limit = opencv_fun.RANSAC_DISTANCES
+        opencv_fun.RANSAC_DISTANCES = 1
+        try:
+            self.assertEqual([opencv_fun.ref_affine_ransac(x, y, 0.1, 0.99, 1000)
+                              for x, y in zip(patterns[::2], patterns[1::2])], expected)
+        finally:
+            opencv_fun.RANSAC_DISTANCES = limit
+
+    def test_align_patterns_batch(self):
+        patterns = [numpy.array(x['spots']) for x in self.records]
+        matrices = numpy.array([[[self.state.uniform(0.8, 1.2), self.state.uniform(-0.2, 0.2),
+                                  self.state.uniform(-50, 50)],
+                                 [self.state.uniform(-0.2, 0.2), self.state.uniform(0.8, 1.2),
+                                  self.state.uniform(-50, 50)]] for x in patterns])
+        offsets = numpy.cumsum([0] + [len(x) for x in patterns])
+        aligned = fish_fun.align_patterns_batch(matrices, numpy.concatenate(patterns), offsets)
+        for key, pattern in enumerate(patterns):
+            #the old loop applied the matrix to one point at a time
+            self.assertEqual(aligned[offsets[key]:offsets[key + 1]].tolist(),
+                             [[int(x) for x in opencv_fun.affine_apply(matrices[key], point)]
+                              for point in pattern.tolist()])
+
+    def test_affine_transform(self):
+        for record_1, record_2 in zip(self.records[::2], self.records[1::2]):
+            standard_1 = {'spots': fish_fun.standardize_pattern(record_1)}
+            standard_2 = {'spots': fish_fun.standardize_pattern(record_2)}
+            for method, individual_1, individual_2 in [('fish_ref', record_1, record_2),
+                                                       ('fish_ransac', standard_1, standard_2)]:
+                matrix, pattern = fish_fun.align_matrix(individual_1, individual_2, method)
+                self.assertEqual(fish_fun.affine_transform(matrix, pattern),
+                                 [[int(x) for x in opencv_fun.affine_apply(matrix, point)]
+                                  for point in pattern])
+
+
+class RankGalleryTest(TestCase):
+
+    """
+    The ranked search which skips the rows that can not enter the top rows
+    gives the same ranking as scoring every row.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        keep = sorted(set(x for group in groups[:20] for x in group))
+        keep += [x for x in range(len(records)) if x not in keep][:60]
+        #copies of the sightings with a few spots, which the search can skip
+        copies = [dict(records[x], spots=records[x]['spots'][:8]) for x in keep[:30]]
+        save_records([records[x] for x in keep] + copies)
+
+    def setUp(self):
+        gallery.load()
+        self.arrays = gallery.arrays()
+
+    def query(self, row):
+        #a gallery row as a new individual
+        new_individual = self.arrays.individual(row)
+        new_individual['spots_standard'] = self.arrays.pattern_standard(row).tolist()
+        new_individual['name'] = self.arrays.info[row]['name']
+        return new_individual
+
+    def ranking(self, rows, values, matchquality, top):
+        #every row scored, best first and in the rows order for equal values
+        return sorted([(x, value) for x, value in zip(rows, values) if value > matchquality],
+                      key=lambda x: -x[1])[:top]
+
+    def test_rank_gallery_rows(self):
+        for method in ['fish_ransac', 'fish_ref']:
+            for row in range(0, 40, 4):
+                new_individual = self.query(row)
+                rows = [x for x in range(len(self.arrays)) if x != row]
+                #fish_ref is not the same every time, so the scores are given as a cache
+                values = functions.score_gallery_rows(self.arrays, new_individual, rows, method)
+                cache = {x: (value, value, None) for x, value in zip(rows, values)}
+                for matchquality, top in [(2, 3), (4, 10), (0, 1), (0, 200)]:
+                    ranked, checked = functions.rank_gallery_rows(
+                        self.arrays, new_individual, rows, method, matchquality, top, None,
+                        dict(cache))
+                    self.assertEqual(ranked, self.ranking(rows, values, matchquality, top))
+                    self.assertEqual(checked, len(rows))
+
+    def test_rank_gallery_rows_aligned(self):
+        #the rows are aligned during the search
+        for row in [0, 12]:
+            new_individual = self.query(row)
+            rows = [x for x in range(len(self.arrays)) if x != row]
+            values = functions.score_gallery_rows(self.arrays, new_individual, rows,
+                                                  'fish_ransac')
+            cache = {}
+            ranked, checked = functions.rank_gallery_rows(
+                self.arrays, new_individual, rows, 'fish_ransac', 2, 5, None, cache)
+            self.assertEqual(ranked, self.ranking(rows, values, 2, 5))
+            #the rows which could not enter the top rows were not aligned
+            self.assertLess(len(cache), len(rows))
+
+
+class ScoreCacheTest(TestCase):
+
+    """
+    A search of an image reads the scores saved by its earlier searches and
+    finds the same matches, until the spots of a row change.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        save_records(records[:60])
+
+    def setUp(self):
+        gallery.load()
+        self.arrays = gallery.arrays()
+        self.query = self.arrays.individual(0)
+        self.query['spots_standard'] = self.arrays.pattern_standard(0).tolist()
+        self.query['name'] = self.arrays.info[0]['name']
+        self.query['imageId'] = self.arrays.info[0]['imageId']
+
+    def search(self):
+        #a ranked search of the query
+        matchData = identifyImage.getBioMatchData(gallery.arrays(), self.query, ['fish_ransac'],
+                                                  2, 1, 5, None)
+        return matchData, matchData.pop('scoreCache')
+
+    def cached(self):
+        #the cached scores of the query
+        return scorecache.load_scores(gallery.arrays(), [self.query['imageId']],
+                                      [scorecache.params_hash(self.query, 'fish_ransac')],
+                                      'fish_ransac')[0]
+
+    def test_cached_search(self):
+        first, counts = self.search()
+        self.assertEqual(counts['hits'], 0)
+        self.assertGreater(counts['misses'], 0)
+        misses = counts['misses']
+        second, counts = self.search()
+        #the second search reads every row the first one aligned, and no other
+        self.assertEqual(counts['hits'], misses)
+        self.assertEqual(counts['misses'], 0)
+        self.assertEqual(second, first)
+        #the cached scores and inliers are those of the rows aligned again
+        cache = self.cached()
+        rows = sorted(cache)
+        aligned = {}
+        functions.score_gallery_rows(self.arrays, self.query, rows, 'fish_ransac', aligned)
+        self.assertEqual([cache[x][:2] for x in rows], [aligned[x][:2] for x in rows])
+        self.assertTrue(all(0 < cache[x][1] and cache[x][0] <= cache[x][1] for x in rows))
+
+    def test_invalidate(self):
+        self.search()
+        rows = sorted(self.cached())
+        imageIds = [self.arrays.info[x]['imageId'] for x in rows[:2]]
+        #a change of the date keeps the scores of the row
+        data_individual = FishData.objects.get(pk=imageIds[0])
+        data_individual.date = '2016-09-23'
+        data_individual.save()
+        self.assertEqual(sorted(self.cached()), rows)
+        #a change of the spots deletes them
+        data_individual = FishData.objects.get(pk=imageIds[1])
+        data_individual.spots = json.dumps(json.loads(data_individual.spots)[1:])
+        data_individual.save()
+        self.assertFalse(PairScore.objects.filter(galleryImageId=imageIds[1]).exists())
+        self.assertEqual(len(self.cached()), len(rows) - 1)
+        #the search aligns the changed row again
+        matchData, counts = self.search()
+        self.assertEqual(counts['misses'], 1)
+
+    def test_random_methods(self):
+        #the scores of a method drawing random samples are not cached
+        rows = list(range(1, len(self.arrays)))
+        cache = {}
+        functions.score_gallery_rows(self.arrays, self.query, rows, 'fish_standard', cache)
+        self.assertEqual(cache, {})
+        functions.score_gallery_rows(self.arrays, self.query, rows, 'fish_ransac', cache)
+        self.assertEqual(sorted(cache), [x for x in rows if self.arrays.standard[x]])
+        identifyImage.getBioMatchData(gallery.arrays(), self.query, ['fish_standard'],
+                                      1000, 1, 0, None)
+        self.assertFalse(PairScore.objects.exists())
+
+    def test_random_passes(self):
+        #every pass of a search with a random method aligns the rows again
+        align_matrix = fish_fun.align_matrix
+        aligned = []
+        def counted(*args):
+            aligned[-1] += 1
+            return align_matrix(*args)
+        fish_fun.align_matrix = counted
+        try:
+            for matchPerm in [1, 3]:
+                aligned.append(0)
+                identifyImage.getBioMatchData(gallery.arrays(), self.query, ['fish_standard'],
+                                              1000, matchPerm, 0, None)
+        finally:
+            fish_fun.align_matrix = align_matrix
+        self.assertGreater(aligned[0], 0)
+        self.assertEqual(aligned[1], 3 * aligned[0])
+
+
+class ReidentifyTest(TestCase):
+
+    """
+    The reidentify command joins the matching pairs into clusters, and a
+    run resumed from its checkpoint finds the same clusters as a run which
+    was not interrupted, unless FishData changed in between. A finished run
+    is followed by a new run.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        keep = sorted(set(x for group in groups[:8] for x in group))
+        keep += [x for x in range(len(records)) if x not in keep][:20]
+        save_records([records[x] for x in keep])
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def run_command(self, name, *args):
+        #a dry run with its checkpoint in the test directory
+        path = os.path.join(self.root, name)
+        call_command('reidentify', '--workers', '1', '--chunk', '4', '--dry-run',
+                     '--checkpoint', path, *args, stdout=io.StringIO())
+        with open(path) as json_file:
+            return json.load(json_file)
+
+    def interrupted_run(self, name):
+        #stop the run after two chunks, the checkpoint is saved on the way out
+        match_rows = reidentify.match_rows
+        calls = []
+        def interrupted(*args):
+            calls.append(1)
+            if len(calls) > 2:
+                raise KeyboardInterrupt
+            return match_rows(*args)
+        reidentify.match_rows = interrupted
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_command(name)
+        finally:
+            reidentify.match_rows = match_rows
+        with open(os.path.join(self.root, name)) as json_file:
+            return json.load(json_file)
+
+    def test_cluster_pairs(self):
+        pairs = [(3, 2, 20), (7, 5, 15), (1, 2, 13), (5, 7, 14)]
+        self.assertEqual(sorted(reidentify.cluster_pairs(pairs)), [[1, 2, 3], [5, 7]])
+        self.assertEqual(reidentify.cluster_pairs([]), [])
+
+    def test_checkpoint(self):
+        state = self.run_command('full.json')
+        self.assertEqual(sorted(state['done']), sorted(FishData.objects.values_list('imageId', flat=True)))
+        self.assertEqual(state['stamp'], GalleryStamp.objects.get().changes)
+        self.assertGreater(len(reidentify.cluster_pairs(state['pairs'])), 0)
+        #each pair is found once, by the first row of the pair
+        pairs = [tuple(sorted(x[:2])) for x in state['pairs']]
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertTrue(state['finished'])
+        #a finished run is followed by a new run, which finds the same pairs
+        self.assertEqual(self.run_command('full.json'), state)
+
+    def test_resume(self):
+        expected = self.run_command('full.json')
+        interrupted = self.interrupted_run('resumed.json')
+        self.assertEqual(len(interrupted['done']), 8)
+        self.assertNotIn('finished', interrupted)
+        state = self.run_command('resumed.json')
+        self.assertEqual(sorted(state['done']), sorted(expected['done']))
+        self.assertEqual(sorted(reidentify.cluster_pairs(state['pairs'])),
+                         sorted(reidentify.cluster_pairs(expected['pairs'])))
+
+    def test_resume_changed(self):
+        self.interrupted_run('resumed.json')
+        #a change of FishData since the checkpoint stops the resume
+        data_individual = FishData.objects.order_by('imageId').first()
+        data_individual.spots = json.dumps(json.loads(data_individual.spots)[1:])
+        data_individual.save()
+        with self.assertRaisesRegex(CommandError, 'FishData has changed'):
+            self.run_command('resumed.json')
+        #a new checkpoint starts again
+        self.assertEqual(self.run_command('new.json')['stamp'],
+                         GalleryStamp.objects.get().changes)
+
+    def test_finished_changed(self):
+        #a change of FishData after a finished run, such as an upload or the
+        #baseTags saved by the run, starts a new run
+        path = os.path.join(self.root, 'saved.json')
+        call_command('reidentify', '--workers', '1', '--chunk', '4',
+                     '--checkpoint', path, stdout=io.StringIO())
+        data_individual = FishData.objects.order_by('imageId').first()
+        data_individual.spots = json.dumps(json.loads(data_individual.spots)[1:])
+        data_individual.save()
+        state = self.run_command('saved.json')
+        self.assertEqual(state['stamp'], GalleryStamp.objects.get().changes)
+        self.assertEqual(len(state['done']), FishData.objects.count())
+        self.assertTrue(state['finished'])
+
+
+class ParallelSearchTest(TestCase):
+
+    """
+    The search pool of parallel.py finds the same rows as the search in one
+    process, also after FishData changes are replayed into its workers.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        keep = sorted(set(x for group in groups[:10] for x in group))
+        keep += [x for x in range(len(records)) if x not in keep][:40]
+        save_records([records[x] for x in keep])
+        cls.records = [records[x] for x in keep]
+
+    def setUp(self):
+        gallery.load()
+
+    def tearDown(self):
+        parallel.search_pool.shutdown()
+
+    def query(self, packed, row):
+        #a gallery row as a new individual
+        new_individual = packed.individual(row)
+        new_individual['spots_standard'] = packed.pattern_standard(row).tolist()
+        new_individual['name'] = packed.info[row]['name']
+        return new_individual
+
+    def assertSameRanking(self, packed, row):
+        new_individual = self.query(packed, row)
+        rows = [x for x in range(len(packed)) if x != row]
+        for matchquality, top in [(2, 5), (0, 200)]:
+            ranked, checked = parallel.search_pool.rank(packed, new_individual, rows, 'fish_ransac',
+                                                        matchquality, top, 2, None)
+            self.assertEqual((ranked, checked), functions.rank_gallery_rows(
+                packed, new_individual, rows, 'fish_ransac', matchquality, top, None))
+
+    def test_rank(self):
+        packed = gallery.arrays()
+        for row in range(0, 20, 5):
+            self.assertSameRanking(packed, row)
+
+    def test_search(self):
+        packed = gallery.arrays()
+        for row in range(0, 20, 5):
+            new_individual = self.query(packed, row)
+            rows = [x for x in range(len(packed)) if x != row]
+            values = functions.score_gallery_rows(packed, new_individual, rows, 'fish_ransac')
+            #a single row above the match quality is found by both searches, the
+            #shards check more rows than one process before they stop
+            best = rows[values.index(max(values))]
+            rows = [x for x, value in zip(rows, values) if value < max(values)] + [best]
+            matchquality = max(values) - 1
+            match, checked = parallel.search_pool.search(packed, new_individual, rows,
+                                                         'fish_ransac', matchquality, 2, None)
+            expected = functions.search_gallery_rows(packed, new_individual, rows,
+                                                     'fish_ransac', matchquality, None)
+            self.assertEqual(match, expected[0])
+            self.assertLessEqual(checked, len(rows))
+            #no row above the match quality, every row is checked
+            self.assertEqual(parallel.search_pool.search(packed, new_individual, rows, 'fish_ransac',
+                                                         max(values), 2, None),
+                             (None, len(rows)))
+
+    def test_bio_match_data(self):
+        #a ranked search with SEARCH_WORKERS = 2 gives the same matches
+        new_individual = self.query(gallery.arrays(), 0)
+        new_individual['name'] = 'query'
+        expected = identifyImage.getBioMatchData(gallery.arrays(), new_individual, ['fish_ransac'],
+                                                 2, 1, 5, None)
+        workers = identifyImage.SEARCH_WORKERS
+        identifyImage.SEARCH_WORKERS = 2
+        try:
+            matchData = identifyImage.getBioMatchData(gallery.arrays(), new_individual,
+                                                      ['fish_ransac'], 2, 1, 5, None)
+        finally:
+            identifyImage.SEARCH_WORKERS = workers
+        self.assertEqual(matchData, expected)
+
+    def test_changes(self):
+        self.assertSameRanking(gallery.arrays(), 0)
+        executor = parallel.search_pool.executor
+        #a changed row, a new row and a deleted row reach the running workers
+        data_individual = FishData.objects.get(pk=gallery.arrays().info[3]['imageId'])
+        data_individual.spots = json.dumps(json.loads(data_individual.spots)[2:])
+        data_individual.save()
+        record = self.records[0]
+        FishData(imageId=1000, name='copy_' + record['name'], date=record['date'], tank='-',
+                 baseTag='', pitTag='-', report='-', spots=json.dumps(record['spots']),
+                 refNose=json.dumps(record['ref_nose']), refTail=json.dumps(record['ref_tail']),
+                 refHead=json.dumps(record['ref_head'])).save()
+        FishData.objects.get(pk=gallery.arrays().info[7]['imageId']).delete()
+        for row in [0, 3, 10]:
+            self.assertSameRanking(gallery.arrays(), row)
+        self.assertIs(parallel.search_pool.executor, executor)
+        #the new row is found by a search of its copy
+        row = gallery.arrays().index[1000]
+        new_individual = self.query(gallery.arrays(), gallery.arrays().index[1])
+        new_individual['name'] = 'query'
+        ranked = parallel.search_pool.rank(gallery.arrays(), new_individual,
+                                           list(range(len(gallery.arrays()))), 'fish_ransac',
+                                           2, 5, 2, None)[0]
+        self.assertIn(row, [x[0] for x in ranked])
+
+
+class BatchTest(TestCase):
+
+    """
+    The batch search finds the same matches as a single search of each
+    query, and the blocked nearest rows are those of the full score matrix.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        keep = sorted(set(x for group in groups[:10] for x in group))
+        keep += [x for x in range(len(records)) if x not in keep][:40]
+        save_records([records[x] for x in keep])
+
+    def setUp(self):
+        gallery.load()
+
+    def test_blocked_nearest(self):
+        state = numpy.random.RandomState(3)
+        #small whole numbers, so the scores are exact and many are equal
+        matrix = state.randint(-3, 4, (300, 16)).astype(numpy.float32)
+        queries = state.randint(-3, 4, (25, 16)).astype(numpy.float32)
+        scores = numpy.dot(queries, matrix.T)
+        block_bytes = batch.BLOCK_BYTES
+        #blocks of 7 rows and one query at a time
+        batch.BLOCK_BYTES = 7 * 16 * 4
+        try:
+            for number in [1, 5, 40, 400]:
+                expected = [numpy.lexsort((numpy.arange(len(matrix)), -x))[:number].tolist()
+                            for x in scores]
+                self.assertEqual(batch.blocked_nearest(matrix, queries, number, 0), expected)
+                self.assertEqual(batch.blocked_nearest(matrix, queries, number, 256), expected)
+        finally:
+            batch.BLOCK_BYTES = block_bytes
+
+    def test_identify_batch(self):
+        packed = gallery.arrays()
+        new_individuals = []
+        for row in range(0, 40, 3):
+            new_individual = packed.individual(row)
+            new_individual['spots_standard'] = packed.pattern_standard(row).tolist()
+            new_individual['name'] = 'query_%d' % row
+            new_individuals += [new_individual]
+        #a query with the name of a gallery row searches its other sightings
+        #(fish_ref, used without standard spots, is not the same every time)
+        medoid = [x for x in range(len(packed)) if packed.representative[x] and
+                  len(packed.sightings.get(str(packed.info[x]['baseTag']), [])) > 1][0]
+        new_individuals[1]['name'] = packed.info[medoid]['name']
+        self.assertIsNot(packed.representatives(new_individuals[1]['name']), packed.representative)
+        results = batch.identify_batch(new_individuals, 'fish_ransac', 2, 5)
+        self.assertEqual(len(results), len(new_individuals))
+        self.assertTrue(any(x['matching_image_list'] for x in results))
+        for new_individual, result in zip(new_individuals, results):
+            expected = identifyImage.getBioMatchData(gallery.arrays(), new_individual,
+                                                     ['fish_ransac'], 2, 1, 5, None)
+            self.assertEqual(result, dict(expected, name=new_individual['name']))
+
+
+class TagMatchTest(TestCase):
+
+    """
+    A tag search returns the gallery rows with the pitTag, or with the tag
+    as their report when they have no pitTag, newest first.
+    """
+
+    def setUp(self):
+        rows = [(1, 'a_1', '2015-01-01', 'T1', '-', True),
+                (2, 'a_2', '2016-01-01', '-', 'T1', True),
+                (3, 'a_3', '2016-01-01', 'T1', 'T2', True),
+                (4, 'a_4', '2017-01-01', 'T2', 'T1', True),
+                (5, 'a_5', '2018-01-01', '-', '-', True),
+                (6, 'query', '2018-01-01', 'T1', '-', True),
+                (7, 'a_7', '2019-01-01', 'T1', '-', False),
+                (8, 'a_8', '2014-01-01', 'T1', '-', True)]
+        for imageId, name, date, pitTag, report, inGallery in rows:
+            FishData(imageId=imageId, name=name, date=date, tank='-', baseTag='',
+                     pitTag=pitTag, report=report, spots='[]', inGallery=inGallery).save()
+
+    def test_tag_match(self):
+        matchData = identifyImage.getTagMatchData({'name': 'query'}, 'T1')
+        #tagged by pitTag or by report without a pitTag, not the query itself or
+        #rows outside the gallery, newest first and by imageId for equal dates
+        self.assertEqual(matchData['matching_image_id_list'], [2, 3, 1, 8])
+        self.assertEqual(matchData['matching_image_list'][0],
+                         {'population': '', 'name': 'a_2', 'imageId': 2, 'tank': '-',
+                          'date': '2016-01-01'})
+        self.assertEqual(matchData['matchPitTag'], 'T1')
+        self.assertTrue(matchData['searchComplete'])
+        #the untagged value '-' matches nothing
+        self.assertEqual(identifyImage.getTagMatchData({'name': 'query'}, '-')['matching_image_id_list'], [])
+        self.assertEqual(identifyImage.getTagMatchData({'name': 'query'}, 'T2')['matching_image_id_list'], [4])
+
+
+class IdentityTest(TestCase):
+
+    """
+    The identity of a baseTag keeps the medoid of its sightings as they are
+    saved and deleted, and a bio search which matches the medoid returns
+    every sighting of the identity.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        records, groups = real_records()
+        group = groups[0]
+        cls.tag = records[group[0]]['name'].split('_')[1]
+        #the first sighting is the query, the second is in the gallery with a
+        #copy missing a few spots and another fish given the same baseTag
+        cls.query = records[group[0]]
+        others = [x for x in range(len(records)) if records[x]['name'].split('_')[1] != cls.tag]
+        save_records([records[group[1]]] + [records[x] for x in others[:40]])
+        sighting = records[group[1]]
+        for imageId, record in [(1000, dict(sighting, spots=sighting['spots'][2:])),
+                                (1001, records[others[40]])]:
+            FishData(imageId=imageId, name='copy_%d' % imageId, date=record['date'], tank='-',
+                     baseTag=cls.tag, pitTag='-', report='-', spots=json.dumps(record['spots']),
+                     refNose=json.dumps(record['ref_nose']), refTail=json.dumps(record['ref_tail']),
+                     refHead=json.dumps(record['ref_head'])).save()
+
+    def setUp(self):
+        gallery.load()
+
+    def members(self, baseTag):
+        return list(FishData.objects.filter(baseTag=baseTag).values(*MEDOID_FIELDS))
+
+    def new_individual(self, record, name):
+        new_individual = {'spots': record['spots'], 'ref_nose': record['ref_nose'],
+                          'ref_tail': record['ref_tail'], 'ref_head': record['ref_head'],
+                          'name': name}
+        new_individual['spots_standard'] = features.standard_spots(
+            record['spots'], record['ref_nose'], record['ref_tail'])
+        return new_individual
+
+    def test_medoid(self):
+        #the sighting most similar to the others in total
+        members = self.members(self.tag)
+        embeddings = numpy.array([features.pattern_embedding(decode_points(x['spotsStandard']))
+                                  for x in members])
+        expected = members[int(numpy.argmax(numpy.dot(embeddings, embeddings.T).sum(axis=1)))]
+        self.assertEqual(identity_medoid(members), expected['imageId'])
+        #without standard spots, the sighting with the most spots
+        members = [dict(x, spotsStandard='') for x in members]
+        expected = max(members, key=lambda x: len(json.loads(x['spots'])))
+        self.assertEqual(identity_medoid(members), expected['imageId'])
+
+    def test_update_identity(self):
+        identity = Identity.objects.get(pk=self.tag)
+        self.assertEqual(identity.sightings, len(self.members(self.tag)))
+        self.assertEqual(identity.medoidImageId, identity_medoid(self.members(self.tag)))
+        #moving the medoid to another baseTag recalculates both identities
+        data_individual = FishData.objects.get(pk=identity.medoidImageId)
+        data_individual.baseTag = 'moved'
+        data_individual.save()
+        identity = Identity.objects.get(pk=self.tag)
+        self.assertEqual(identity.sightings, len(self.members(self.tag)))
+        self.assertEqual(identity.medoidImageId, identity_medoid(self.members(self.tag)))
+        self.assertEqual(Identity.objects.get(pk='moved').medoidImageId, data_individual.imageId)
+        self.assertEqual(gallery.arrays().identities[self.tag], identity.medoidImageId)
+        #deleting the last sighting removes the identity
+        data_individual.delete()
+        self.assertFalse(Identity.objects.filter(pk='moved').exists())
+        self.assertNotIn('moved', gallery.arrays().identities)
+        FishData.objects.filter(baseTag=self.tag).exclude(pk=identity.medoidImageId).delete()
+        self.assertEqual(Identity.objects.get(pk=self.tag).sightings, 1)
+
+    def test_match_sightings(self):
+        packed = gallery.arrays()
+        medoid = packed.index[Identity.objects.get(pk=self.tag).medoidImageId]
+        sightings = packed.sightings[self.tag]
+        #only the medoid of the identity is searched
+        subset = packed.representatives('query')
+        self.assertEqual([x for x in sightings if subset[x]], [medoid])
+        matchData = identifyImage.getBioMatchData(packed, self.new_individual(self.query, 'query'),
+                                                  ['fish_ransac'], 12, 1, 5, None)
+        self.assertIn(packed.info[medoid]['imageId'], matchData['matching_image_id_list'])
+        #the match is expanded into every sighting of the identity
+        self.assertTrue(set(packed.info[x]['imageId'] for x in sightings) <= 
+                        set(matchData['matching_image_id_list']))
+        self.assertEqual(matchData['matchPitTag'], '-')
+
+    def test_query_named_as_medoid(self):
+        #a query with the name of the medoid searches the other sightings
+        packed = gallery.arrays()
+        medoid = packed.index[Identity.objects.get(pk=self.tag).medoidImageId]
+        name = packed.info[medoid]['name']
+        subset = packed.representatives(name)
+        self.assertEqual(sorted(x for x in packed.sightings[self.tag] if subset[x]),
+                         packed.sightings[self.tag])
+        matchData = identifyImage.getBioMatchData(packed, self.new_individual(self.query, name),
+                                                  ['fish_ransac'], 12, 1, 5, None)
+        others = [packed.info[x]['imageId'] for x in packed.sightings[self.tag] if x != medoid]
+        self.assertTrue(set(others) & set(matchData['matching_image_id_list']))
+        self.assertNotIn(packed.info[medoid]['imageId'], matchData['matching_image_id_list'])
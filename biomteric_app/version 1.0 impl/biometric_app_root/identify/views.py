@@ -92,7 +92,9 @@ def getDataAndRun(request):
             # getting image name from uploaded image file
             image_name = str(form['image'].value()).split('.')[0]
             # Calling the process of matching the uploaded data with database data
-            analyzeDataResult = identifyImage.analyzeData(image_url, image_name, identifyObj.pitTag)
+            analyzeDataResult = identifyImage.analyzeData(image_url, image_name, identifyObj.pitTag, imageId)
+            # recording how many candidates were checked before the search deadline
+            identifyObj.searchProgress = analyzeDataResult.get('searchProgress', '')
             # checking whether the analyzes was successull or not
             if analyzeDataResult['type'] == 'success':
                 spotObj = FishData()
@@ -110,6 +112,7 @@ def getDataAndRun(request):
                 spotObj.refNose = json.dumps(new_individual['ref_nose'])
                 spotObj.refHead = json.dumps(new_individual['ref_head'])
                 spotObj.refTail = json.dumps(new_individual['ref_tail'])
+                spotObj.pipelineVersion = new_individual['pipelineVersion']
                 if analyzeDataResult['type'] is 'Match Not Found' or len(matching_image_list) == 0:
                     spotObj.population = '-'
                 else:
@@ -134,6 +137,7 @@ def getDataAndRun(request):
                 else:
                     identifyObj.population = matching_image_list[0]['population']
                     identifyObj.matchingImageId = json.dumps(match_image_id_list)
+                    identifyObj.matchingScore = json.dumps(analyzeDataResult['matching_score_list'])
                     identifyObj.status = 'Match Found'
                 # saving the match details
                 identifyObj.save()
@@ -141,8 +145,46 @@ def getDataAndRun(request):
             else:
                 identifyObj.status = 'Match not Found'
                 identifyObj.save()
+                # keeping the spots of an analysed image, so it can be searched again without the image
+                if 'new_individual' in analyzeDataResult:
+                    saveUnmatchedSpots(imageId, image_name, form.cleaned_data['image'], 
+                                       identifyObj.tank, analyzeDataResult)
                 #responseData = {'type': 'info', 'message': 'Sorry, unable to identify the fish. Please try again with another.'}
 
+"""
+saveUnmatchedSpots(imageId, image_name, imageUrl, tank, analyzeDataResult)
+to save the spots and ref points of an analysed image which found no match. The row 
+is not added to the gallery (see FishData.inGallery) but lets tryAgain and the 
+sweep_unmatched command search the image again without processing it again
+
+Input : imageId
+        imageId of the uploaded image
+        image_name, imageUrl, tank
+        details of the uploaded image
+        analyzeDataResult
+        the result of the search, containing new_individual
+"""
+def saveUnmatchedSpots(imageId, image_name, imageUrl, tank, analyzeDataResult):
+    new_individual = analyzeDataResult['new_individual']
+    spotObj = FishData()
+    spotObj.imageId = imageId
+    spotObj.name = image_name
+    spotObj.imageUrl = imageUrl
+    spotObj.spots = json.dumps(new_individual['spots'])
+    spotObj.refNose = json.dumps(new_individual['ref_nose'])
+    spotObj.refHead = json.dumps(new_individual['ref_head'])
+    spotObj.refTail = json.dumps(new_individual['ref_tail'])
+    spotObj.pipelineVersion = new_individual['pipelineVersion']
+    spotObj.population = '-'
+    spotObj.tank = tank
+    spotObj.date = datetime.date.today().strftime("%y-%m-%d")
+    spotObj.time = analyzeDataResult['timeTook']
+    spotObj.pitTag = '-'
+    spotObj.report = '-'
+    spotObj.baseTag = ''
+    spotObj.inGallery = False
+    spotObj.save()
+
 """
 IdentifyList(ListView):
 to load the uploaded list in the table as listview
@@ -197,11 +239,16 @@ def getMatchDataFromDB(imageId):
     # condition to check whether the clicked image has match found
     if(matchDataId.status == 'Match Found'):
         # decoding the matching imageId list
-        matchImageIdList = jsonDec.decode(matchDataId.matchingImageId)
+        matchImageIdList = json.loads(matchDataId.matchingImageId)
+        # decoding the score of each match (empty for tag matches)
+        matchScoreList = json.loads(matchDataId.matchingScore) if matchDataId.matchingScore else []
         # getting the match data using matchImageIdList
-        matchDataList = FishData.objects.filter(pk__in=matchImageIdList)
-        # organizing the data for display
-        for data in matchDataList:
+        matchDataList = FishData.objects.in_bulk(matchImageIdList)
+        # organizing the data for display, keeping the ranked order
+        for position, matchImageId in enumerate(matchImageIdList):
+            if matchImageId not in matchDataList:
+                continue
+            data = matchDataList[matchImageId]
             print(data.imageUrl.url)
             if data.pitTag:
                 tag = data.pitTag
@@ -215,6 +262,7 @@ def getMatchDataFromDB(imageId):
                 'tank': data.tank,
                 'date': data.date,
                 'tag' : tag,
+                'score': matchScoreList[position] if position < len(matchScoreList) else '-',
                 })
     return JsonResponse(responseData, safe=False)
 
@@ -247,8 +295,15 @@ def tryAgain(request):
             image_url = MEDIA_ROOT + '/images/' + dataToCheck.image.url.split('/')[3]
             # setting the image name for further process
             image_name = str(dataToCheck.image.url.split('/')[3].split('.')[0])
-            # Initiating the analysis for finding the matches
-            analyzeDataResult = identifyImage.analyzeData(image_url, image_name, dataToCheck.pitTag)
+            # searching again with the stored spots, the image is only analysed
+            # again when the stored spots are missing or out of date
+            analyzeDataResult = identifyImage.searchStoredData(dataToCheck.imageId, dataToCheck.pitTag)
+            storedSpots = analyzeDataResult is not None
+            if analyzeDataResult is None:
+                # Initiating the analysis for finding the matches
+                analyzeDataResult = identifyImage.analyzeData(image_url, image_name, dataToCheck.pitTag, dataToCheck.imageId)
+            # recording how many candidates were checked before the search deadline
+            dataToCheck.searchProgress = analyzeDataResult.get('searchProgress', '')
             # checks whether the process is success or not
             if analyzeDataResult['type'] == 'success':
                 spotObj = FishData()
@@ -266,6 +321,7 @@ def tryAgain(request):
                 spotObj.refNose = json.dumps(new_individual['ref_nose'])
                 spotObj.refHead = json.dumps(new_individual['ref_head'])
                 spotObj.refTail = json.dumps(new_individual['ref_tail'])
+                spotObj.pipelineVersion = new_individual['pipelineVersion']
                 if analyzeDataResult['type'] is 'Match Not Found' or len(matching_image_list) == 0:
                     spotObj.population = '-'
                 else:
@@ -290,6 +346,7 @@ def tryAgain(request):
                 else:
                     dataToCheck.population = matching_image_list[0]['population']
                     dataToCheck.matchingImageId = json.dumps(match_image_id_list)
+                    dataToCheck.matchingScore = json.dumps(analyzeDataResult['matching_score_list'])
                     dataToCheck.status = 'Match Found'
                 # saving clicked image data
                 dataToCheck.save()             
@@ -297,6 +354,10 @@ def tryAgain(request):
                 dataToCheck.status = 'Match not Found'
                 # saving clicked image data
                 dataToCheck.save()
+                # keeping the spots of an analysed image, so it can be searched again without the image
+                if 'new_individual' in analyzeDataResult and not storedSpots:
+                    saveUnmatchedSpots(dataToCheck.imageId, image_name, dataToCheck.image.url, 
+                                       dataToCheck.tank, analyzeDataResult)
     # returning the match details for showing for the user
     return getMatchDataFromDB(imageId)
 